@@ -10,14 +10,42 @@ import curses
 import random
 import time
 import sys
+import os
+import json
+import gzip
+import select
+import shutil
+import signal
+import sqlite3
+import heapq
+import threading
+import unicodedata
+from array import array
+from bisect import bisect_left
 from copy import deepcopy
-from collections import deque
+from collections import deque, namedtuple
+from functools import lru_cache
+from math import gcd
+from itertools import combinations_with_replacement
+from queue import Queue, Empty
+try:
+    import termios
+    import tty
+except ImportError:  # Windows: no raw tty, so no ANSI renderer
+    termios = tty = None
+try:
+    import numpy as np
+except ImportError:  # optional: the bot environment falls back to plain lists
+    np = None
 
 # -------------------- Game data (Clash-like names) --------------------
 CLASSES = {
-    "Knight": {"Strength": 10, "Agility": 6, "Magic": 2, "hp": 48, "passive": "armor"},
-    "Wizard": {"Strength": 4, "Agility": 6, "Magic": 12, "hp": 34, "passive": "arcane"},
-    "Bandit": {"Strength": 7, "Agility": 10, "Magic": 3, "hp": 36, "passive": "swift"},
+    "Knight": {"Strength": 10, "Agility": 6, "Magic": 2, "hp": 48, "passive": "armor",
+               "spells": ["firebolt", "heal", "smite"]},
+    "Wizard": {"Strength": 4, "Agility": 6, "Magic": 12, "hp": 34, "passive": "arcane",
+               "spells": ["firebolt", "heal", "arc_lance", "frost_cone"]},
+    "Bandit": {"Strength": 7, "Agility": 10, "Magic": 3, "hp": 36, "passive": "swift",
+               "spells": ["firebolt", "heal", "fan_of_knives"]},
 }
 
 AREAS = [
@@ -27,6 +55,15 @@ AREAS = [
         "desc": "A tangled wood where Spear Goblins and Ghosts lurk.",
         "encounters": ["spear_goblin", "ghost", "skeleton_army", "witch"],
         "loot": ["elixir_bottle", "royal_sword", "leather_armor"],
+        "terrain": [
+            "...#.......",
+            "...#...#...",
+            ".......#...",
+            "...........",
+            "..~~...#...",
+            "..~~.......",
+            ".....#.....",
+        ],
         "art": [
             r"⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⣠⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀",
             r"⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠓⠒⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⢀⣀⣀⠀⠀⠀⠀⠀⢠⢤⣤⣤⡀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀",
@@ -55,6 +92,15 @@ AREAS = [
         "desc": "Gladiatorial pits with Mini P.E.K.K.A. and Mega Minions.",
         "encounters": ["mini_pekka", "mega_minion", "valkyrie", "prince", "bowler", "dark_prince"],
         "loot": ["magic_tome", "crown_key", "iron_sword"],
+        "terrain": [
+            "...........",
+            "..#.....#..",
+            "...........",
+            "...........",
+            "...........",
+            "..#.....#..",
+            "...........",
+        ],
         "art": [
             r"⠀⠀⠀⠀⠀⢀⣠⣤⣤⣶⣶⣶⣶⣶⣶⣄⠀⠀⠀⠀⠀⠀⠀⠀⠀⠀",
             r"⠀⠀⢀⣴⣾⣿⣿⠿⢿⣿⣿⠏⠉⠉⠹⣿⣷⠀⠀⠀⠀⠀⠀⠀⠀⠀",
@@ -75,6 +121,15 @@ AREAS = [
         "desc": "Trap-filled valley: Bandit leaders and ambushes roam.",
         "encounters": ["bandit", "trap_spike", "lumberjack", "royal_ghost", "archer_queen"],
         "loot": ["elixir_flask", "treasure_map", "steel_armor"],
+        "terrain": [
+            "..^....^...",
+            "...#..^....",
+            ".^....#..^.",
+            "....^......",
+            "..#....^...",
+            "...^..#..^.",
+            ".......^...",
+        ],
         "art": [
             r"⣤⣿⠗⣯⠇⣰⠁⠀⠀⢀⡼⠉⡲⡀⠀⠈⢳⢦⣈⣷⣴⠏⠢⡈⢳⢸⠀⠀⡠⠋⢳⣄⡀⠀⢄⡄⠘⣿⡄⠀⠘⠀⣇⣿⡐⠁⡀⠀⠁⠀⠑⢬⣿⡉⡿⢄⣿⢇⡱⢝⡄⠈⣿⡇⠑",
             r"⢿⡟⠉⠘⢠⠃⢀⢁⢠⢊⠄⠊⢀⠍⠣⣤⢃⠀⠉⢻⣿⠀⠀⠐⠘⣿⣠⠞⠀⢠⠁⠹⡍⠢⢜⡙⡄⣿⡧⡀⠀⣿⣞⠸⢣⡀⠇⡄⠀⠀⠀⠀⣟⢸⣧⠊⢉⠺⣆⠀⢇⠁⣼⡇⠀",
@@ -103,6 +158,15 @@ AREAS = [
         "desc": "Scorching dunes where only the strongest warriors battle beneath the burning sun.",
         "encounters": ["pekka", "mega_knight", "prince", "dark_prince", "archer_queen", "royal_ghost", "electro_wizard"],
         "loot": ["royal_blade", "steel_armor", "magic_tome"],
+        "terrain": [
+            "~~~....~~~~",
+            "~~..~~..~~~",
+            "....~~~....",
+            "...........",
+            "..~~...~~..",
+            "~~~~..~~~~~",
+            "~~~~~~~~~~~",
+        ],
         "art": [
             r"        $$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$W",
             r"        .$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$W",
@@ -148,6 +212,15 @@ AREAS = [
         "desc": "Crimson heights where the Baby Dragon sleeps upon treasure.",
         "encounters": ["baby_dragon"],
         "loot": ["magic_tome"],
+        "terrain": [
+            "..#.....#..",
+            "...^...^...",
+            "..#.....##.",
+            "...........",
+            ".....^.....",
+            "..#..^..#..",
+            "...........",
+        ],
         "art": [
             r"                     _",
             r"                    /#\\",
@@ -180,6 +253,15 @@ AREAS = [
         "description": "A silent crater where the air vibrates with ancient power.",
         "encounters": ["adult_dragon"],
         "loot": ["dragon_scale"],
+        "terrain": [
+            "^^.......^^",
+            "^.........^",
+            "...........",
+            "...........",
+            "...........",
+            "^.........^",
+            "^^.......^^",
+        ],
     },
 ]
 SECRET_FINAL_ARENA = {
@@ -188,6 +270,15 @@ SECRET_FINAL_ARENA = {
     "desc": "A forgotten arena sealed behind royal magic.",
     "encounters": ["archer_queen", "mega_knight", "golem"],
     "loot": ["magic_tome"],
+    "terrain": [
+        "...........",
+        "..#..^..#..",
+        "...........",
+        "....^.^....",
+        "...........",
+        "..#..^..#..",
+        "...........",
+    ],
     "art": [                                                                                                                                                                
             r"-#@@@@@   :++.            .=#@@@@@@@@#.   .#@@@@@@@#+               .++:      #@#.",                        
             r"+@@@@@@ *+-            :   #@@@@@@@@@+   +@@@@@@@@#    -==           +%+    +%@+",                         
@@ -270,19 +361,23 @@ ENEMIES = {
     "dark_prince": {"name": "Dark Prince", "hp": 32, "atk": 10, "agility": 7, "special": "charge", "taunts": ["Small charge!", "Mini charge!"]},
     "pekka": {"name": "P.E.K.K.A.", "hp": 60, "atk": 18, "agility": 3, "special": "sturdy", "taunts": ["DESTROY!", "P.E.K.K.A. POWER!"]},
     "electro_wizard": {"name": "Electro Wizard", "hp": 40, "atk": 7, "agility": 8, "special": "stun", "range": 3, "taunts": ["Zap zap!", "Don't blink!"]},
-    "witch": {"name": "Witch", "hp": 18, "atk": 4, "agility": 5, "special": "summon", "range": 3, "taunts": ["Rise, my minions!", "Heh heh!"]},
-    "golem": {"name": "Golem", "hp": 80, "atk": 16, "agility": 2, "special": "explode", "taunts": ["Grrr!", "Crush!"]},
+    "witch": {"name": "Witch", "hp": 18, "atk": 4, "agility": 5, "special": "summon", "range": 3, "summons": "skeleton", "summon_count": 2, "taunts": ["Rise, my minions!", "Heh heh!"]},
+    "golem": {"name": "Golem", "hp": 80, "atk": 16, "agility": 2, "special": "explode", "death_blast": 8, "splits_into": "golemite", "split_count": 2, "taunts": ["Grrr!", "Crush!"]},
     "bowler": {"name": "Bowler", "hp": 22, "atk": 6, "agility": 4, "special": "knockback", "range": 3, "taunts": ["Strike!", "Rock and roll!"]},
     "lumberjack": {"name": "Lumberjack", "hp": 38, "atk": 12, "agility": 8, "special": "rage", "taunts": ["Raaagh!", "Chop chop!"]},
     "archer_queen": {"name": "Archer Queen", "hp": 40, "atk": 9, "agility": 9, "special": "invis", "range": 4, "taunts": ["Silent shot!", "Can’t see me!"]},
     "mega_knight": {"name": "Mega Knight", "hp": 70, "atk": 17, "agility": 5, "special": "slam", "taunts": ["Mega slam!", "Boom!"]},
     "royal_ghost": {"name": "Royal Ghost", "hp": 25, "atk": 8, "agility": 8, "special": "phase", "taunts": ["Boo!", "Invisible strike!"]},
+    # summoned / split-off units (never rolled as encounters)
+    "skeleton": {"name": "Skeleton", "hp": 6, "atk": 3, "agility": 6, "special": None, "taunts": ["Clack!", "Rattle rattle!"]},
+    "golemite": {"name": "Golemite", "hp": 20, "atk": 6, "agility": 3, "special": "explode", "death_blast": 4, "taunts": ["Grr!", "Rumble!"]},
     "adult_dragon": {"name": "Adult Dragon", "hp": 200, "atk": 11, "agility": 6, "special": "fire", "range": 3, "taunts": ["Roooar!", "Flames rise."]},
 }
 
 # -------------------- Globals --------------------
 GRID_ROWS = 7
 GRID_COLS = 11
+PLAYER_START = (GRID_ROWS // 2, 1)
 
 # -------------------- Utilities --------------------
 def roll(sides=20):
@@ -297,6 +392,426 @@ def clamp_pos(r, c):
 def manhattan(a, b):
     return abs(a[0]-b[0]) + abs(a[1]-b[1])
 
+# terminal cells a character occupies: wide/fullwidth (CJK, most emoji) take two, combining marks and
+# joiners/variation selectors none, everything else one
+ZERO_WIDTH = {"\u200b", "\u200c", "\u200d", "\ufe0e", "\ufe0f"}
+
+@lru_cache(maxsize=4096)
+def char_width(ch):
+    if ch in ZERO_WIDTH or unicodedata.combining(ch):
+        return 0
+    return 2 if unicodedata.east_asian_width(ch) in ("W", "F") else 1
+
+def display_width(text):
+    if text.isascii():
+        return len(text)
+    return sum(char_width(ch) for ch in text)
+
+def crop_to_width(text, width):
+    """Longest prefix of text that fits in `width` terminal cells (never splits a wide char)."""
+    if text.isascii():
+        return text[:max(0, width)]
+    used = 0
+    for i, ch in enumerate(text):
+        w = char_width(ch)
+        if used + w > width:
+            return text[:i]
+        used += w
+    return text
+
+# -------------------- Terrain --------------------
+# tile char -> movement cost to ENTER the tile (None = impassable)
+TERRAIN_TILES = {
+    ".": {"name": "floor", "cost": 1, "draw": " . "},
+    "#": {"name": "wall", "cost": None, "draw": "###"},
+    "~": {"name": "sand", "cost": 2, "draw": " ~ "},
+    "^": {"name": "spikes", "cost": 4, "draw": " ^ ", "damage": 3},
+}
+TERRAIN_COLORS = {"^": 7, "~": 8}  # curses color pair per tile
+EMPTY_LAYOUT = ["." * GRID_COLS for _ in range(GRID_ROWS)]
+
+class Terrain:
+    """Parsed arena layout: tile chars plus a per-cell movement cost grid."""
+
+    def __init__(self, key, layout):
+        self.key = key
+        self.tiles = tuple(layout)
+        self.rows = len(self.tiles)
+        self.cols = len(self.tiles[0]) if self.tiles else 0
+        self.cost = tuple(
+            tuple(TERRAIN_TILES.get(ch, TERRAIN_TILES["."])["cost"] for ch in row)
+            for row in self.tiles
+        )
+        # passable 4-neighbours of every cell, worked out once since a layout never changes
+        self.adjacent = {
+            (r, c): tuple(n for n in ((r-1, c), (r+1, c), (r, c-1), (r, c+1)) if self.passable(n))
+            for r in range(self.rows) for c in range(self.cols)
+        }
+
+    def in_bounds(self, pos):
+        return 0 <= pos[0] < self.rows and 0 <= pos[1] < self.cols
+
+    def tile(self, pos):
+        return self.tiles[pos[0]][pos[1]]
+
+    def passable(self, pos):
+        return self.in_bounds(pos) and self.cost[pos[0]][pos[1]] is not None
+
+    def step_cost(self, pos):
+        return self.cost[pos[0]][pos[1]]
+
+    def damage(self, pos):
+        return TERRAIN_TILES.get(self.tile(pos), {}).get("damage", 0)
+
+    def neighbors(self, pos):
+        return self.adjacent.get(pos, ())
+
+_TERRAIN_CACHE = {}
+
+def get_terrain(area):
+    """Return the (cached) Terrain for an area dict; arenas without a layout get an empty floor."""
+    key = area.get("id", area.get("name")) if isinstance(area, dict) else str(area)
+    terrain = _TERRAIN_CACHE.get(key)
+    if terrain is None:
+        layout = area.get("terrain") if isinstance(area, dict) else None
+        terrain = Terrain(key, layout or EMPTY_LAYOUT)
+        _TERRAIN_CACHE[key] = terrain
+    return terrain
+
+DEFAULT_TERRAIN = Terrain("empty", EMPTY_LAYOUT)
+
+@lru_cache(maxsize=1024)
+def terrain_distance_field(terrain, goal):
+    """
+    Exact terrain-only cost from every cell to goal (reverse Dijkstra), cached per (layout, goal).
+    Units only ever add obstacles, so this is an admissible and consistent A* heuristic.
+    """
+    dist = {goal: 0}
+    heap = [(0, goal)]
+    while heap:
+        d, cur = heapq.heappop(heap)
+        if d > dist[cur]:
+            continue
+        enter_cost = terrain.step_cost(cur)
+        for prev in terrain.neighbors(cur):
+            nd = d + enter_cost
+            if nd < dist.get(prev, float("inf")):
+                dist[prev] = nd
+                heapq.heappush(heap, (nd, prev))
+    return dist
+
+def enter_tile(terrain, pos):
+    """Damage dealt to a unit stepping onto pos (spikes), 0 otherwise."""
+    if terrain is None or not terrain.in_bounds(pos):
+        return 0
+    return terrain.damage(pos)
+
+# -------------------- Story flags --------------------
+# Story state is a bitset. Bit positions are part of the saved format, so only ever append here.
+STORY_FLAGS = ("has_crown_key", "has_map", "dragon_scale", "befriended_dragon", "slain_dragon", "true_ruler",
+               "liberator")
+STORY_FLAG_ALIASES = {"befriended_adult_dragon": "befriended_dragon", "slain_adult_dragon": "slain_dragon"}
+# carrying one of these items counts as having its flag
+ITEM_FLAGS = {"crown_key": "has_crown_key", "treasure_map": "has_map", "dragon_scale": "dragon_scale"}
+FLAG_BITS = {name: 1 << i for i, name in enumerate(STORY_FLAGS)}
+FLAG_BITS.update({alias: FLAG_BITS[name] for alias, name in STORY_FLAG_ALIASES.items()})
+STORY_BYTES = (len(STORY_FLAGS) + 7) // 8
+
+def flag_mask(*names):
+    """Bits for these flags (aliases allowed); an unknown name is a KeyError, so typos fail at import."""
+    mask = 0
+    for name in names:
+        mask |= FLAG_BITS[name]
+    return mask
+
+class StoryFlags:
+    """Set-like view over the story bitset: add/discard/`in` take flag names or their aliases."""
+
+    __slots__ = ("bits",)
+
+    def __init__(self, bits=0):
+        self.bits = bits
+
+    def add(self, name):
+        self.bits |= FLAG_BITS[name]
+
+    def discard(self, name):
+        self.bits &= ~FLAG_BITS[name]
+
+    def __contains__(self, name):
+        return bool(self.bits & FLAG_BITS[name])
+
+    def __iter__(self):
+        return (name for name in STORY_FLAGS if self.bits & FLAG_BITS[name])
+
+    def __len__(self):
+        return bin(self.bits).count("1")
+
+    def to_bytes(self):
+        return self.bits.to_bytes(STORY_BYTES, "little")
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(int.from_bytes(data, "little"))
+
+class Inventory(list):
+    """
+    The player's item list, counting the ITEM_FLAGS items as they come and go so `bits` (the flags
+    carried items grant) never needs a scan. Change it through append/extend/insert/pop/remove.
+    """
+
+    def __init__(self, items=()):
+        super().__init__()
+        self.held = dict.fromkeys(ITEM_FLAGS, 0)
+        self.bits = 0
+        self.extend(items)
+
+    def _count(self, key, n):
+        if key in self.held:
+            self.held[key] += n
+            bit = FLAG_BITS[ITEM_FLAGS[key]]
+            self.bits = self.bits | bit if self.held[key] else self.bits & ~bit
+
+    def append(self, key):
+        super().append(key)
+        self._count(key, 1)
+
+    def extend(self, keys):
+        for key in keys:
+            self.append(key)
+
+    def __iadd__(self, keys):
+        self.extend(keys)
+        return self
+
+    def insert(self, i, key):
+        super().insert(i, key)
+        self._count(key, 1)
+
+    def pop(self, i=-1):
+        key = super().pop(i)
+        self._count(key, -1)
+        return key
+
+    def remove(self, key):
+        super().remove(key)
+        self._count(key, -1)
+
+    def clear(self):
+        super().clear()
+        self.held = dict.fromkeys(ITEM_FLAGS, 0)
+        self.bits = 0
+
+    def __reduce__(self):
+        return Inventory, (list(self),)
+
+# Endings in priority order: (name, flags it needs, extra test on the player or None). The first match wins.
+ENDING_RULES = [
+    ("Fallen Champion", (), lambda p: p.hp <= 0),
+    ("True Ruler", ("true_ruler",), None),
+    ("Liberator", ("liberator",), None),
+    ("Elder Dragon Ally", ("befriended_dragon",), None),
+    ("Hoard King", ("slain_dragon",), lambda p: p.gold > 60),
+    ("Dragonslayer", ("slain_dragon",), None),
+    ("Arena Legend", (), lambda p: p.exp > 80 or p.level >= 6),
+    ("Wandering Champion", (), None),
+]
+
+ENDING_TABLE = [(name, flag_mask(*flags), test) for name, flags, test in ENDING_RULES]
+
+def resolve_ending(player):
+    """The ending this run has earned, from ENDING_RULES."""
+    bits = player.flag_bits()
+    for name, mask, test in ENDING_TABLE:
+        if bits & mask == mask and (test is None or test(player)):
+            return name
+
+# -------------------- Zone graph --------------------
+# Campaign map: zone id -> exits in priority order. Pressing 'n' takes the first exit whose
+# unlock flags are all held; a zone with no exits ends the run through its own finale.
+START_ZONE = "goblin_forest"
+ZONE_EDGES = {
+    "goblin_forest": ["royal_arena"],
+    "royal_arena": ["dark_valley"],
+    "dark_valley": ["desert_arena"],
+    "desert_arena": ["hidden_throne", "dragons_peak"],
+    "dragons_peak": [],
+    "hidden_throne": [],
+}
+# zone id -> flags needed to enter it
+UNLOCK_RULES = {"hidden_throne": ("has_map", "has_crown_key")}
+# zones that host a set-piece fight instead of being walked into
+ZONE_FIGHTS = {"dragons_peak": "dragon_finale"}
+
+ZONES = {a["id"]: a for a in AREAS}
+UNLOCK_MASKS = {zone: flag_mask(*flags) for zone, flags in UNLOCK_RULES.items()}
+# zone id -> ((target, mask), ...); only flags some edge tests can change where a run may go
+ZONE_TABLE = {z: tuple((t, UNLOCK_MASKS.get(t, 0)) for t in exits) for z, exits in ZONE_EDGES.items()}
+ROUTE_MASK = flag_mask(*{f for flags in UNLOCK_RULES.values() for f in flags})
+
+def _zone_tiers():
+    """Zone id -> difficulty tier: 1 + fewest steps from the start, ignoring locks."""
+    tiers, frontier = {START_ZONE: 1}, deque([START_ZONE])
+    while frontier:
+        z = frontier.popleft()
+        for t in ZONE_EDGES[z]:
+            if t not in tiers:
+                tiers[t] = tiers[z] + 1
+                frontier.append(t)
+    return tiers
+
+ZONE_TIERS = _zone_tiers()
+
+@lru_cache(maxsize=None)
+def _next_zone(zone_id, bits):
+    for target, mask in ZONE_TABLE[zone_id]:
+        if bits & mask == mask:
+            return target
+    return None
+
+@lru_cache(maxsize=None)
+def _zone_plan(bits):
+    """(zones reachable from the start, locked exits leading out of them) for one flag state."""
+    seen, stack, sealed = {START_ZONE}, [START_ZONE], set()
+    while stack:
+        for target, mask in ZONE_TABLE[stack.pop()]:
+            if bits & mask != mask:
+                sealed.add(target)
+            elif target not in seen:
+                seen.add(target)
+                stack.append(target)
+    return frozenset(seen), tuple(sorted(sealed - seen))
+
+def next_zone(player, zone_id):
+    """Where 'n' leads from zone_id with the player's current flags, or None at a dead end."""
+    return _next_zone(zone_id, player.flag_bits() & ROUTE_MASK)
+
+def reachable_zones(player):
+    return _zone_plan(player.flag_bits() & ROUTE_MASK)[0]
+
+def unlockable_zones(player):
+    """Zones one unlock away: (zone id, names of the flags still missing)."""
+    bits = player.flag_bits()
+    return [(z, [f for f in UNLOCK_RULES[z] if not bits & flag_mask(f)])
+            for z in _zone_plan(bits & ROUTE_MASK)[1]]
+
+def zone_line(player):
+    """One status line for the stats screen; sealed zones stay unnamed."""
+    sealed = len(unlockable_zones(player))
+    return f"Zones open: {len(reachable_zones(player))}/{len(ZONE_EDGES)}" + (f"  Sealed paths: {sealed}" if sealed else "")
+
+# -------------------- Loot tables --------------------
+# Rarity tiers, commonest first, and the draw weight an item of each tier gets in a table.
+RARITIES = ("common", "uncommon", "rare", "epic", "legendary")
+RARITY_WEIGHTS = {"common": 60, "uncommon": 25, "rare": 10, "epic": 4, "legendary": 1}
+ITEM_RARITY = {
+    "elixir_bottle": "common", "small_potion": "common", "leather_armor": "common",
+    "elixir_flask": "uncommon", "iron_sword": "uncommon", "large_potion": "uncommon", "royal_sword": "uncommon",
+    "magic_tome": "rare", "steel_armor": "rare", "crown_key": "rare", "treasure_map": "rare",
+    "royal_blade": "epic",
+    "dragon_scale": "legendary",
+}
+PITY_RARITY = "rare"  # a dry streak ends with an item at least this rare
+PITY_LIMIT = 6        # draws in a row below PITY_RARITY before the next one is forced up
+# foes with drops of their own, rolled on top of the arena's table:
+# enemy key -> {"chance": odds of a draw, "items": ids or {id: weight}, "always": guaranteed ids}
+ENEMY_LOOT = {
+    "witch": {"chance": 0.3, "items": ["elixir_flask", "magic_tome"]},
+    "prince": {"chance": 0.25, "items": ["iron_sword", "royal_sword"]},
+    "archer_queen": {"chance": 0.3, "items": ["elixir_flask", "treasure_map"]},
+    "golem": {"chance": 0.35, "items": ["steel_armor", "large_potion"]},
+    "pekka": {"chance": 0.4, "items": ["steel_armor", "royal_blade"], "always": ["large_potion"]},
+    "mega_knight": {"chance": 0.4, "items": ["steel_armor", "royal_blade"], "always": ["large_potion"]},
+}
+
+RARITY_RANK = {r: i for i, r in enumerate(RARITIES)}
+
+def item_rarity(key):
+    return ITEM_RARITY.get(key, "common")
+
+class AliasTable:
+    """Weighted picks in O(1) per draw (Vose's alias method), after an O(n) build."""
+    __slots__ = ("keys", "prob", "alias")
+
+    def __init__(self, weights):
+        self.keys = list(weights)
+        n = len(self.keys)
+        total = sum(weights.values())
+        scaled = [weights[k] * n / total for k in self.keys]
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+        small = [i for i, w in enumerate(scaled) if w < 1.0]
+        large = [i for i, w in enumerate(scaled) if w >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s], self.alias[s] = scaled[s], l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+        # whatever is left over is 1.0 up to rounding, and keeps prob 1
+
+    def sample(self, rng=random):
+        u = rng.random() * len(self.keys)
+        i = int(u)
+        return self.keys[i] if u - i < self.prob[i] else self.keys[self.alias[i]]
+
+class LootTable:
+    """
+    One drop table: `items` is a list of item ids (weighted by rarity; repeats add up) or an {id: weight}
+    dict, `always` the guaranteed drops. Pity is counted per table name in a dict the caller owns.
+    """
+    def __init__(self, name, items, always=()):
+        if isinstance(items, dict):
+            weights = dict(items)
+        else:
+            weights = {}
+            for key in items:
+                weights[key] = weights.get(key, 0) + RARITY_WEIGHTS[item_rarity(key)]
+        self.name = name
+        self.always = tuple(always)
+        self.table = AliasTable(weights) if weights else None
+        rare = {k: w for k, w in weights.items() if RARITY_RANK[item_rarity(k)] >= RARITY_RANK[PITY_RARITY]}
+        # pity only means something when the table also holds commoner items
+        self.pity = AliasTable(rare) if rare and len(rare) < len(weights) else None
+
+    def roll(self, counters, rng=random):
+        """Draw one item id (None from an empty table), forcing a rare one after PITY_LIMIT dry draws."""
+        if self.table is None:
+            return None
+        if self.pity is None:
+            return self.table.sample(rng)
+        dry = counters.get(self.name, 0)
+        item = (self.pity if dry >= PITY_LIMIT else self.table).sample(rng)
+        counters[self.name] = 0 if RARITY_RANK[item_rarity(item)] >= RARITY_RANK[PITY_RARITY] else dry + 1
+        return item
+
+# built once at load; procedural arenas add theirs the first time they pay out
+AREA_LOOT = {a["id"]: LootTable(a["id"], a["loot"], a.get("loot_always", ())) for a in AREAS}
+ENEMY_LOOT_TABLES = {key: (spec["chance"], LootTable(key, spec["items"], spec.get("always", ())))
+                     for key, spec in ENEMY_LOOT.items()}
+
+def area_loot(area):
+    table = AREA_LOOT.get(area["id"])
+    if table is None:
+        table = AREA_LOOT[area["id"]] = LootTable(area["id"], area["loot"], area.get("loot_always", ()))
+    return table
+
+def roll_loot(player, area, fallen=()):
+    """Item ids won by clearing `area`: one draw from its table plus the drops of each fallen foe."""
+    table = area_loot(area)
+    found = list(table.always)
+    item = table.roll(player.loot_pity)
+    if item is not None:
+        found.append(item)
+    for foe in fallen:
+        entry = ENEMY_LOOT_TABLES.get(foe.get("key"))
+        if entry is None or foe.get("summoned"):
+            continue
+        chance, table = entry
+        found.extend(table.always)
+        if random.random() < chance:
+            found.append(table.roll(player.loot_pity))
+    return found
+
 # -------------------- Player --------------------
 class Player:
     def __init__(self, name, pclass):
@@ -311,12 +826,29 @@ class Player:
         self.hp = self.max_hp
         self.level = 1
         self.exp = 0
-        self.inventory = []
+        self.inventory = Inventory()
         self.equipment = {}
         self.gold = 0
         self.mana = self.magic * 2
-        self.story_flags = set()
+        self.story_flags = StoryFlags()
         self.passive = base["passive"]
+        self.effects = {}  # status effect -> expiry turn (see EffectScheduler)
+        self.director = EncounterDirector()
+        self.companion = False  # hired party member rather than the player's own hero
+        self.companions = []    # the leader's hired heroes (see PARTY_MAX)
+        self.threat = 0
+        self.downed = False
+        self.run_id = None      # this run's id in the statistics database, while one is being recorded
+        self.shops = {}         # arena name -> Shop, so stock and prices carry over between visits
+        self.loot_pity = {}     # loot table name -> draws in a row below PITY_RARITY
+        self.facing = (0, 1)    # last step taken (row, col); aims line and cone spells
+
+    def flag_bits(self):
+        """Story flags set during the run plus those granted by items being carried."""
+        return self.story_flags.bits | self.inventory.bits
+
+    def has_flag(self, name):
+        return bool(self.flag_bits() & FLAG_BITS[name])
 
     def add_item(self, item_id):
         self.inventory.append(item_id)
@@ -413,6 +945,738 @@ class Player:
             return True, "Dragon Scale resonates with you."
         return False, "Nothing happened."
 
+# -------------------- Status effects --------------------
+# Timed buffs/debuffs. Durations count turn starts: an effect applied on turn t
+# is gone when turn t + duration begins.
+STATUS_EFFECTS = {
+    "phased": {"label": "Phased"},          # evades the next hit, then drops
+    "invisible": {"label": "Invisible"},    # evades every hit while it lasts
+    "enraged": {"label": "Enraged"},        # +50% damage
+    "swarm_rage": {"label": "Swarming"},    # +3 damage
+    "charging": {"label": "Charging"},      # next hit deals double, then drops
+    "stunned": {"label": "Stunned"},        # loses its turn
+    "rooted": {"label": "Rooted"},          # can't move
+    "burning": {"label": "Burning", "tick": 2},  # damage at the start of each turn
+    "guarding": {"label": "Guarding"},      # halves incoming damage
+}
+
+def is_player(unit):
+    return isinstance(unit, Player)
+
+def unit_name(unit):
+    if is_player(unit):
+        return unit.name if unit.companion else "You"
+    return unit["name"]
+
+def unit_ref(unit):
+    """unit_name() for use mid-sentence ("hits you" / "hits Aria")."""
+    name = unit_name(unit)
+    return "you" if name == "You" else name
+
+def unit_effects(unit):
+    if is_player(unit):
+        return unit.effects
+    return unit.setdefault("effects", {})
+
+def unit_hp(unit):
+    return unit.hp if is_player(unit) else unit["hp"]
+
+def damage_unit(unit, amount):
+    if is_player(unit):
+        unit.hp -= amount
+        return unit.hp
+    unit["hp"] -= amount
+    return unit["hp"]
+
+def describe_effects(unit, turn):
+    effects = unit_effects(unit)
+    return ", ".join(f"{STATUS_EFFECTS[name]['label']}({max(0, until - turn)})" for name, until in effects.items())
+
+class EffectScheduler:
+    """
+    Keeps every unit's effects as {name: expiry turn} and a single heap of (turn, seq, kind, name, unit)
+    events. process() pops only what is due, so quiet turns cost nothing regardless of unit count.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.seq = 0  # tie-breaker so units are never compared
+
+    def _push(self, turn, kind, name, unit):
+        heapq.heappush(self.heap, (turn, self.seq, kind, name, unit))
+        self.seq += 1
+
+    def apply(self, unit, name, duration, turn):
+        effects = unit_effects(unit)
+        until = turn + duration
+        was_active = name in effects
+        if effects.get(name, -1) >= until:
+            return
+        effects[name] = until
+        self._push(until, "expire", name, unit)
+        if STATUS_EFFECTS[name].get("tick") and not was_active:
+            self._push(turn + 1, "tick", name, unit)
+
+    def has(self, unit, name):
+        return name in unit_effects(unit)
+
+    def consume(self, unit, name):
+        """Remove an effect early (its heap entry goes stale and is skipped). Returns whether it was active."""
+        return unit_effects(unit).pop(name, None) is not None
+
+    def process(self, turn, messages):
+        while self.heap and self.heap[0][0] <= turn:
+            due, _, kind, name, unit = heapq.heappop(self.heap)
+            effects = unit_effects(unit)
+            until = effects.get(name)
+            if until is None:
+                continue  # consumed or already expired
+            alive = unit_hp(unit) > 0
+            if kind == "expire":
+                if until == due:  # otherwise it was refreshed and a later entry owns it
+                    del effects[name]
+                    if alive:
+                        owner = "Your" if unit_name(unit) == "You" else f"{unit_name(unit)}'s"
+                        messages.append(f"{owner} {STATUS_EFFECTS[name]['label']} wears off.")
+            elif kind == "tick" and until > due and alive:
+                dmg = STATUS_EFFECTS[name]["tick"]
+                left = damage_unit(unit, dmg)
+                who = unit_name(unit)
+                messages.append(LogEntry("{} {} {} {} damage.", (who, "take" if who == "You" else "takes", dmg, name)))
+                if not is_player(unit) and left <= 0:
+                    messages.append(f"{unit['name']} falls!")
+                elif due + 1 < until:
+                    self._push(due + 1, "tick", name, unit)
+
+# -------------------- Combat log --------------------
+LOG_CAPACITY = 512  # combat log lines kept for scrollback; older ones are overwritten
+COMBAT_LOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "combat_log.txt")
+
+class LogEntry(namedtuple("LogEntry", "fmt args")):
+    """A log line kept as a str.format template plus arguments; the text is only built when shown or exported."""
+    __slots__ = ()
+
+    def __str__(self):
+        return self.fmt.format(*self.args)
+
+class CombatLog:
+    """
+    Fixed-capacity ring buffer of log entries (plain strings or LogEntry). append() writes one slot and
+    never grows or slices a list; once full, each new entry overwrites the oldest. Entries are numbered
+    by `total` (how many were ever appended), so readers and rewinds can address them stably.
+    """
+
+    def __init__(self, capacity=LOG_CAPACITY):
+        self.buf = [None] * capacity
+        self.capacity = capacity
+        self.total = 0
+        self.floor = 0  # entries numbered below this are gone (see truncate)
+
+    def append(self, entry):
+        self.buf[self.total % self.capacity] = entry
+        self.total += 1
+
+    def first(self):
+        """Number of the oldest entry still held."""
+        return max(self.floor, self.total - self.capacity)
+
+    def __len__(self):
+        return self.total - self.first()
+
+    def lines(self, start, stop):
+        """Text of entries numbered start..stop-1 (clipped to what's held), formatted now."""
+        buf, cap = self.buf, self.capacity
+        return [str(buf[i % cap]) for i in range(max(start, self.first()), min(stop, self.total))]
+
+    def tail(self, n, back=0):
+        """The n lines ending `back` entries before the newest."""
+        stop = self.total - back
+        return self.lines(stop - n, stop)
+
+    def truncate(self, total):
+        """Forget everything appended after entry number `total` (a rewind)."""
+        self.floor = min(total, self.first())
+        self.total = total
+
+    def export(self, path=COMBAT_LOG_PATH):
+        with open(path, "w", encoding="utf-8") as f:
+            f.writelines(line + "\n" for line in self.lines(0, self.total))
+        return path
+
+# -------------------- Layout --------------------
+Rect = namedtuple("Rect", "y x h w")
+GRID_TOP, GRID_LEFT = 2, 2
+GRID_WIDTH = GRID_COLS * 3
+HUD_X = 45            # preferred column for the side panels when the terminal is wide enough
+HUD_MIN_WIDTH = 36
+HUD_LINES = 12        # status + inventory + party
+LOG_LINES = 6
+PROMPT_LINES = 12     # turn banner, move/action prompts, rolls, target list
+
+@lru_cache(maxsize=16)
+def compute_layout(height, width):
+    """
+    Panel rects (grid, hud, enemies, initiative, prompt, log) for a terminal size. Wide terminals put the
+    HUD and enemy roster beside the grid; narrow ones stack everything under it. Panels that don't fit get
+    zero height rather than spilling into their neighbours.
+    """
+    def rect(y, x, h, w):
+        return Rect(y, x, max(0, min(h, height - y)), max(0, min(w, width - x - 1)))
+
+    y = GRID_TOP + GRID_ROWS + 1
+    # short terminals trade log lines for prompt space
+    log_h = max(0, min(LOG_LINES if height >= 32 else 3, height - y - 2))
+    log_y = height - 1 - log_h
+    rects = {"grid": rect(GRID_TOP, GRID_LEFT, GRID_ROWS, GRID_WIDTH), "log": rect(log_y, 2, log_h, width - 4)}
+    side_x = HUD_X if width - HUD_X >= HUD_MIN_WIDTH else GRID_LEFT + GRID_WIDTH + 3
+    if width - side_x >= HUD_MIN_WIDTH:
+        # wide: HUD and enemy roster beside the grid, prompts underneath it
+        rects["hud"] = rect(1, side_x, min(HUD_LINES, log_y - 1), width - side_x)
+        rects["enemies"] = rect(1 + HUD_LINES, side_x, min(MAX_ENEMY_SLOTS + 1, log_y - 1 - HUD_LINES), width - side_x)
+        left_w = side_x - GRID_LEFT - 2
+        rects["initiative"] = rect(y, GRID_LEFT, min(1, log_y - y), left_w)
+        rects["prompt"] = rect(y + 1, GRID_LEFT, min(PROMPT_LINES, log_y - y - 1), left_w)
+    else:
+        # narrow: initiative, prompt, HUD and roster stacked under the grid; each panel first gets a
+        # usable minimum, then any spare rows, in that order
+        rects["initiative"] = rect(y, GRID_LEFT, min(1, log_y - y), width - 4)
+        y += 1
+        panels = (("prompt", 6, PROMPT_LINES), ("hud", 7, HUD_LINES), ("enemies", 3, MAX_ENEMY_SLOTS + 1))
+        spare = max(0, log_y - y)
+        sizes = {}
+        for name, least, _ in panels:
+            sizes[name] = min(least, spare)
+            spare -= sizes[name]
+        for name, _, most in panels:
+            extra = min(most - sizes[name], spare)
+            sizes[name] += extra
+            spare -= extra
+        for name, _, _ in panels:
+            rects[name] = rect(y, GRID_LEFT, sizes[name], width - 4)
+            y += sizes[name]
+    return rects
+
+@lru_cache(maxsize=64)
+def render_art(art, width, max_rows):
+    """
+    Crop and centre an art block for a terminal width, measuring in display cells rather than
+    code points. Cached per (art, width, rows), so re-showing a zone is just the blit.
+    Returns (x, lines).
+    """
+    room = max(0, width - 3)
+    lines = tuple(crop_to_width(ln.rstrip(), room) for ln in art[:max_rows])
+    block = max((display_width(ln) for ln in lines), default=0)
+    return max(0, (width - block) // 2), lines
+
+class Pane:
+    """
+    One panel of the layout: a clipped, offset view onto the screen (a light stand-in for a curses
+    sub-window), so nothing drawn into it can land in a neighbouring panel or off the terminal.
+    """
+
+    def __init__(self, ui, rect):
+        self.ui = ui
+        self.rect = rect
+
+    def addstr(self, y, x, text, attr=0):
+        r = self.rect
+        if 0 <= y < r.h and 0 <= x < r.w:
+            self.ui.put(r.y + y, r.x + x, crop_to_width(text, r.w - x), attr)
+
+    def clear(self):
+        for y in range(self.rect.h):
+            self.ui.put(self.rect.y + y, self.rect.x, " " * self.rect.w)
+
+# -------------------- Renderers --------------------
+# curses attribute bits (A_BOLD, A_REVERSE, ...) are plain ints and double as the attribute format for
+# every backend; only the colour-pair packing needs working out, since color_pair() wants a
+# live screen
+_PAIR_SHIFT = (curses.A_COLOR & -curses.A_COLOR).bit_length() - 1
+
+def color_pair(n):
+    return n << _PAIR_SHIFT
+
+def pair_number(attr):
+    return (attr & curses.A_COLOR) >> _PAIR_SHIFT
+
+COLOR_PAIRS = {  # pair -> (foreground, background); -1 is the terminal default
+    1: (curses.COLOR_WHITE, curses.COLOR_BLUE),    # player tile
+    2: (curses.COLOR_WHITE, curses.COLOR_RED),     # enemy tile
+    3: (curses.COLOR_BLACK, curses.COLOR_WHITE),   # HUD
+    4: (curses.COLOR_YELLOW, -1),                  # highlight
+    5: (curses.COLOR_GREEN, -1),                   # success
+    6: (curses.COLOR_MAGENTA, -1),                 # info
+    7: (curses.COLOR_RED, -1),                     # spikes
+    8: (curses.COLOR_YELLOW, -1),                  # sand
+}
+
+def key_code(key):
+    """getch-style code for a getkey-style key name ("a" -> 97, "KEY_UP" -> curses.KEY_UP)."""
+    return ord(key) if len(key) == 1 else getattr(curses, key, -1)
+
+class ScreenBuffer:
+    """
+    Off-screen grid of cells and attributes with per-row dirty spans; diff() returns the runs that
+    changed since the previous diff. A wide character fills its cell and leaves "" in the one to its
+    right, as it would on a terminal. Backs the ANSI renderer and the session recorder.
+    """
+
+    def __init__(self, height=0, width=0):
+        self.resize(height, width)
+
+    def resize(self, height, width):
+        self.height, self.width = height, width
+        self.cells = [[" "] * width for _ in range(height)]
+        self.attrs = [[0] * width for _ in range(height)]
+        self.shown = [(row[:], attrs[:]) for row, attrs in zip(self.cells, self.attrs)]
+        self.dirty = {}
+
+    def _touch(self, y, lo, hi):
+        old = self.dirty.get(y)
+        self.dirty[y] = (min(lo, old[0]), max(hi, old[1])) if old else (lo, hi)
+
+    def put(self, y, x, text, attr=0):
+        if not (0 <= y < self.height and 0 <= x < self.width):
+            return
+        row = self.cells[y]
+        lo = x
+        if row[x] == "":
+            row[x - 1] = " "  # splitting a wide character blanks its left half, as a terminal would
+            lo = x - 1
+        if text.isascii():
+            text = text[:self.width - x]
+            row[x:x + len(text)] = text
+            c = x + len(text)
+        else:
+            c = self._put_wide(row, x, text)
+        self.attrs[y][x:c] = [attr] * (c - x)
+        if c < self.width and row[c] == "":
+            row[c] = " "
+            c += 1
+        self._touch(y, lo, c)
+
+    def _put_wide(self, row, x, text):
+        c = x
+        for ch in text:
+            w = char_width(ch)
+            if w == 0:
+                if c > x:
+                    row[c - 1] += ch  # combining mark rides on the previous cell
+                continue
+            if c + w > self.width:
+                break
+            row[c] = ch
+            if w == 2:
+                row[c + 1] = ""  # right half of a wide character
+            c += w
+        return c
+
+    def erase(self):
+        self.cells = [[" "] * self.width for _ in range(self.height)]
+        self.attrs = [[0] * self.width for _ in range(self.height)]
+        for y in range(self.height):
+            self._touch(y, 0, self.width)
+
+    def diff(self):
+        """[(y, start, end)] for each row that changed since the last call, which become the shown state."""
+        spans = []
+        for y, (lo, hi) in sorted(self.dirty.items()):
+            cur, attrs = self.cells[y], self.attrs[y]
+            old, old_attrs = self.shown[y]
+            changed = [c for c in range(lo, min(hi, self.width)) if cur[c] != old[c] or attrs[c] != old_attrs[c]]
+            if not changed:
+                continue
+            a, b = changed[0], changed[-1] + 1
+            if cur[a] == "" and a > 0:
+                a -= 1  # start on the wide character, not its right half
+            old[a:b], old_attrs[a:b] = cur[a:b], attrs[a:b]
+            spans.append((y, a, b))
+        self.dirty.clear()
+        return spans
+
+    def text(self, y, a, b):
+        return "".join(self.cells[y][a:b])
+
+    def lines(self):
+        return ["".join(row).rstrip() for row in self.cells]
+
+class Renderer:
+    """
+    What the UI draws through. Backends provide size/write/erase/flush and getkey (curses-style key
+    names such as "a", "\\n" and "KEY_UP", with "KEY_RESIZE" when the terminal changes size).
+    `realtime` backends get the animation delays; the others run flat out.
+    """
+    realtime = True
+
+    def size(self):
+        raise NotImplementedError
+
+    def write(self, y, x, text, attr=0):
+        raise NotImplementedError
+
+    def erase(self):
+        raise NotImplementedError
+
+    def flush(self):
+        raise NotImplementedError
+
+    def getkey(self):
+        raise NotImplementedError
+
+    def getch(self):
+        return key_code(self.getkey())
+
+    def key_ready(self):
+        """True when a key is waiting, so getkey() won't block."""
+        return False
+
+    def flush_input(self):
+        """Throw away keys typed but not read yet."""
+
+    def getstr(self, y, x, n):
+        """Read a line of up to n characters, echoing it at (y, x)."""
+        s = ""
+        while True:
+            k = self.getkey()
+            if k in ("\n", "\r", "KEY_ENTER"):
+                return s
+            if k in ("KEY_BACKSPACE", "\x7f", "\b"):
+                s = s[:-1]
+            elif len(k) == 1 and k.isprintable() and len(s) < n:
+                s += k
+            self.write(y, x, s + " ")
+            self.flush()
+
+    def close(self):
+        pass
+
+class CursesRenderer(Renderer):
+    """The classic backend: a curses screen (as handed over by curses.wrapper)."""
+
+    def __init__(self, stdscr):
+        self.stdscr = stdscr
+        curses.curs_set(0)
+        curses.start_color()
+        curses.use_default_colors()
+        for pair, (fg, bg) in COLOR_PAIRS.items():
+            curses.init_pair(pair, fg, bg)
+        curses.set_escdelay(25)  # a lone Esc is a key here, not the start of an escape sequence
+
+    def size(self):
+        return self.stdscr.getmaxyx()
+
+    def write(self, y, x, text, attr=0):
+        try:
+            self.stdscr.addstr(y, x, text, attr)
+        except curses.error:
+            pass  # the bottom-right cell raises after writing; anything else was clipped already
+
+    def erase(self):
+        self.stdscr.erase()
+
+    def flush(self):
+        self.stdscr.refresh()
+
+    def getkey(self):
+        return self.stdscr.getkey()
+
+    def getch(self):
+        return self.stdscr.getch()
+
+    def key_ready(self):
+        self.stdscr.nodelay(True)
+        try:
+            ch = self.stdscr.getch()
+        finally:
+            self.stdscr.nodelay(False)
+        if ch == -1:
+            return False
+        curses.ungetch(ch)
+        return True
+
+    def flush_input(self):
+        curses.flushinp()
+
+    def getstr(self, y, x, n):
+        curses.echo()
+        try:
+            return self.stdscr.getstr(y, x, n).decode()
+        finally:
+            curses.noecho()
+
+ANSI_KEYS = {"\x1b[A": "KEY_UP", "\x1b[B": "KEY_DOWN", "\x1b[C": "KEY_RIGHT", "\x1b[D": "KEY_LEFT",
+             "\x1bOA": "KEY_UP", "\x1bOB": "KEY_DOWN", "\x1bOC": "KEY_RIGHT", "\x1bOD": "KEY_LEFT",
+             "\x7f": "KEY_BACKSPACE"}
+
+@lru_cache(maxsize=64)
+def ansi_style(attr):
+    """SGR escape for a curses attribute (bold, reverse, colour pair)."""
+    codes = ["0"]
+    if attr & curses.A_BOLD:
+        codes.append("1")
+    if attr & curses.A_REVERSE:
+        codes.append("7")
+    fg, bg = COLOR_PAIRS.get(pair_number(attr), (-1, -1))
+    if fg >= 0:
+        codes.append(str(30 + fg))
+    if bg >= 0:
+        codes.append(str(40 + bg))
+    return f"\x1b[{';'.join(codes)}m"
+
+class AnsiRenderer(Renderer):
+    """
+    Raw ANSI backend for terminals without curses: drawing goes into a ScreenBuffer and flush() sends
+    the cells that changed as one escape-sequence string, a single write per frame. Input comes from
+    the tty in cbreak mode (POSIX only).
+    """
+
+    def __init__(self, out=None, inp=None):
+        if termios is None:
+            raise RuntimeError("the ANSI renderer needs a POSIX terminal")
+        self.out = out or sys.stdout
+        self.fd = (inp or sys.stdin).fileno()
+        self.saved = termios.tcgetattr(self.fd)
+        tty.setcbreak(self.fd)
+        self.pending = deque()
+        self.resized = False
+        signal.signal(signal.SIGWINCH, self._on_winch)
+        self.screen = ScreenBuffer(*self.size())
+        # alternate screen, hidden cursor
+        self.out.write("\x1b[?1049h\x1b[?25l\x1b[2J")
+        self.out.flush()
+
+    def _on_winch(self, *_):
+        self.resized = True
+
+    def size(self):
+        cols, lines = shutil.get_terminal_size()
+        return lines, cols
+
+    def write(self, y, x, text, attr=0):
+        self.screen.put(y, x, text, attr)
+
+    def erase(self):
+        self.screen.erase()
+
+    def flush(self):
+        out, style = [], 0
+        for y, a, b in self.screen.diff():
+            out.append(f"\x1b[{y + 1};{a + 1}H")
+            cells, attrs = self.screen.cells[y], self.screen.attrs[y]
+            for c in range(a, b):
+                if attrs[c] != style:
+                    style = attrs[c]
+                    out.append(ansi_style(style))
+                out.append(cells[c])
+        if out:
+            out.append("\x1b[0m")
+            self.out.write("".join(out))
+            self.out.flush()
+
+    def getkey(self):
+        while not self.pending:
+            if self.resized:
+                self.resized = False
+                self.screen.resize(*self.size())
+                self.out.write("\x1b[2J")
+                return "KEY_RESIZE"
+            if not select.select([self.fd], [], [], 0.1)[0]:
+                continue
+            data = os.read(self.fd, 64).decode("utf-8", "replace")
+            while data:
+                seq = next((s for s in ANSI_KEYS if data.startswith(s)), None) or data[0]
+                self.pending.append(ANSI_KEYS.get(seq, seq))
+                data = data[len(seq):]
+        return self.pending.popleft()
+
+    def key_ready(self):
+        return bool(self.pending) or bool(select.select([self.fd], [], [], 0)[0])
+
+    def flush_input(self):
+        self.pending.clear()
+        termios.tcflush(self.fd, termios.TCIFLUSH)
+
+    def close(self):
+        termios.tcsetattr(self.fd, termios.TCSADRAIN, self.saved)
+        signal.signal(signal.SIGWINCH, signal.SIG_DFL)
+        self.out.write("\x1b[0m\x1b[?25h\x1b[?1049l")
+        self.out.flush()
+
+class NullRenderer(Renderer):
+    """
+    Draws nothing and skips every delay: for soak tests, simulations and headless servers. Keys come
+    from `keys`; running out of them raises EOFError, which ends the session.
+    """
+    realtime = False
+
+    def __init__(self, keys=(), height=40, width=120):
+        self.keys = iter(keys)
+        self.height, self.width = height, width
+
+    def size(self):
+        return self.height, self.width
+
+    def write(self, y, x, text, attr=0):
+        pass
+
+    def erase(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def getkey(self):
+        k = next(self.keys, None)
+        if k is None:
+            raise EOFError("out of scripted keys")
+        return k
+
+# -------------------- Session recording --------------------
+RECORDING_VERSION = 1
+REPLAY_MAX_GAP = 3.0  # seconds; long idle stretches are cut down to this during playback
+
+class SessionRecorder:
+    """
+    Records what the UI draws, as per-frame diffs, plus input with timestamps, so a session can be
+    replayed later without a terminal (--replay). UI writes are mirrored into a shadow ScreenBuffer as
+    they happen and each refresh emits only the cell runs that changed since the previous frame, so
+    recording costs a list splice per put rather than a screen snapshot per frame.
+    File: gzipped JSON lines, a header then events [kind, ms since the previous event, ...]:
+    "r" resize (h, w), "f" frame ([y, x, text], ...), "k" key, "s" typed string, "m" marker (kind, value).
+    """
+
+    def __init__(self, path, seed=None):
+        self.file = gzip.open(path, "wt", encoding="utf-8")
+        self.last = time.monotonic()
+        self.screen = ScreenBuffer()
+        self.file.write(json.dumps({"version": RECORDING_VERSION, "started": round(time.time()), "seed": seed}) + "\n")
+
+    def _event(self, *event):
+        now = time.monotonic()
+        self.file.write(json.dumps([event[0], round((now - self.last) * 1000), *event[1:]], ensure_ascii=False) + "\n")
+        self.last = now
+
+    def resize(self, height, width):
+        self.screen.resize(height, width)
+        self._event("r", height, width)
+
+    def put(self, y, x, text):
+        self.screen.put(y, x, text)
+
+    def erase(self):
+        self.screen.erase()
+
+    def frame(self):
+        ops = [[y, a, self.screen.text(y, a, b)] for y, a, b in self.screen.diff()]
+        if ops:
+            self._event("f", ops)
+
+    def key(self, key):
+        self._event("k", key)
+
+    def text(self, s):
+        self._event("s", s)
+
+    def mark(self, kind, value):
+        self._event("m", kind, value)
+
+    def close(self):
+        self.file.close()
+
+def read_recording(path):
+    """Header dict and an iterator over the events of a recorded session."""
+    f = gzip.open(path, "rt", encoding="utf-8")
+    header = json.loads(f.readline())
+    if header.get("version") != RECORDING_VERSION:
+        f.close()
+        raise ValueError(f"{path}: unsupported recording version {header.get('version')}")
+    return header, (json.loads(line) for line in f)
+
+def replay_session(path, speed=1.0, out=None):
+    """Play a recording to `out` (stdout) as ANSI text at `speed`x; speed 0 plays as fast as it can."""
+    out = out or sys.stdout
+    _, events = read_recording(path)
+    height = 0
+    for event in events:
+        if speed > 0:
+            time.sleep(min(event[1] / 1000, REPLAY_MAX_GAP) / speed)
+        if event[0] == "r":
+            height = event[2]
+            out.write("\x1b[2J\x1b[H")
+        elif event[0] == "f":
+            out.write("".join(f"\x1b[{y + 1};{x + 1}H{text}" for y, x, text in event[2]))
+            out.flush()
+    out.write(f"\x1b[{height + 1};1H\n")
+
+def dump_frames(path, turns=(), frames=(), out=None):
+    """
+    Print screens from a recording as plain text: for each combat turn in `turns`, what was on screen
+    when that turn first asked for input (in every fight), and the numbered frames in `frames`.
+    """
+    out = out or sys.stdout
+    header, events = read_recording(path)
+    screen = ScreenBuffer()
+    fight, area, frame_no, pending, seen = 0, "", 0, None, set()
+
+    def show(label):
+        out.write(f"--- {label} ---\n" + "\n".join(screen.lines()).rstrip() + "\n")
+
+    out.write(f"recording v{header['version']}, seed {header.get('seed')}\n")
+    for event in events:
+        kind = event[0]
+        if kind in ("k", "s") and pending:
+            show(pending)
+            pending = None
+        if kind == "r":
+            screen.resize(event[2], event[3])
+        elif kind == "f":
+            for y, x, text in event[2]:
+                screen.put(y, x, text)
+            frame_no += 1
+            if frame_no in frames:
+                show(f"frame {frame_no}")
+        elif kind == "m" and event[2] == "fight":
+            fight, area = fight + 1, event[3]
+        elif kind == "m" and event[2] == "turn" and event[3] in turns and (fight, event[3]) not in seen:
+            seen.add((fight, event[3]))
+            pending = f"fight {fight} ({area}), turn {event[3]}"
+    if pending:
+        show(pending)
+    return frame_no
+
+# -------------------- Key bindings --------------------
+# curses / ANSI key names -> the names KEY_BINDINGS uses; single letters are matched case-insensitively
+KEY_ALIASES = {"KEY_UP": "up", "KEY_DOWN": "down", "KEY_LEFT": "left", "KEY_RIGHT": "right",
+               "KEY_PPAGE": "pageup", "KEY_NPAGE": "pagedown", "\x1b": "esc", "\n": "enter", "\r": "enter",
+               "KEY_ENTER": "enter", " ": "space", "\t": "tab"}
+PICK_KEYS = {str(n): n for n in range(1, 10)}  # numbered lists: the command is the 1-based position
+STEP_KEYS = {"w": "up", "up": "up", "s": "down", "down": "down", "a": "left", "left": "left", "d": "right", "right": "right"}
+MOVE_STEPS = {"up": (-1, 0), "down": (1, 0), "left": (0, -1), "right": (0, 1)}
+# context -> key name -> command; a key missing from the current context is invalid there
+KEY_BINDINGS = {
+    "move": {**STEP_KEYS, "p": "stay", "l": "log", "u": "rewind", ":": "queue"},
+    "step": STEP_KEYS,
+    "act": {"1": "attack", "2": "defend", "3": "magic", "4": "item", "m": "move_again", "r": "run", "p": "pass"},
+    "zone": {"e": "explore", "w": "wilds", "r": "rest", "i": "inventory", "s": "stats", "h": "party", "n": "next",
+             "q": "quit", "p": "shop"},
+    "class": {"1": "Knight", "2": "Wizard", "3": "Bandit"},
+    "pick": PICK_KEYS,
+    "inventory": {**PICK_KEYS, "i": "inspect", "d": "discard"},
+    "confirm": {"y": "yes", "n": "no", "esc": "no"},
+    "choice": {"w": "up", "up": "up", "s": "down", "down": "down", "enter": "confirm", "space": "confirm"},
+    "shop": {"w": "up", "k": "up", "up": "up", "s": "down", "j": "down", "down": "down", "enter": "confirm",
+             "space": "confirm", "tab": "mode", "q": "leave", "esc": "leave"},
+    "log": {"w": "older", "up": "older", "s": "newer", "down": "newer", "a": "page_older", "pageup": "page_older",
+            "d": "page_newer", "pagedown": "page_newer", "x": "save"},
+}
+
+def key_name(key):
+    return KEY_ALIASES.get(key) or (key.lower() if len(key) == 1 else key)
+
+def bound(context, key):
+    """The command `key` runs in `context`, or None."""
+    return KEY_BINDINGS[context].get(key_name(key))
+
 # -------------------- Curses helper UI --------------------
 def show_throne_room_ending(ui, player):
     ui.clear()
@@ -437,12 +1701,12 @@ def show_throne_room_ending(ui, player):
 
     row = 2
     for line in lines:
-        ui.stdscr.addstr(row, 4, line)
-        ui.stdscr.refresh()
-        time.sleep(0.6)
+        ui.put(row, 4, line)
+        ui.refresh()
+        ui.pause(0.6)
         row += 1
 
-    ui.stdscr.getch()
+    ui.getch()
     ui.clear()
 
     # Final title card
@@ -461,13 +1725,12 @@ def show_throne_room_ending(ui, player):
 
     row = 3
     for line in title:
-        ui.stdscr.addstr(row, 4, line, curses.A_BOLD)
-        ui.stdscr.refresh()
-        time.sleep(0.5)
+        ui.put(row, 4, line, curses.A_BOLD)
+        ui.refresh()
+        ui.pause(0.5)
         row += 2
 
-    ui.stdscr.getch()
-    exit()
+    ui.getch()
 def show_spared_dragon_ending(ui, player):
     ui.clear()
     lines = [
@@ -499,12 +1762,12 @@ def show_spared_dragon_ending(ui, player):
 
     row = 2
     for line in lines:
-        ui.stdscr.addstr(row, 4, line)
-        ui.stdscr.refresh()
-        time.sleep(0.6)
+        ui.put(row, 4, line)
+        ui.refresh()
+        ui.pause(0.6)
         row += 1
 
-    ui.stdscr.getch()
+    ui.getch()
     ui.clear()
 
     # Closing scene
@@ -527,13 +1790,12 @@ def show_spared_dragon_ending(ui, player):
 
     row = 3
     for line in closing:
-        ui.stdscr.addstr(row, 4, line, curses.A_BOLD if "THE END" in line else 0)
-        ui.stdscr.refresh()
-        time.sleep(0.5)
+        ui.put(row, 4, line, curses.A_BOLD if "THE END" in line else 0)
+        ui.refresh()
+        ui.pause(0.5)
         row += 2
 
-    ui.stdscr.getch()
-    exit()
+    ui.getch()
 
 def show_ending_cutscene(ui, player):
     ui.clear()
@@ -559,12 +1821,12 @@ def show_ending_cutscene(ui, player):
 
     row = 2
     for line in lines:
-        ui.stdscr.addstr(row, 4, line)
-        ui.stdscr.refresh()
-        time.sleep(0.6)
+        ui.put(row, 4, line)
+        ui.refresh()
+        ui.pause(0.6)
         row += 1
 
-    ui.stdscr.getch()
+    ui.getch()
     ui.clear()
 
     # Final title card
@@ -577,59 +1839,148 @@ def show_ending_cutscene(ui, player):
 
     row = 5
     for line in title:
-        ui.stdscr.addstr(row, 6, line, curses.A_BOLD)
+        ui.put(row, 6, line, curses.A_BOLD)
         row += 2
-    ui.stdscr.refresh()
-    ui.stdscr.getch()
-    exit()
+    ui.refresh()
+    ui.getch()
 
 
 class UI:
-    def __init__(self, stdscr):
-        self.stdscr = stdscr
-        curses.curs_set(0)
-        curses.start_color()
-        curses.use_default_colors()
-        # color pairs (foreground, background)
-        curses.init_pair(1, curses.COLOR_WHITE, curses.COLOR_BLUE)   # player tile
-        curses.init_pair(2, curses.COLOR_WHITE, curses.COLOR_RED)    # enemy tile
-        curses.init_pair(3, curses.COLOR_BLACK, curses.COLOR_WHITE)  # HUD
-        curses.init_pair(4, curses.COLOR_YELLOW, -1)                 # highlight
-        curses.init_pair(5, curses.COLOR_GREEN, -1)                  # success
-        curses.init_pair(6, curses.COLOR_MAGENTA, -1)                # info
-        self.height, self.width = self.stdscr.getmaxyx()
+    def __init__(self, renderer, recorder=None):
+        self.renderer = renderer  # CursesRenderer, AnsiRenderer or NullRenderer
+        self.recorder = recorder  # SessionRecorder mirroring everything drawn, or None
+        self.on_resize = None  # screen-specific repaint, called after the layout is recomputed
+        self.typeahead = deque()  # keys queued from a ':' command line; getkey() hands these out first
+        self.resize()
+
+    # --- layout & input ---
+    def resize(self):
+        """Re-read the terminal size and switch to the (cached) layout for it."""
+        self.height, self.width = self.renderer.size()
+        self.layout = compute_layout(self.height, self.width)
+        if self.recorder:
+            self.recorder.resize(self.height, self.width)
+        self.panes = {}
+        self.clear()
+        if self.on_resize:
+            self.on_resize()
+        self.refresh()
+
+    def pane(self, name):
+        p = self.panes.get(name)
+        if p is None:
+            p = self.panes[name] = Pane(self, self.layout[name])
+        return p
+
+    def prompt_row(self, i):
+        return self.layout["prompt"].y + i
+
+    def getkey(self):
+        if self.typeahead:
+            return self.typeahead.popleft()  # already recorded as the line it came from
+        while True:
+            k = self.renderer.getkey()
+            if k != "KEY_RESIZE":
+                if self.recorder:
+                    self.recorder.key(k)
+                return k
+            self.resize()
+
+    def getch(self):
+        if self.typeahead:
+            return key_code(self.typeahead.popleft())
+        while True:
+            k = self.renderer.getch()
+            if k != curses.KEY_RESIZE:
+                if self.recorder:
+                    self.recorder.key(k)
+                return k
+            self.resize()
+
+    def command(self, context):
+        """
+        Read a key and look it up in KEY_BINDINGS[context]: returns (key, command), command None when the
+        key isn't bound there. An invalid key drops any typeahead, which was planned for a different state.
+        """
+        key = self.getkey()
+        cmd = bound(context, key)
+        if cmd is None:
+            self.flush_input()
+        return key, cmd
+
+    def key_ready(self):
+        return bool(self.typeahead) or self.renderer.key_ready()
+
+    def flush_input(self):
+        self.typeahead.clear()
+        self.renderer.flush_input()
+
+    def queue_line(self, y, x, n=40):
+        """Read a line of commands such as "d d 1" at (y, x) and queue its keys; spaces only separate them."""
+        self.typeahead.extend(k for k in self.getstr(y, x, n) if not k.isspace())
+
+    def put(self, y, x, text, attr=0):
+        """Write clipped to the screen; anything off-screen is dropped instead of raising."""
+        if not (0 <= y < self.height and 0 <= x < self.width):
+            return
+        text = crop_to_width(text, self.width - x - 1)
+        if self.recorder:
+            self.recorder.put(y, x, text)
+        self.renderer.write(y, x, text, attr)
+
+    def getstr(self, y, x, n):
+        """Read a line of up to n characters, echoed at (y, x)."""
+        s = self.renderer.getstr(y, x, n)
+        if self.recorder:
+            self.recorder.put(y, x, s)
+            self.recorder.text(s)
+        return s
+
+    def mark(self, kind, value):
+        """Note a point of interest (a fight starting, a new combat turn) in the recording."""
+        if self.recorder:
+            self.recorder.mark(kind, value)
+
+    def pause(self, seconds):
+        """Animation delay; skipped on backends that don't draw in real time."""
+        if self.renderer.realtime:
+            time.sleep(seconds)
+
+    def beat(self, seconds):
+        """The short pause that lets a keypress echo show, skipped while more keys are already waiting."""
+        if not self.key_ready():
+            self.pause(seconds)
 
     def clear(self):
-        self.stdscr.erase()
+        self.renderer.erase()
+        if self.recorder:
+            self.recorder.erase()
 
     def draw_text_block(self, lines, y_off=1, x_off=2):
         for i, line in enumerate(lines):
             if y_off + i < self.height - 1:
-                self.stdscr.addstr(y_off + i, x_off, line)
+                self.put(y_off + i, x_off, line)
 
     def draw_zone_art(self, art_lines, title, desc):
         self.clear()
-        mid_x = max(0, (self.width // 2) - 20)
-        self.stdscr.addstr(1, mid_x, title, curses.A_BOLD | curses.color_pair(6))
-        for i, ln in enumerate(art_lines):
-            if 3 + i < self.height - 2:
-                try:
-                    self.stdscr.addstr(3 + i, mid_x, ln[:self.width - mid_x - 2])
-                except curses.error:
-                    pass
-        # description box
-        self.stdscr.addstr(10, 2, desc)
-        self.stdscr.addstr(self.height - 2, 2, "Press any key to continue...")
-        self.stdscr.refresh()
-        self.stdscr.getch()
+        # art gets whatever rows are left after the title, description and footer
+        art_x, shown = render_art(tuple(art_lines), self.width, max(0, self.height - 8))
+        self.put(1, max(0, (self.width - display_width(title)) // 2), title, curses.A_BOLD | color_pair(6))
+        for i, ln in enumerate(shown):
+            self.put(3 + i, art_x, ln)
+        # description box, under the art
+        self.put(min(4 + len(shown), self.height - 4), 2, desc)
+        self.put(self.height - 2, 2, "Press any key to continue...")
+        self.refresh()
+        self.getch()
 
     def display_message_with_animation(self, message, y=None, x=2, delay=0.04):
         if y is None:
             y = self.height - 4
         for i in range(1, len(message)+1):
-            self.stdscr.addstr(y, x, message[:i])
-            self.stdscr.refresh()
-            time.sleep(delay)
+            self.put(y, x, message[:i])
+            self.refresh()
+            self.pause(delay)
 
     def rolling_animation(self, label="Rolling", y=None, x=2, rolls=6, max_val=20):
         if y is None:
@@ -648,14 +1999,14 @@ class UI:
                 shown_val = max(1, min(max_val, final_val - random.randint(1, 3)))
             else:
                 shown_val = final_val  # exact final value now visible
-            self.stdscr.addstr(y, x, f"{label} {dots} {shown_val:2d}   ")
-            self.stdscr.refresh()
-            time.sleep(0.18)
+            self.put(y, x, f"{label} {dots} {shown_val:2d}   ")
+            self.refresh()
+            self.pause(0.18)
 
         # make sure the very last draw stays visible as the final result
-        self.stdscr.addstr(y, x, f"{label}: {final_val:2d}   ")
-        self.stdscr.refresh()
-        time.sleep(0.4)
+        self.put(y, x, f"{label}: {final_val:2d}   ")
+        self.refresh()
+        self.pause(0.4)
 
         return final_val
 
@@ -665,95 +2016,230 @@ class UI:
         if y is None:
             y = self.height - 4
         for frame in frames:
-            self.stdscr.addstr(y, x, " " * (self.width - x - 2))
-            self.stdscr.addstr(y, x, frame)
-            self.stdscr.refresh()
-            time.sleep(delay)
-
-    def draw_grid(self, player_pos, enemies):
-        top = 2
-        left = 2
+            self.put(y, x, " " * (self.width - x - 2))
+            self.put(y, x, frame)
+            self.refresh()
+            self.pause(delay)
+
+    def draw_grid(self, player_pos, enemies, terrain=None, allies=()):
+        # allies: (hero, pos) for the other party members, drawn by initial
+        grid = self.pane("grid")
+        terrain = terrain or DEFAULT_TERRAIN
+        alive = live_items(enemies)
+        occupant = {e["pos"]: i + 1 for i, e in alive}  # one pass instead of a scan per cell
+        friends = {pos: hero.name[:1].upper() for hero, pos in allies}
         for r in range(GRID_ROWS):
             for c in range(GRID_COLS):
-                ch = " . "
-                color = curses.color_pair(0)
+                tile = terrain.tile((r, c))
+                ch = TERRAIN_TILES.get(tile, TERRAIN_TILES["."])["draw"]
+                color = color_pair(TERRAIN_COLORS.get(tile, 0))
                 if (r, c) == player_pos:
                     ch = " P "
-                    color = curses.color_pair(1)
-                else:
-                    found = None
-                    for idx, e in enumerate(enemies, 1):
-                        if e["hp"] > 0 and e["pos"] == (r, c):
-                            found = idx
-                            break
-                    if found is not None:
-                        ch = f"E{found}"
-                        color = curses.color_pair(2)
-                try:
-                    self.stdscr.addstr(top + r, left + c*3, ch, color)
-                except curses.error:
-                    pass  # in case terminal is small
-                # >>> Show enemy list neatly under the player's inventory in the HUD
-                try:
-                    hud_x = 45
-                    # draw starting a bit lower than inventory section (line ~9)
-                    y = 13
-                    self.stdscr.addstr(y, hud_x, "=== Enemies ===", curses.A_BOLD | curses.color_pair(3))
-                    line = 1
-                    for i, e in enumerate(enemies, 1):
-                        if e["hp"] > 0:
-                            name = e["name"]
-                            self.stdscr.addstr(y + line, hud_x, f"E{i}: {name} {e['hp']}/{e.get('max_hp', e['hp'])}")
-                            line += 1
-                    # clear a couple extra lines below in case old enemies are gone
-                    for clr in range(line, line + 4):
-                        self.stdscr.addstr(y + clr, hud_x, " " * 35)
-                except curses.error:
-                    pass
-                # <<<
-
-
-
-    def draw_hud(self, player, messages):
-        # top-right area for stats
-        stat_x = 45
-        try:
-            # Player stats
-            self.stdscr.addstr(1, stat_x, "=== STATUS ===", curses.A_BOLD | curses.color_pair(3))
-            self.stdscr.addstr(2, stat_x, player.summary_line())
-            self.stdscr.addstr(4, stat_x, f"Gold: {player.gold}  Lv:{player.level}  Exp:{player.exp}")
-            self.stdscr.addstr(6, stat_x, "Inventory:")
-            inv_preview = ", ".join([ITEMS[i]["name"] for i in player.inventory[:5]])
-            self.stdscr.addstr(7, stat_x, inv_preview[:self.width - stat_x - 2])
-
-            # Clear old message area first
-            msg_y_start = self.height - 7
-            msg_lines = 6
-            for i in range(msg_lines):
-                self.stdscr.addstr(msg_y_start + i, 2, " " * (self.width - 4))
-
-            # Display only latest messages
-            latest = messages[-msg_lines:]
-            for i, m in enumerate(latest):
-                self.stdscr.addstr(msg_y_start + i, 2, m[:self.width-4])
-        except curses.error:
-            pass
+                    color = color_pair(1)
+                elif (r, c) in friends:
+                    ch = f" {friends[(r, c)]} "
+                    color = color_pair(1)
+                elif (r, c) in occupant:
+                    ch = f"E{occupant[(r, c)]}"
+                    color = color_pair(2)
+                grid.addstr(r, c*3, ch, color)
+        # >>> Show enemy list neatly under the player's inventory in the HUD
+        roster = self.pane("enemies")
+        roster.clear()
+        roster.addstr(0, 0, "=== Enemies ===", curses.A_BOLD | color_pair(3))
+        for line, (i, e) in enumerate(alive, start=1):
+            tags = "".join(f" [{STATUS_EFFECTS[n]['label']}]" for n in e.get("effects", {}))
+            roster.addstr(line, 0, f"E{i+1}: {e['name']} {e['hp']}/{e.get('max_hp', e['hp'])}{tags}")
+        # <<<
+
+    def draw_initiative(self, names, odds=None):
+        bar = self.pane("initiative")
+        bar.clear()
+        bar.addstr(0, 0, "Next: " + " > ".join(names) + (f"  | {odds}" if odds else ""), color_pair(6))
+
+    def draw_hud(self, player, messages, turn=0, party=(), leader=None):
+        # stats panel; `player` is whoever is acting, `leader` owns gold and the pack
+        hud = self.pane("hud")
+        leader = leader or player
+        hud.clear()
+        # Player stats
+        hud.addstr(0, 0, "=== STATUS ===", curses.A_BOLD | color_pair(3))
+        hud.addstr(1, 0, player.summary_line())
+        hud.addstr(3, 0, f"Gold: {leader.gold}  Lv:{player.level}  Exp:{player.exp}")
+        status = describe_effects(player, turn)
+        if status:
+            hud.addstr(4, 0, f"Effects: {status}", color_pair(4))
+        hud.addstr(5, 0, "Inventory:")
+        hud.addstr(6, 0, ", ".join([ITEMS[i]["name"] for i in leader.inventory[:5]]))
+        if len(party) > 1:
+            hud.addstr(7, 0, "=== Party ===", curses.A_BOLD | color_pair(3))
+            for i, hero in enumerate(party[:PARTY_MAX]):
+                mark = ">" if hero is player else " "
+                hud.addstr(8 + i, 0, f"{mark}{hero.name[:10]} ({hero.pclass}) {max(0, hero.hp)}/{hero.max_hp}" + (" DOWN" if hero.hp <= 0 else ""))
+
+        # Display only latest messages
+        log = self.pane("log")
+        log.clear()
+        if log.rect.h:
+            lines = messages.tail(log.rect.h) if isinstance(messages, CombatLog) else messages[-log.rect.h:]
+            for i, m in enumerate(lines):
+                log.addstr(i, 0, str(m))
+
+    def browse_log(self, log):
+        """Full-screen scrollback over a CombatLog: w/s scroll a line, a/d a page, x saves it to a file."""
+        back = 0
+        while True:
+            self.clear()
+            rows = max(1, self.height - 4)
+            back = max(0, min(back, len(log) - rows))
+            self.put(0, 2, f"Combat log ({len(log)} lines)", curses.A_BOLD | color_pair(3))
+            for i, line in enumerate(log.tail(rows, back)):
+                self.put(2 + i, 2, line)
+            self.put(self.height - 1, 2, "w/s scroll  a/d page  x save  any other key returns", color_pair(6))
+            self.refresh()
+            _, cmd = self.command("log")
+            if cmd in ("older", "newer"):
+                back += 1 if cmd == "older" else -1
+            elif cmd in ("page_older", "page_newer"):
+                back += rows if cmd == "page_older" else -rows
+            elif cmd == "save":
+                self.put(self.height - 1, 2, f"Saved to {log.export()}".ljust(52))
+                self.refresh()
+                self.getkey()
+            else:
+                return
 
     def refresh(self):
-        self.stdscr.refresh()
+        if self.recorder:
+            self.recorder.frame()
+        self.renderer.flush()
 
 # -------------------- Combat helpers & smarter AI --------------------
-
-def spawn_enemies(area, player_pos):
+# strong Clash Royale elites used for 1v1 duels
+ELITE_POOL = ["pekka", "mega_knight", "prince", "golem", "archer_queen", "royal_ghost"]
+ELITE_EXTRAS = ["electro_wizard", "lumberjack"]
+
+# -------------------- Encounter director --------------------
+# group sizes each arena allows (anything else may roll 1v1 elites or groups of 2-3)
+AREA_GROUP_SIZES = {"Hidden Throne": (4,), "Desert Arena": (1,), "Goblin Forest": (2, 3), "Dragon Arena": (1,)}
+DEFAULT_GROUP_SIZES = (1, 2, 3)
+# fixed per-arena multiplier applied to 1v1 duels and the 4-unit throne fight
+ARENA_ELITE_SCALE = {"Goblin Forest": 0.75, "Royal Arena": 0.75, "Dark Valley": 1, "Desert Arena": 1.25, "Hidden Throne": 2}
+LATTICE_HP_SCALES = (0.85, 1.0, 1.15, 1.3)
+LATTICE_POOL_SLICES = ("low", "all", "high")
+TARGET_FIGHT_TURNS = (4, 9)     # fights should last this many turns
+TARGET_DAMAGE_PER_TURN = 0.08   # fraction of max HP the player should lose per turn, roughly
+DIRECTOR_ALPHA = 0.3            # weight of the newest fight in the running averages
+DIRECTOR_STEP = 1.12
+DIRECTOR_RANGE = (0.5, 2.0)
+
+_LATTICE_CACHE = {}
+
+def _enemy_power(key):
+    e = ENEMIES[key]
+    return e["hp"] * e["atk"]
+
+def _group_hp_mult(count):
+    return 1.0 + (0.25 if count == 1 else -0.1 * (count - 1))
+
+def _pool_slice(pool, which):
+    ranked = sorted(set(pool), key=_enemy_power)
+    if which == "all" or len(ranked) < 3:
+        return ranked
+    half = (len(ranked) + 1) // 2
+    return ranked[:half] if which == "low" else ranked[-half:]
+
+def difficulty_lattice(area):
+    """
+    Every (group size, pool slice, HP scale) an arena allows, rated by expected enemy HP x ATK relative to
+    the arena's default roll, and sorted by that rating. Built once per arena.
+    """
+    key = area.get("id", area["name"])
+    lattice = _LATTICE_CACHE.get(key)
+    if lattice is not None:
+        return lattice
+    sizes = AREA_GROUP_SIZES.get(area["name"], DEFAULT_GROUP_SIZES)
+    elite_scale = ARENA_ELITE_SCALE.get(area["name"], area.get("scale", 1.0))
+    cells = []
+    baseline = []
+    for count in sizes:
+        base_pool = area.get("elite_pool", ELITE_POOL) if count == 1 and not story_fight(area) else area["encounters"]
+        for which in LATTICE_POOL_SLICES:
+            pool = _pool_slice(base_pool, which)
+            power = sum(_enemy_power(k) for k in pool) / len(pool) * count * _group_hp_mult(count)
+            if count in (1, 4):
+                power *= elite_scale * elite_scale  # both HP and ATK are scaled
+            for hp_scale in LATTICE_HP_SCALES:
+                cells.append({"count": count, "pool": pool, "hp_scale": hp_scale, "rating": power * hp_scale})
+            if which == "all":
+                baseline.append(power)
+    # normalise so the unscaled, full-pool cells average 1.0
+    norm = sum(baseline) / len(baseline)
+    for c in cells:
+        c["rating"] /= norm
+    cells.sort(key=lambda c: c["rating"])
+    lattice = (cells, [c["rating"] for c in cells])
+    _LATTICE_CACHE[key] = lattice
+    return lattice
+
+class EncounterDirector:
+    """
+    Tracks how the player's fights are going (running averages, O(1) per fight) and steers the next
+    encounter's difficulty so fights stay inside TARGET_FIGHT_TURNS without being lopsided.
+    """
+    def __init__(self):
+        self.fights = 0
+        self.avg_turns = 0.0
+        self.avg_damage = 0.0   # fraction of max HP lost per turn
+        self.flee_rate = 0.0
+        self.death_rate = 0.0
+        self.difficulty = 1.0   # target lattice rating
+
+    def _blend(self, old, new):
+        return new if self.fights == 1 else old + DIRECTOR_ALPHA * (new - old)
+
+    def record_fight(self, turns, hp_lost, max_hp, outcome):
+        """outcome: 'won', 'fled' or 'died'."""
+        self.fights += 1
+        turns = max(1, turns)
+        self.avg_turns = self._blend(self.avg_turns, turns)
+        self.avg_damage = self._blend(self.avg_damage, max(0, hp_lost) / max(1, max_hp) / turns)
+        self.flee_rate = self._blend(self.flee_rate, 1.0 if outcome == "fled" else 0.0)
+        self.death_rate = self._blend(self.death_rate, 1.0 if outcome == "died" else 0.0)
+        lo, hi = TARGET_FIGHT_TURNS
+        if outcome != "won" or self.avg_turns > hi or self.avg_damage > TARGET_DAMAGE_PER_TURN * 1.5 \
+                or self.flee_rate > 0.3:
+            self.difficulty /= DIRECTOR_STEP
+        elif self.avg_turns < lo and self.avg_damage < TARGET_DAMAGE_PER_TURN:
+            self.difficulty *= DIRECTOR_STEP
+        self.difficulty = max(DIRECTOR_RANGE[0], min(DIRECTOR_RANGE[1], self.difficulty))
+
+    def plan(self, area):
+        """Pick the lattice cell whose rating is nearest the current difficulty (random among near-ties)."""
+        cells, ratings = difficulty_lattice(area)
+        i = bisect_left(ratings, self.difficulty)
+        near = cells[max(0, i - 1):i + 1] or cells[-1:]
+        return random.choice(near)
+
+    def summary(self):
+        return (f"Director: difficulty {self.difficulty:.2f}  avg turns {self.avg_turns:.1f}  "
+                f"dmg/turn {self.avg_damage:.0%}  flee {self.flee_rate:.0%}")
+
+def story_fight(area):
+    """Fights the story forces (the dragon finale): their foes are fixed, whatever the difficulty."""
+    return area.get("id") in ZONE_FIGHTS.values()
+
+def spawn_enemies(area, player_pos, keys=None, director=None):
+    # keys: optional fixed composition (list of ENEMIES keys) instead of a random roll
+    # director: optional EncounterDirector that picks size / pool / HP scale from the difficulty lattice
 # === Arena-based spawn rules ===
     # If this fight has a specifically forced encounter (e.g., adult dragon), respect it
-    if area["name"] == "Dragon Arena":
+    if story_fight(area):
         # Spawn exactly one adult dragon, placed in front of player
         count = 1
 
-        # existing code continues...
     # === SECRET FINAL ARENA ALWAYS 2 ENEMIES ===
-    if area["name"] == "Hidden Throne":
+    elif area["name"] == "Hidden Throne":
         count = 4
 
     # Desert Arena: Always 1v1 strong duels
@@ -768,68 +2254,189 @@ def spawn_enemies(area, player_pos):
     else:
         count = 1 if random.random() < 0.5 else random.randint(2, 3)
 
+    hp_scale = 1.0
+    cell = None
+    if keys is not None:
+        count = len(keys)
+    elif director is not None and not story_fight(area):
+        cell = director.plan(area)
+        count, hp_scale = cell["count"], cell["hp_scale"]
 
-    # spawn 1-3 enemies on right side, not overlapping player
+    # spawn 1-3 enemies on right side, not overlapping player or walls
     enemies = []
     attempts = 0
+    terrain = get_terrain(area)
 
     # pick encounter pool
     encounter_pool = area["encounters"][:]
 
     # if only one enemy spawns, choose stronger ones
-    if count == 1 and area["name"] != "Dragon Arena":
+    if count == 1 and not story_fight(area):
         # strong Clash Royale elites
-        strong_pool = ["pekka", "mega_knight", "prince", "golem", "archer_queen", "royal_ghost"]
+        strong_pool = area.get("elite_pool", ELITE_POOL)[:]
         # sometimes add electro wizard or lumberjack
-        if random.random() < 0.3:
-            strong_pool += ["electro_wizard", "lumberjack"]
+        if random.random() < 0.3 and "elite_pool" not in area:
+            strong_pool += ELITE_EXTRAS
         encounter_pool = strong_pool
+    if cell is not None:
+        encounter_pool = cell["pool"]
 
     for i in range(count):
-        key = random.choice(encounter_pool)
+        key = keys[i] if keys is not None else random.choice(encounter_pool)
         template = deepcopy(ENEMIES[key])
         placed = False
         while not placed and attempts < 400:
             attempts += 1
             r = random.randint(0, GRID_ROWS - 1)
             c = random.randint(GRID_COLS//2, GRID_COLS - 1)
-            if (r, c) != player_pos and all(e["pos"] != (r, c) for e in enemies):
+            if (r, c) != player_pos and terrain.passable((r, c)) and all(e["pos"] != (r, c) for e in enemies):
                 template["pos"] = (r, c)
                 # scale HP slightly depending on group size
                 hp_mult = 1.0 + (0.25 if count == 1 else -0.1 * (count - 1))
                 template["hp"] = int(template["hp"] * hp_mult)
                 template["max_hp"] = template["hp"]
                 template["id"] = f"{key}_{i+1}"
+                template["key"] = key
                 # Arena-based scaling for 1v1 powerful fights
                 # Only applies when count == 1 (meaning elite duel)
                 if count == 1 or count == 4:
-                    arena_name = area["name"]
-                    # Define scaling by arena progression
-                    if arena_name == "Goblin Forest":
-                        scale = 0.75   # weaker elites early
-                    elif arena_name == "Royal Arena":
-                        scale = 0.75    # normal strength
-                    elif arena_name == "Dark Valley":
-                        scale = 1   # slightly buffed
-                    elif arena_name == "Desert Arena":
-                        scale = 1.25    # real boss fights
-                    elif arena_name == "Hidden Throne":
-                        scale = 2 # super boss fights
-                    else:
-                        scale = 1.0    # fallback
+                    # scaling by arena progression (generated arenas carry their own)
+                    scale = ARENA_ELITE_SCALE.get(area["name"], area.get("scale", 1.0))
 
                     template["hp"] = int(template["hp"] * scale)
                     template["max_hp"] = template["hp"]
                     template["atk"] = int(template["atk"] * scale)
+                if hp_scale != 1.0:
+                    template["hp"] = template["max_hp"] = max(1, int(template["hp"] * hp_scale))
+                    template["hp_scale"] = hp_scale
                 enemies.append(template)
                 placed = True
         if not placed:
             template["pos"] = (0, GRID_COLS - 1 - i)
             template["id"] = f"{key}_{i+1}"
+            template["key"] = key
             enemies.append(template)
     return enemies
 
 
+# -------------------- Enemy unit pool --------------------
+MAX_ENEMY_SLOTS = 8
+SUMMON_COOLDOWN = 3
+
+def _empty_slot():
+    return {"name": "", "hp": 0, "max_hp": 0, "atk": 0, "agility": 0, "pos": None}
+
+class UnitPool(list):
+    """
+    A fight's enemy list, preallocated to MAX_ENEMY_SLOTS. Summons and splits are written into the
+    slots of dead enemies in place, so long fights never grow the list every per-turn loop walks.
+
+    `live` maps slot index -> unit for the living only (insertion ordered, O(1) removal), so hot
+    loops never step over corpses and "all dead" is just `not pool.live`. Fallen units are recorded
+    in `graveyard` for loot/XP accounting.
+    """
+
+    def __init__(self, enemies, capacity=MAX_ENEMY_SLOTS):
+        super().__init__(enemies[:capacity])
+        self.extend(_empty_slot() for _ in range(capacity - len(self)))
+        self.states = [dict(first=True) for _ in self]
+        self.live = {i: e for i, e in enumerate(self) if e["hp"] > 0}
+        self.graveyard = []
+        self.spawned = 0  # serial for summoned units' ids
+        # stack of reusable slot indices (lowest index on top)
+        self.free = [i for i in range(len(self) - 1, -1, -1) if i not in self.live]
+
+    def all_dead(self):
+        return not self.live
+
+    def occupied(self, pos):
+        return any(e["pos"] == pos for e in self.live.values())
+
+    def open_tiles_around(self, center, player_pos, terrain, include_center=False, allies=()):
+        r, c = center
+        spots = [(r, c)] if include_center else []
+        spots += [(r-1, c), (r+1, c), (r, c-1), (r, c+1)]
+        taken = {player_pos} | {pos for _, pos in allies}
+        return [p for p in spots if terrain.passable(p) and p not in taken and not self.occupied(p)]
+
+    def spawn(self, key, pos):
+        """Drop a fresh ENEMIES[key] unit into a recycled slot. Returns the unit, or None if the pool is full."""
+        if not self.free:
+            return None
+        idx = self.free.pop()
+        slot = self[idx]
+        slot.clear()
+        slot.update(ENEMIES[key])  # shallow: taunt lists are shared read-only
+        slot["max_hp"] = slot["hp"]
+        self.spawned += 1
+        slot.update(pos=pos, id=f"{key}_s{self.spawned}", key=key, summoned=True)
+        self.states[idx].clear()
+        self.live[idx] = slot
+        return slot
+
+    def reap(self, player, player_pos, messages, terrain, allies=()):
+        """
+        Move enemies that died since the last call to the graveyard, run their on-death specials and free
+        their slots. `allies` lists (hero, pos) for other party members caught in death blasts.
+        """
+        for idx, e in [(i, e) for i, e in self.live.items() if e["hp"] <= 0]:
+            del self.live[idx]
+            self.graveyard.append({"key": e.get("key"), "name": e["name"], "max_hp": e.get("max_hp", 0),
+                                   "summoned": e.get("summoned", False)})
+            e.get("effects", {}).clear()
+            self.free.append(idx)
+            on_enemy_death(self, e, player, player_pos, messages, terrain, allies)
+
+def live_units(enemies):
+    """Living enemies: the pool's live index, or a filtered scan for plain lists."""
+    if isinstance(enemies, UnitPool):
+        return enemies.live.values()
+    return [e for e in enemies if e["hp"] > 0]
+
+def live_items(enemies):
+    """(slot index, unit) pairs for living enemies."""
+    if isinstance(enemies, UnitPool):
+        return list(enemies.live.items())
+    return [(i, e) for i, e in enumerate(enemies) if e["hp"] > 0]
+
+def enemy_at(enemies, pos, exclude=None):
+    return any(e["pos"] == pos for e in live_units(enemies) if e is not exclude)
+
+def on_enemy_death(pool, enemy, player, player_pos, messages, terrain, allies=()):
+    blast = enemy.get("death_blast")
+    if blast:
+        caught = [h for h, pos in [(player, player_pos)] + list(allies) if h.hp > 0 and manhattan(enemy["pos"], pos) <= 1]
+        for hero in caught:
+            hero.hp -= blast
+        if caught:
+            who = ", ".join(unit_name(h) for h in caught)
+            messages.append(f"{enemy['name']} explodes! {who} take{'' if len(caught) > 1 or who == 'You' else 's'} {blast} damage.")
+        else:
+            messages.append(f"{enemy['name']} explodes!")
+    split = enemy.get("splits_into")
+    if split:
+        # the dead unit's own slot may be the one recycled, so read it before spawning
+        name, count = enemy["name"], enemy.get("split_count", 2)
+        spots = pool.open_tiles_around(enemy["pos"], player_pos, terrain, include_center=True, allies=allies)
+        made = [pool.spawn(split, pos) for pos in spots[:count]]
+        made = [m for m in made if m]
+        if made:
+            messages.append(f"{name} splits into {len(made)} {made[0]['name']}s!")
+
+def try_summon(enemy, state, enemies, player_pos, terrain, messages, allies=()):
+    """Witch-style summon: every SUMMON_COOLDOWN turns, fill open tiles next to the caster from the pool."""
+    if not isinstance(enemies, UnitPool):
+        return
+    if state.get("summon_cd", 1) > 0:
+        state["summon_cd"] = state.get("summon_cd", 1) - 1
+        return
+    spots = enemies.open_tiles_around(enemy["pos"], player_pos, terrain, allies=allies)
+    made = [enemies.spawn(enemy["summons"], pos) for pos in spots[:enemy.get("summon_count", 1)]]
+    made = [m for m in made if m]
+    if made:
+        state["summon_cd"] = SUMMON_COOLDOWN
+        messages.append(f"{enemy['name']} summons {len(made)} {made[0]['name']}{'s' if len(made) > 1 else ''}!")
+
 def compute_attack(attacker, defender, roll_override=None):
     """
     Compute damage and return (damage, roll_val).
@@ -844,26 +2451,111 @@ def compute_attack(attacker, defender, roll_override=None):
     dmg = max(0, (roll_val // 2) + atk + str_bonus + mag_bonus - def_ag)
     return dmg, roll_val
 
-def find_path_around(enemies, src, dest):
-    # Simple BFS pathfinder that treats enemy tiles as obstacles (so enemies will try to go around each other)
+def player_attack_damage(player, target, rollv):
+    """Melee damage the player deals to target for a given d20 roll (rolls above 18 crit for double)."""
+    weapon_atk = 0
+    if "weapon" in player.equipment:
+        weapon_key = player.equipment["weapon"]
+        weapon = ITEMS.get(weapon_key, {})
+        eff = weapon.get("effect", (None, None))
+        if isinstance(eff[1], dict) and eff[1].get("atk"):
+            weapon_atk = eff[1]["atk"]
+        else:
+            weapon_atk = 2
+
+    p_stat = {"atk": weapon_atk, "strength": player.strength, "magic": 0}
+    dmg, _ = compute_attack(p_stat, {"agility": target["agility"]}, roll_override=rollv)
+    if player.passive == "swift":
+        dmg += 1
+    if rollv > 18:
+        dmg *= 2
+    return dmg
+
+def enemy_hit_damage(enemy, player, rollv, swarm=False, enraged=False, charging=False, slam=False):
+    """Damage an enemy's attack deals to a hero for a given d20 roll, before guarding."""
+    dmg, _ = compute_attack(enemy, {"agility": player.agility}, roll_override=rollv)
+    if swarm:
+        dmg += 3
+    if enraged:
+        dmg = dmg * 3 // 2
+    if charging:
+        dmg *= 2
+    if slam:
+        dmg += 4
+    if player.passive == "armor":
+        dmg = max(0, dmg - 1)
+    if "armor" in player.equipment:
+        armor = ITEMS.get(player.equipment["armor"], {})
+        eff = armor.get("effect", (None, None))
+        if isinstance(eff[1], dict) and eff[1].get("def"):
+            dmg = max(0, dmg - eff[1]["def"])
+    return dmg
+
+def award_victory(player, area, messages, graveyard=()):
+    """Hand out the loot, gold and XP for clearing an encounter (summoned foes in the graveyard add bonus XP)."""
+    found = roll_loot(player, area, graveyard)
+    for loot in found:
+        player.inventory.append(loot)
+    g = random.randint(8, 30)
+    xp = random.randint(8, 20) + 2 * sum(1 for d in graveyard if d.get("summoned"))
+    player.gold += g
+    player.exp += xp
+    for ally in player.companions:
+        ally.exp += xp
+    names = ", ".join(ITEMS[loot]["name"] for loot in found) or "no items"
+    messages.append(f"Found {names} and {g} gold (+{xp} XP)!")
+
+def apply_level_gain(player):
+    player.level += 1
+    player.max_hp += 6
+    player.hp = player.max_hp
+    player.strength += 1
+    player.agility += 1
+    player.magic += 1
+    player.mana = player.magic * 2
+
+def find_path_around(enemies, src, dest, terrain=None, blocked=()):
+    # A* pathfinder over terrain costs that treats enemy tiles as obstacles (so enemies will try to go around each other)
+    # heuristic is the cached terrain-only distance field for dest, so the search hugs the real path
+    # ties on f go to the deepest node: with an exact heuristic that walks one shortest path instead of all of them
     # returns next step toward dest, or direct greedy fallback
-    q = deque()
-    q.append(src)
-    visited = {src: None}
-    obstacles = {e["pos"] for e in enemies if e["hp"] > 0}
+    terrain = terrain or DEFAULT_TERRAIN
+    obstacles = {e["pos"] for e in live_units(enemies)} | set(blocked)
     obstacles.discard(dest)  # allow destination if an enemy stands there
-    while q:
-        cur = q.popleft()
+    h = terrain_distance_field(terrain, dest)
+    came = {src: None}
+    if src in h:
+        adjacent, cost = terrain.adjacent, terrain.cost
+        # fast path: walk downhill on h around the obstacles; reaching dest that way is already a shortest path
+        cur, first = src, None
+        while cur != dest:
+            for nxt in adjacent[cur]:
+                if nxt not in obstacles and nxt in h and cost[nxt[0]][nxt[1]] + h[nxt] == h[cur]:
+                    break
+            else:
+                break
+            cur = nxt
+            first = first or nxt
         if cur == dest:
-            break
-        for dr, dc in [(-1,0),(1,0),(0,-1),(0,1)]:
-            nr, nc = cur[0]+dr, cur[1]+dc
-            if 0 <= nr < GRID_ROWS and 0 <= nc < GRID_COLS:
-                nxt = (nr, nc)
-                if nxt not in visited and nxt not in obstacles:
-                    visited[nxt] = cur
-                    q.append(nxt)
-    if dest not in visited:
+            return first or src
+        g = {src: 0}
+        heap = [(h[src], 0, src)]
+        while heap:
+            _, gc, cur = heapq.heappop(heap)
+            gc = -gc
+            if cur == dest:
+                break
+            if gc > g[cur]:
+                continue
+            for nxt in adjacent[cur]:
+                if nxt in obstacles or nxt not in h:
+                    continue
+                ng = gc + cost[nxt[0]][nxt[1]]
+                if ng < g.get(nxt, ng + 1):
+                    g[nxt] = ng
+                    came[nxt] = cur
+                    heapq.heappush(heap, (ng + h[nxt], -ng, nxt))
+    if dest not in came:
         # fallback: greedy step
         dr = 0
         dc = 0
@@ -872,39 +2564,63 @@ def find_path_around(enemies, src, dest):
         if src[1] < dest[1]: dc = 1
         elif src[1] > dest[1]: dc = -1
         nextpos = clamp_pos(src[0]+dr, src[1]+dc)
-        return nextpos
+        return nextpos if terrain.passable(nextpos) else src
     # reconstruct path
     cur = dest
-    while visited[cur] != src:
-        cur = visited[cur]
+    while came[cur] != src:
+        cur = came[cur]
         if cur is None:
             return src
     return cur
 
-def enemy_ai_move_and_act(e_idx, enemy, state, player, player_pos, enemies, ui, messages):
+def enemy_ai_move_and_act(e_idx, enemy, state, player, player_pos, enemies, ui, messages, terrain=None, effects=None, turn=0,
+                          allies=(), field=None):
     # smarter AI:
-    # prioritize target: if multiple players/targets were present they'd pick lowest HP; here always player
+    # prioritize target: the caller picks it (pick_target: threat / HP / reach); `player` is that hero and
+    # `allies` the rest of the party as (hero, pos), whose tiles are off limits
     # behaviour:
     # - if adjacent: decide attack (or special) or defend if low hp
     # - if not adjacent: pathfind around obstacles toward player, sometimes flank (choose lateral move)
     # - taunt occasionally
+    # returns the player's position (specials like knockback can shove the player)
     if enemy["hp"] <= 0:
-        return
+        return player_pos
+    terrain = terrain or DEFAULT_TERRAIN
+    taken = {pos for _, pos in allies}
+    if effects is None:
+        effects = EffectScheduler()
+    if effects.has(enemy, "stunned"):
+        messages.append(f"{enemy['name']} is stunned and can't act.")
+        return player_pos
     # random taunt
     if random.random() < 0.08:
-        t = random.choice(enemy.get("taunts", ["..."]))
-        messages.append(f"{enemy['name']}: {t}")
+        messages.append(LogEntry("{}: {}", (enemy["name"], random.choice(enemy.get("taunts", ["..."])))))
+    brain = BOSS_BRAINS.get(enemy.get("key"))
+    if brain is not None:
+        return brain.tick(BossTurn(e_idx, enemy, state, player, player_pos, enemies, ui, messages, terrain, effects, turn,
+                                   allies, field, taken))
+    return enemy_basic_turn(e_idx, enemy, state, player, player_pos, enemies, ui, messages, terrain, effects, turn,
+                            allies, field, taken)
+
+def enemy_basic_turn(e_idx, enemy, state, player, player_pos, enemies, ui, messages, terrain, effects, turn, allies, field,
+                     taken):
+    """The stock move-then-attack turn every enemy without a behaviour tree plays (and bosses fall back on)."""
     # pre-turn special set
     sp = enemy.get("special")
-    if sp == "phase" and random.random() < 0.2:
-        state["phased"] = True
+    if sp == "phase" and random.random() < 0.2 and not effects.has(enemy, "phased"):
+        effects.apply(enemy, "phased", 2, turn)
         messages.append(f"{enemy['name']} fades and will evade next hit.")
-    else:
-        state["phaesd"] = False
     if sp == "swarm" and random.random() < 0.2:
-        state["swarm_rage"] = True
-    else:
-        state["swarm_rage"] = False
+        effects.apply(enemy, "swarm_rage", 1, turn)
+    if sp == "invis" and random.random() < 0.25 and not effects.has(enemy, "invisible"):
+        effects.apply(enemy, "invisible", 2, turn)
+        messages.append(f"{enemy['name']} vanishes from sight!")
+    if sp == "summon" and enemy.get("summons"):
+        try_summon(enemy, state, enemies, player_pos, terrain, messages, allies)
+    if sp == "rage" and enemy["hp"] <= enemy.get("max_hp", enemy["hp"]) // 2 and not state.get("raged"):
+        state["raged"] = True
+        effects.apply(enemy, "enraged", 3, turn)
+        messages.append(f"{enemy['name']} flies into a rage!")
     # decide move
     # --- MOVE FIRST ---
     dist_before = manhattan(enemy["pos"], player_pos)
@@ -919,37 +2635,53 @@ def enemy_ai_move_and_act(e_idx, enemy, state, player, player_pos, enemies, ui,
         bestd = dist_before
         for dr, dc in [(-1,0),(1,0),(0,-1),(0,1)]:
             nr, nc = enemy["pos"][0]+dr, enemy["pos"][1]+dc
-            if 0 <= nr < GRID_ROWS and 0 <= nc < GRID_COLS and not any(e["pos"] == (nr,nc) for e in enemies):
+            if terrain.passable((nr,nc)) and not enemy_at(enemies, (nr,nc)) and (nr,nc) not in taken:
                 d = manhattan((nr,nc), player_pos)
                 if d > bestd:
                     best = (nr,nc)
                     bestd = d
         if best != enemy["pos"]:
             enemy["pos"] = best
-            messages.append(f"{enemy['name']} backs away!")
+            messages.append(LogEntry("{} backs away!", (enemy["name"],)))
             moved = True
 
     # Try to move toward player if not already adjacent
-    if dist_before > 1:
-        nextpos = find_path_around(enemies, enemy["pos"], player_pos)
+    # charging units cover two tiles when they start far away, and hit twice as hard on arrival
+    steps = 2 if sp == "charge" and dist_before >= 3 else 1
+    for _ in range(steps):
+        if manhattan(enemy["pos"], player_pos) <= 1 or effects.has(enemy, "rooted"):
+            break
+        nextpos = next_step(enemies, enemy["pos"], player_pos, terrain, field, taken)
 
         # avoid collisions and moving onto player tile
-        if nextpos != player_pos and not any(other["pos"] == nextpos and other["hp"] > 0 for other in enemies if other is not enemy):
+        if nextpos != player_pos and nextpos not in taken and not enemy_at(enemies, nextpos, exclude=enemy):
             enemy["pos"] = nextpos
             moved = True
+    if steps == 2 and moved:
+        effects.apply(enemy, "charging", 2, turn)
+        messages.append(LogEntry("{} charges!", (enemy["name"],)))
+
+    if moved:
+        spike = enter_tile(terrain, enemy["pos"])
+        if spike:
+            enemy["hp"] -= spike
+            messages.append(f"{enemy['name']} steps on spikes and takes {spike} damage!")
+            if enemy["hp"] <= 0:
+                messages.append(f"{enemy['name']} falls!")
+                return player_pos
 
     # --- THEN ATTACK IF IN RANGE ---
     dist_after = manhattan(enemy["pos"], player_pos)
     enemy_range = enemy.get("range", 1)
     # 50/50 chance ranged units will NOT attack if they moved this turn
     if moved and enemy_range > 1 and random.random() < 0.5:
-        return
+        return player_pos
 
 
     if dist_after <= enemy_range:
         # ranged taunt or message
         if enemy_range > 1 and dist_after > 1:
-            messages.append(f"{enemy['name']} attacks from a distance!")
+            messages.append(LogEntry("{} attacks from a distance!", (enemy["name"],)))
 
         # retreat logic for low hp melee only
         if enemy_range == 1 and enemy["hp"] < max(6, enemy.get("atk", 5)) and random.random() < 0.4:
@@ -957,7 +2689,7 @@ def enemy_ai_move_and_act(e_idx, enemy, state, player, player_pos, enemies, ui,
             bestd = manhattan(best, player_pos)
             for dr, dc in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
                 nr, nc = enemy["pos"][0] + dr, enemy["pos"][1] + dc
-                if 0 <= nr < GRID_ROWS and 0 <= nc < GRID_COLS and not any(other["pos"] == (nr, nc) for other in enemies):
+                if terrain.passable((nr, nc)) and not enemy_at(enemies, (nr, nc)) and (nr, nc) not in taken:
                     d = manhattan((nr, nc), player_pos)
                     if d > bestd:
                         best = (nr, nc)
@@ -965,477 +2697,2392 @@ def enemy_ai_move_and_act(e_idx, enemy, state, player, player_pos, enemies, ui,
             if best != enemy["pos"]:
                 enemy["pos"] = best
                 messages.append(f"{enemy['name']} retreats!")
-                return
+                return player_pos
         # perform attack
-        dmg, r = compute_attack(enemy, {"agility": player.agility})
-
-        if state.get("swarm_rage"):
-            dmg += 3
-        if player.passive == "armor":
-            dmg = max(0, dmg - 1)
-        if "armor" in player.equipment:
-            armor_key = player.equipment["armor"]
-            armor = ITEMS.get(armor_key, {})
-            eff = armor.get("effect", (None, None))
-            if isinstance(eff[1], dict) and eff[1].get("def"):
-                dmg = max(0, dmg - eff[1]["def"])
+        charging = effects.consume(enemy, "charging")
+        slam = sp == "slam" and moved and dist_after == 1
+        dmg = enemy_hit_damage(enemy, player, roll(20), effects.has(enemy, "swarm_rage"), effects.has(enemy, "enraged"),
+                               charging, slam)
+        if charging:
+            messages.append(f"{enemy['name']}'s charge connects!")
+        if slam:
+            messages.append(f"{enemy['name']} lands with a MEGA SLAM!")
+        if effects.has(player, "guarding"):
+            dmg //= 2
+            owner = "Your" if unit_ref(player) == "you" else f"{player.name}'s"
+            messages.append(f"{owner} defense absorbed some damage.")
 
         if enemy_range > 1:
-            messages.append(f"{enemy['name']} fires a ranged attack for {dmg} damage!")
+            messages.append(LogEntry("{} fires a ranged attack at {} for {} damage!", (enemy["name"], unit_ref(player), dmg)))
         else:
-            messages.append(f"{enemy['name']} hits you for {dmg} damage!")
+            messages.append(LogEntry("{} hits {} for {} damage!", (enemy["name"], unit_ref(player), dmg)))
 
         player.hp -= dmg
-        return
-
-
-        # else attack
-        # maybe special multi-hit for 'dash' or 'spin'
-        # compute attack roll animation
-        # do a dice roll using UI if provided
-
-# -------------------- Combat main (curses-driven) --------------------
-def combat_sequence(stdscr, ui, player, area):
-    # spawn enemies
-    # If area is a dict, use its name. If it's just a string, use it directly.
-    state = {"area_name": area["name"] if isinstance(area, dict) else area}
-    player_pos = (GRID_ROWS//2, 1)
-    enemies = spawn_enemies(area, player_pos)
-    enemy_states = [dict(first=True) for _ in enemies]
-    messages = [f"Encounter: {', '.join(e['name'] for e in enemies)}"]
-    turn = 1
-    defending = False
+        player_pos = apply_on_hit_special(enemy, player, player_pos, enemies, terrain, effects, turn, messages, moved, taken)
+        return player_pos
 
-    while True:
-        ui.clear()
-        messages.append(f"========= Turn {turn}")
-        ui.draw_grid(player_pos, enemies)
-        ui.draw_hud(player, messages)
-        messages.clear()
-        messages.append(f"========= Turn {turn}")
-        ui.stdscr.addstr(
-            GRID_ROWS + 4,
-            2,
-            "Turn {} - Move (W/A/S/D), then choose action (1 Attack, 2 Defend, 3 Magic, 4 Item, m Move Again, r Run, p Pass).".format(turn)
-        )
-        ui.refresh()
+    return player_pos
 
-        # pre-turn enemy states
-        for i,e in enumerate(enemies):
-            if e["hp"]>0 and enemy_states[i].get("phased"):
-                # phased remains until next incoming attack; we set it already in AI pre-turns
-                pass
+def apply_on_hit_special(enemy, player, player_pos, enemies, terrain, effects, turn, messages, moved=False, blocked=()):
+    """Status riders for enemy specials once an attack lands. Returns the (possibly shoved) player position."""
+    sp = enemy.get("special")
+    who = unit_ref(player)
+    if sp == "stun" and random.random() < 0.35:
+        effects.apply(player, "stunned", 2, turn)
+        messages.append(f"{enemy['name']} stuns {who}!")
+    elif sp in ("fire_breath", "fire") and random.random() < 0.4:
+        effects.apply(player, "burning", 3, turn)
+        messages.append("You catch fire!" if who == "you" else f"{who} catches fire!")
+    elif sp == "slam" and moved:
+        effects.apply(player, "rooted", 2, turn)
+        messages.append(f"The shockwave pins {who} in place!")
+    elif sp == "knockback":
+        dr = (player_pos[0] > enemy["pos"][0]) - (player_pos[0] < enemy["pos"][0])
+        dc = (player_pos[1] > enemy["pos"][1]) - (player_pos[1] < enemy["pos"][1])
+        if dr and dc:
+            dr = 0  # knock along one axis only
+        pushed = (player_pos[0] + dr, player_pos[1] + dc)
+        if terrain.passable(pushed) and not enemy_at(enemies, pushed) and pushed not in blocked:
+            messages.append(f"{enemy['name']} knocks {who} back!")
+            player_pos = pushed
+            spike = enter_tile(terrain, player_pos)
+            if spike:
+                player.hp -= spike
+                messages.append(f"Spikes! {unit_name(player)} take{'' if who == 'you' else 's'} {spike} damage.")
+    return player_pos
+
+# -------------------- Boss behaviour --------------------
+# Boss scripts as behaviour trees: (node, [int arg], *children). Composites: select (first child that
+# doesn't fail), sequence (children until one fails). Decorators: once (child runs a single time per unit),
+# cooldown N (child at most every N turns). Conditions: hp_below PCT, within N / beyond N (tiles to the target).
+# Actions: fight (the stock turn), roar (enrage), breath / quake N (wind up for a turn, then hit every hero
+# within N tiles), leap (jump next to the target and slam).
+BOSS_TREES = {
+    "adult_dragon": ("select",
+                     # second phase below half HP: one roar, then breath on a shorter cooldown
+                     ("sequence", ("hp_below", 50),
+                      ("select", ("once", ("roar",)),
+                                 ("sequence", ("within", 3), ("cooldown", 3, ("breath", 3))),
+                                 ("fight",))),
+                     ("sequence", ("within", 3), ("cooldown", 5, ("breath", 3))),
+                     ("fight",)),
+    "golem": ("select",
+              ("sequence", ("hp_below", 50), ("once", ("roar",))),
+              ("sequence", ("within", 2), ("cooldown", 4, ("quake", 2))),
+              ("fight",)),
+    "mega_knight": ("select",
+                    ("sequence", ("hp_below", 40), ("once", ("roar",))),
+                    ("sequence", ("beyond", 2), ("within", 4), ("cooldown", 3, ("leap",))),
+                    ("fight",)),
+}
+FAILURE, SUCCESS, RUNNING = 0, 1, 2
+(BT_SELECT, BT_SEQUENCE, BT_ONCE, BT_COOLDOWN, BT_HP_BELOW, BT_WITHIN, BT_BEYOND,
+ BT_FIGHT, BT_ROAR, BT_BREATH, BT_QUAKE, BT_LEAP) = range(12)
+BT_OPS = {"select": BT_SELECT, "sequence": BT_SEQUENCE, "once": BT_ONCE, "cooldown": BT_COOLDOWN,
+          "hp_below": BT_HP_BELOW, "within": BT_WITHIN, "beyond": BT_BEYOND, "fight": BT_FIGHT, "roar": BT_ROAR,
+          "breath": BT_BREATH, "quake": BT_QUAKE, "leap": BT_LEAP}
+
+class BossTurn:
+    """Everything one boss action can touch; leaves update player_pos in place."""
+    __slots__ = ("e_idx", "enemy", "state", "player", "player_pos", "enemies", "ui", "messages", "terrain", "effects",
+                 "turn", "allies", "field", "taken")
+
+    def __init__(self, *args):
+        for name, value in zip(self.__slots__, args):
+            setattr(self, name, value)
+
+def _guarded(t, hero, dmg):
+    if t.effects.has(hero, "guarding"):
+        owner = "Your" if unit_ref(hero) == "you" else f"{hero.name}'s"
+        t.messages.append(f"{owner} defense absorbed some damage.")
+        return dmg // 2
+    return dmg
+
+def _bt_fight(t, arg):
+    t.player_pos = enemy_basic_turn(t.e_idx, t.enemy, t.state, t.player, t.player_pos, t.enemies, t.ui, t.messages,
+                                    t.terrain, t.effects, t.turn, t.allies, t.field, t.taken)
+    return SUCCESS
+
+def _bt_roar(t, arg):
+    t.effects.apply(t.enemy, "enraged", 3, t.turn)
+    t.messages.append(f"{t.enemy['name']} roars and flies into a rage!")
+    return SUCCESS
+
+def _bt_blast(t, radius, windup, verb, rider, rider_msg, heavy=False):
+    """Shared two-step area attack: the first tick only winds up (RUNNING), the next one lands (double if heavy)."""
+    name = t.enemy["name"]
+    if not t.state.get("winding"):
+        t.state["winding"] = True
+        t.messages.append(f"{name} {windup}...")
+        return RUNNING
+    t.state["winding"] = False
+    caught = [(h, pos) for h, pos in [(t.player, t.player_pos)] + list(t.allies)
+              if h.hp > 0 and manhattan(t.enemy["pos"], pos) <= radius]
+    if not caught:
+        t.messages.append(f"{name} {verb}, but nobody is in reach.")
+    for hero, _ in caught:
+        dmg = enemy_hit_damage(t.enemy, hero, roll(20), enraged=t.effects.has(t.enemy, "enraged"), charging=heavy)
+        dmg = _guarded(t, hero, dmg)
+        hero.hp -= dmg
+        t.effects.apply(hero, rider, 2, t.turn)
+        who = unit_ref(hero)
+        s, be = ("", "are") if who == "you" else ("s", "is")
+        t.messages.append(f"{name} {verb} — {who} take{s} {dmg} damage and {be} {rider_msg}!")
+    return SUCCESS
+
+def _bt_breath(t, arg):
+    return _bt_blast(t, arg, "draws a deep, rumbling breath", "breathes fire", "burning", "set alight")
+
+def _bt_quake(t, arg):
+    return _bt_blast(t, arg, "raises its fists high", "pounds the ground", "rooted", "knocked off balance", heavy=True)
+
+def _bt_leap(t, arg):
+    r, c = t.player_pos
+    spots = [p for p in ((r - 1, c), (r + 1, c), (r, c - 1), (r, c + 1))
+             if t.terrain.passable(p) and p not in t.taken and not enemy_at(t.enemies, p, exclude=t.enemy)]
+    if not spots:
+        return FAILURE
+    enemy = t.enemy
+    enemy["pos"] = min(spots, key=lambda p: manhattan(p, enemy["pos"]))
+    t.messages.append(f"{enemy['name']} leaps high into the air!")
+    spike = enter_tile(t.terrain, enemy["pos"])
+    if spike:
+        enemy["hp"] -= spike
+        t.messages.append(f"{enemy['name']} lands on spikes and takes {spike} damage!")
+        if enemy["hp"] <= 0:
+            t.messages.append(f"{enemy['name']} falls!")
+            return SUCCESS
+    dmg = enemy_hit_damage(enemy, t.player, roll(20), enraged=t.effects.has(enemy, "enraged"), slam=True)
+    dmg = _guarded(t, t.player, dmg)
+    t.messages.append(f"{enemy['name']} lands on {unit_ref(t.player)} with a MEGA SLAM for {dmg} damage!")
+    t.player.hp -= dmg
+    t.player_pos = apply_on_hit_special(enemy, t.player, t.player_pos, t.enemies, t.terrain, t.effects, t.turn,
+                                        t.messages, True, t.taken)
+    return SUCCESS
+
+# leaf actions by opcode (conditions are inlined in BehaviorTree._run)
+BT_ACTIONS = {BT_FIGHT: _bt_fight, BT_ROAR: _bt_roar, BT_BREATH: _bt_breath, BT_QUAKE: _bt_quake, BT_LEAP: _bt_leap}
+
+class BehaviorTree:
+    """
+    A BOSS_TREES script compiled to flat preorder arrays: ops[i] is the opcode, args[i] its int argument
+    and end[i] one past the last node of its subtree, so a node's children are i + 1, end[i + 1], ...
+    Per-unit memory lives in the unit's AI state: "bt" holds one int per node (cooldown ready turn, once
+    fired) and "bt_cursor" the action left RUNNING last turn, which resumes before anything else is checked.
+    """
+    __slots__ = ("ops", "args", "end", "actions")
+
+    def __init__(self, spec):
+        self.ops, self.args, self.end = [], [], []
+        self._emit(spec)
+        self.actions = [BT_ACTIONS.get(op) for op in self.ops]
+
+    def _emit(self, node):
+        i = len(self.ops)
+        arg = node[1] if len(node) > 1 and not isinstance(node[1], tuple) else 0
+        self.ops.append(BT_OPS[node[0]])
+        self.args.append(arg)
+        self.end.append(0)
+        for child in node[1:]:
+            if isinstance(child, tuple):
+                self._emit(child)
+        self.end[i] = len(self.ops)
+
+    def tick(self, t):
+        """Play one boss turn. Returns the target's (possibly shoved) position."""
+        mem = t.state.get("bt")
+        if mem is None:
+            mem = t.state["bt"] = [0] * len(self.ops)
+        cursor = t.state.get("bt_cursor")
+        if cursor is not None:
+            if self.actions[cursor](t, self.args[cursor]) != RUNNING:
+                t.state["bt_cursor"] = None
+        elif self._run(0, t, mem) == FAILURE:
+            _bt_fight(t, 0)  # a script that finds nothing to do still takes the stock turn
+        return t.player_pos
+
+    def _run(self, i, t, mem):
+        op, arg = self.ops[i], self.args[i]
+        if op == BT_SELECT or op == BT_SEQUENCE:
+            want = FAILURE if op == BT_SELECT else SUCCESS  # keep going while children return this
+            j, end = i + 1, self.end[i]
+            while j < end:
+                status = self._run(j, t, mem)
+                if status != want:
+                    return status
+                j = self.end[j]
+            return want
+        if op == BT_ONCE:
+            if mem[i]:
+                return FAILURE
+            mem[i] = 1
+            return self._run(i + 1, t, mem)
+        if op == BT_COOLDOWN:
+            if t.turn < mem[i]:
+                return FAILURE
+            status = self._run(i + 1, t, mem)
+            if status != FAILURE:
+                mem[i] = t.turn + arg
+            return status
+        if op == BT_HP_BELOW:
+            e = t.enemy
+            return SUCCESS if e["hp"] * 100 < arg * e.get("max_hp", e["hp"]) else FAILURE
+        if op == BT_WITHIN or op == BT_BEYOND:
+            near = manhattan(t.enemy["pos"], t.player_pos) <= arg
+            return SUCCESS if near == (op == BT_WITHIN) else FAILURE
+        status = self.actions[i](t, arg)
+        if status == RUNNING:
+            t.state["bt_cursor"] = i
+        return status
+
+# compiled once at load
+BOSS_BRAINS = {key: BehaviorTree(spec) for key, spec in BOSS_TREES.items()}
+
+# -------------------- Initiative --------------------
+INITIATIVE_SCALE = 120  # a unit acts every INITIATIVE_SCALE // (agility + INITIATIVE_FLOOR) ticks
+INITIATIVE_FLOOR = 4
+TURN_TICKS = 12         # one combat turn (effect durations, HUD counter) spans this many ticks
+
+def action_delay(agility):
+    return max(1, INITIATIVE_SCALE // (max(0, agility) + INITIATIVE_FLOOR))
+
+class InitiativeQueue:
+    """
+    Speed-based turn order: a heap of (ready_at, rank, seq, key). Popping a unit reschedules it one
+    action_delay later, so agile units come up more often. Ties break on rank (heroes, then enemy slots)
+    and then insertion order, so the same fight always plays out in the same order.
+    """
 
-        # Movement input (one step max)
-        ui.stdscr.addstr(GRID_ROWS + 6, 2, "Movement: ")
-        ui.stdscr.refresh()
-        key = ui.stdscr.getkey()
-        ui.stdscr.addstr(GRID_ROWS + 6, 12, key)
-        ui.stdscr.refresh()
-        time.sleep(0.15)
-        mv_done = False
-        try:
-            if key.lower() in ("w","a","s","d"):
-                drdc = {"w":(-1,0),"s":(1,0),"a":(0,-1),"d":(0,1)}[key.lower()]
-                newp = clamp_pos(player_pos[0]+drdc[0], player_pos[1]+drdc[1])
-                # cannot move onto enemy tile
-                if any(e["pos"] == newp and e["hp"]>0 for e in enemies):
-                    messages.append("Can't move onto enemy — blocked.")
-                else:
-                    player_pos = newp
-            elif key.lower() == "p":  # pass movement
-                messages.append("You chose to skip movement.")
-            else:
-                # if not movement key, treat as action key pressed immediately (fall through)
-                pass
-        except Exception:
-            pass
+    def __init__(self):
+        self.heap = []
+        self.seq = 0
+        self.units = {}  # key -> (delay, rank, seq of its live heap entry)
+
+    def add(self, key, agility, now=0, rank=0):
+        delay = action_delay(agility)
+        self.units[key] = (delay, rank, self.seq)
+        heapq.heappush(self.heap, (now + delay, rank, self.seq, key))
+        self.seq += 1
+
+    def remove(self, key):
+        self.units.pop(key, None)  # its heap entry goes stale and is skipped
+
+    def _live(self, entry):
+        unit = self.units.get(entry[3])
+        return unit is not None and unit[2] == entry[2]
+
+    def peek(self):
+        """(ready_at, key) of the next actor without taking its turn."""
+        while self.heap and not self._live(self.heap[0]):
+            heapq.heappop(self.heap)
+        return (self.heap[0][0], self.heap[0][3]) if self.heap else (None, None)
+
+    def pop(self):
+        now, key = self.peek()
+        if key is None:
+            return None, None
+        heapq.heappop(self.heap)
+        delay, rank, _ = self.units[key]
+        self.units[key] = (delay, rank, self.seq)
+        heapq.heappush(self.heap, (now + delay, rank, self.seq, key))
+        self.seq += 1
+        return now, key
+
+    def preview(self, n):
+        """The next n actors in order, worked out on a scratch copy of the heap."""
+        heap = [e for e in self.heap if self._live(e)]
+        heapq.heapify(heap)
+        order = []
+        while heap and len(order) < n:
+            t, rank, seq, key = heapq.heappop(heap)
+            order.append(key)
+            heapq.heappush(heap, (t + self.units[key][0], rank, seq, key))
+        return order
+
+INITIATIVE_PREVIEW = 6  # upcoming actors shown in the HUD
+
+def initiative_name(key, party, enemies):
+    if key[0] == "hero":
+        return unit_name(party[key[1]])
+    return f"E{key[1] + 1}"
+
+def sync_initiative(queue, enemies, now):
+    """Queue enemies that appeared since the last call (they wait a full delay) and drop the fallen."""
+    live = {("enemy", i, e["id"]) for i, e in live_items(enemies)}
+    for key in [k for k in queue.units if k[0] == "enemy" and k not in live]:
+        queue.remove(key)
+    for key in live - queue.units.keys():
+        queue.add(key, enemies[key[1]]["agility"], now, rank=PARTY_MAX + key[1])
+
+# -------------------- Party --------------------
+PARTY_MAX = 4                 # leader + up to three hired companions
+COMPANION_BASE_COST = 40      # gold; each extra hire costs this much more
+COMPANION_NAMES = ["Aria", "Bram", "Cora", "Dax", "Elin", "Finn", "Gwen", "Holt"]
+TARGET_HP_WEIGHT = 6          # enemy target score: lower is juicier
+TARGET_THREAT_WEIGHT = 0.5
+
+def hire_cost(player):
+    return COMPANION_BASE_COST * (len(player.companions) + 1)
+
+def hire_companion(player, pclass):
+    """Recruit a companion of pclass at one level below the leader. Returns the hero, or None if the party is full."""
+    if len(player.companions) + 1 >= PARTY_MAX:
+        return None
+    taken = {h.name for h in player.companions}
+    name = next((n for n in COMPANION_NAMES if n not in taken and n != player.name), f"Hero {len(taken) + 2}")
+    hero = Player(name, pclass)
+    hero.companion = True
+    for _ in range(max(0, player.level - 2)):
+        apply_level_gain(hero)
+    player.companions.append(hero)
+    return hero
+
+def party_members(party, positions, skip=None):
+    """(hero, pos) for standing party members, leaving out party[skip]."""
+    return [(h, positions[i]) for i, h in enumerate(party) if i != skip and h.hp > 0]
+
+def party_start_positions(terrain, n):
+    """Open, spike-free tiles for n heroes, clustered around PLAYER_START on the left edge."""
+    spots = [(r, c) for r in range(GRID_ROWS) for c in range(3)
+             if terrain.passable((r, c)) and not terrain.damage((r, c))]
+    spots.sort(key=lambda p: (manhattan(p, PLAYER_START), p[1] != PLAYER_START[1], p[0]))
+    if PLAYER_START in spots:
+        spots.remove(PLAYER_START)
+    return ([PLAYER_START] + spots)[:n]
+
+def revive_party(party):
+    """Downed companions get back up on 1 HP once the fight is over."""
+    for hero in party:
+        if hero.hp <= 0:
+            hero.hp = 1
+        hero.downed = False
+
+@lru_cache(maxsize=64)
+def party_distance_field(terrain, goals):
+    """
+    Multi-source Dijkstra from every hero tile at once: pos -> (terrain cost to the nearest hero, that hero's pos).
+    One search per party layout serves every enemy, instead of one search per hero per enemy.
+    """
+    field = {g: (0, g) for g in goals}
+    heap = [(0, g, g) for g in goals]
+    heapq.heapify(heap)
+    while heap:
+        d, cur, src = heapq.heappop(heap)
+        if d > field[cur][0]:
+            continue
+        enter_cost = terrain.step_cost(cur)
+        for prev in terrain.neighbors(cur):
+            nd = d + enter_cost
+            if nd < field.get(prev, (float("inf"),))[0]:
+                field[prev] = (nd, src)
+                heapq.heappush(heap, (nd, prev, src))
+    return field
+
+def next_step(enemies, src, dest, terrain, field=None, blocked=()):
+    """
+    Next tile from src toward dest. When dest is the nearest hero on the party field, just walk downhill
+    on it; otherwise (or when the downhill tiles are all taken) fall back to A*.
+    """
+    if field is not None and field.get(src, (0, None))[1] == dest:
+        here = field[src][0]
+        best = None
+        for nxt in terrain.neighbors(src):
+            if nxt not in field or nxt in blocked or (nxt != dest and enemy_at(enemies, nxt)):
+                continue
+            d = terrain.step_cost(nxt) + field[nxt][0]
+            if field[nxt][0] < here and (best is None or d < best[0]):
+                best = (d, nxt)
+        if best is not None:
+            return best[1]
+    return find_path_around(enemies, src, dest, terrain, blocked)
+
+def pick_target(enemy, party, positions, field=None):
+    """
+    Index of the hero this enemy goes after. Heroes within striking reach are scored by remaining HP
+    and threat (damage dealt this fight); if none are in reach, the nearest hero on the party field.
+    """
+    standing = [i for i, h in enumerate(party) if h.hp > 0]
+    if len(standing) == 1:
+        return standing[0]
+    reach = enemy.get("range", 1) + (2 if enemy.get("special") == "charge" else 1)
+    in_reach = [i for i in standing if manhattan(enemy["pos"], positions[i]) <= reach]
+    if in_reach:
+        def score(i):
+            hero = party[i]
+            return (TARGET_HP_WEIGHT * hero.hp / max(1, hero.max_hp) - TARGET_THREAT_WEIGHT * hero.threat
+                    + manhattan(enemy["pos"], positions[i]))
+        return min(in_reach, key=score)
+    nearest = field.get(enemy["pos"], (0, None))[1] if field else None
+    for i in standing:
+        if positions[i] == nearest:
+            return i
+    return min(standing, key=lambda i: manhattan(enemy["pos"], positions[i]))
 
-        # action selection
-        ui.stdscr.addstr(GRID_ROWS + 7, 2, "Action: ")
-        ui.stdscr.refresh()
-        action_key = ui.stdscr.getkey()
-        ui.stdscr.addstr(GRID_ROWS + 7, 10, action_key)
-        ui.stdscr.refresh()
-        time.sleep(0.15)  
-        action = ""
-        if action_key == "1":
-            action = "attack"
-        elif action_key == "2":
-            action = "defend"
-        elif action_key == "3":
-            action = "magic"
-        elif action_key == "4":
-            action = "item"
-        elif action_key.lower() == "r":
-            action = "run"
-        elif action_key.lower() == "p":  # pass action
-            action = "pass"
-        elif action_key == "m":
-            action = "move_again"
+# -------------------- Combat main (curses-driven) --------------------
+# -------------------- Spells --------------------
+# Spellbooks are listed per class in CLASSES. Shapes are drawn for a caster facing right (+col) and
+# turned to the caster's facing; "self" spells have no area and act on the caster.
+SPELLS = {
+    "firebolt": {"name": "Firebolt", "desc": "Damage nearby enemies", "cost": 3, "shape": "diamond", "size": 3,
+                 "effect": "damage", "power": 3},
+    "heal": {"name": "Heal", "desc": "Heal yourself", "cost": 2, "shape": "self", "size": 0,
+             "effect": "heal", "power": 6},
+    "smite": {"name": "Smite", "desc": "Strike the four tiles around you", "cost": 2, "shape": "cross", "size": 1,
+              "effect": "damage", "power": 5},
+    "arc_lance": {"name": "Arc Lance", "desc": "Pierce a straight line ahead", "cost": 2, "shape": "line", "size": 5,
+                  "effect": "damage", "power": 4},
+    "frost_cone": {"name": "Frost Cone", "desc": "Blast a widening cone ahead", "cost": 4, "shape": "cone", "size": 3,
+                   "effect": "damage", "power": 3},
+    "fan_of_knives": {"name": "Fan of Knives", "desc": "Throw a short cone of blades", "cost": 2, "shape": "cone",
+                      "size": 2, "effect": "damage", "power": 3},
+}
+FACINGS = ((0, 1), (0, -1), (1, 0), (-1, 0))
+
+def _shape_offsets(shape, size):
+    """(row, col) offsets a shape covers around the caster, facing right; the caster's own tile is never hit."""
+    if shape == "diamond":
+        return [(dr, dc) for dr in range(-size, size + 1) for dc in range(-size, size + 1)
+                if 0 < abs(dr) + abs(dc) <= size]
+    if shape == "line":
+        return [(0, k) for k in range(1, size + 1)]
+    if shape == "cone":
+        return [(j, k) for k in range(1, size + 1) for j in range(1 - k, k)]
+    if shape == "cross":
+        return [off for k in range(1, size + 1) for off in ((0, k), (0, -k), (k, 0), (-k, 0))]
+    if shape == "self":
+        return []
+    raise ValueError(f"unknown spell shape {shape!r}")
+
+def _turn(offset, facing):
+    dr, dc = offset
+    fr, fc = facing
+    # forward axis follows the facing, the side axis stays perpendicular to it
+    return (fr * dc + fc * dr, fc * dc + fr * dr)
+
+# spell key -> facing -> frozenset of offsets, compiled once at load
+SPELL_MASKS = {key: {f: frozenset(_turn(off, f) for off in _shape_offsets(sp["shape"], sp["size"])) for f in FACINGS}
+               for key, sp in SPELLS.items()}
+
+def spellbook(hero):
+    return CLASSES[hero.pclass].get("spells", [])
+
+def spell_targets(key, origin, facing, enemies):
+    """(slot, unit) pairs inside the spell's area: each live unit is one set lookup against the compiled mask."""
+    mask = SPELL_MASKS[key][facing]
+    r, c = origin
+    return [(i, e) for i, e in live_items(enemies) if (e["pos"][0] - r, e["pos"][1] - c) in mask]
+
+def cast_spell(hero, key, origin, enemies, effects, messages, who="You", s=""):
+    """
+    Spend the mana and resolve one spell from `origin`. Returns the damage dealt (0 for heals and misses),
+    or None when the hero can't pay for it.
+    """
+    spell = SPELLS[key]
+    if hero.mana < spell["cost"]:
+        return None
+    hero.mana -= spell["cost"]
+    if spell["effect"] == "heal":
+        healed = min(hero.max_hp - hero.hp, spell["power"] + hero.magic)
+        hero.hp += healed
+        messages.append(f"{who} cast{s} {spell['name']} and gain{s} {healed} HP.")
+        return 0
+    targets = spell_targets(key, origin, getattr(hero, "facing", FACINGS[0]), enemies)
+    if not targets:
+        messages.append(f"No targets in range for {spell['name']}.")
+    dealt = 0
+    for idx, e in targets:
+        if effects.consume(e, "phased"):
+            messages.append(f"{e['name']} phased and avoided {spell['name']}!")
+        elif effects.has(e, "invisible"):
+            messages.append(f"{spell['name']} can't find the invisible {e['name']}!")
         else:
-            # some terminals return string length >1; allow w/a/s/d repeated -> attempt to ignore
+            dmg, _ = compute_attack({"atk": spell["power"], "magic": hero.magic}, {"agility": e["agility"]})
+            messages.append(f"{spell['name']} hits {e['name']} for {dmg}.")
+            e["hp"] -= dmg
+            hero.threat += dmg
+            dealt += dmg
+    return dealt
+
+def hero_turn(ui, player, player_pos, leader, enemies, terrain, effects, turn, messages, state, blocked=()):
+    """
+    One hero's move + action. `player` is the acting hero, `leader` owns the shared inventory and
+    `blocked` holds the other heroes' tiles. Returns (new position, fled).
+    """
+    who = unit_name(player)
+    prompt = ui.pane("prompt")
+    s, be = ("", "are") if who == "You" else ("s", "is")
+    # burning can finish the player (or the last foe) before anyone acts
+    if player.hp <= 0 or enemies.all_dead():
+        stunned = True
+        key = action_key = ""
+    else:
+        stunned = effects.has(player, "stunned")
+    if stunned and player.hp > 0 and not enemies.all_dead():
+        messages.append(f"{who} {be} stunned and lose{s} {'your' if who == 'You' else 'a'} turn!")
+        prompt.addstr(2, 0, "Stunned!")
+        ui.refresh()
+        ui.pause(0.8)
+        key = action_key = ""
+
+    # Movement input (one step max)
+    move = None
+    if not stunned and effects.has(player, "rooted"):
+        messages.append(f"{who} {be} rooted and can't move.")
+        key = ""
+    elif not stunned:
+        prompt.addstr(2, 0, "Movement: ")
+        ui.refresh()
+        key, move = ui.command("move")
+        while move in ("log", "queue"):
+            if move == "queue":
+                # ':' opens a command line; its keys feed this prompt and the ones after it
+                prompt.addstr(2, 0, "Queue: ")
+                ui.refresh()
+                ui.queue_line(ui.prompt_row(2), prompt.rect.x + 7)
+            elif isinstance(messages, CombatLog):
+                ui.browse_log(messages)
+                if ui.on_resize:
+                    ui.on_resize()  # back to the fight screen
+            ui.pane("prompt").addstr(2, 0, "Movement: ".ljust(48))
+            ui.refresh()
+            key, move = ui.command("move")
+        prompt.addstr(2, 10, key_name(key))
+        ui.refresh()
+        ui.beat(0.15)
+    mv_done = False
+    if move == "rewind":
+        if state.get("can_rewind"):
+            state["rewind"] = True  # combat_sequence puts the fight back one hero turn
+            return player_pos, False
+        messages.append("Nothing left to rewind.")
+        ui.flush_input()
+    try:
+        if move in MOVE_STEPS:
+            drdc = MOVE_STEPS[move]
+            player.facing = drdc
+            newp = clamp_pos(player_pos[0]+drdc[0], player_pos[1]+drdc[1])
+            # cannot move onto enemy tile
+            if enemy_at(enemies, newp):
+                messages.append("Can't move onto enemy — blocked.")
+            elif newp in blocked:
+                messages.append("An ally is in the way.")
+            elif not terrain.passable(newp):
+                messages.append("A wall blocks your way.")
+            elif newp != player_pos:
+                player_pos = newp
+                spike = enter_tile(terrain, player_pos)
+                if spike:
+                    player.hp -= spike
+                    messages.append(f"Spikes! {who} take{s} {spike} damage.")
+            if player_pos != newp:
+                ui.flush_input()  # blocked: whatever was queued after this step assumed it worked
+        elif move == "stay":  # pass movement
+            messages.append(f"{who} chose to skip movement.")
+    except Exception:
+        pass
+
+    # action selection
+    action = "stunned"
+    if not stunned:
+        prompt.addstr(3, 0, "Action: ")
+        ui.refresh()
+        action_key, action = ui.command("act")
+        prompt.addstr(3, 8, key_name(action_key))
+        ui.refresh()
+        ui.beat(0.15)
+        if action is None:
             messages.append("Invalid action key.")
-            action = None
 
-        # Player action resolution
-        if action == "attack":
-            # display rolling animation and use that same roll for the actual damage
-            rollv = ui.rolling_animation("Attack roll", y=GRID_ROWS + 8, x=2, rolls=6, max_val=20)
+    # Player action resolution
+    if action == "attack":
+        # display rolling animation and use that same roll for the actual damage
+        rollv = ui.rolling_animation("Attack roll", y=ui.prompt_row(4), x=2, rolls=6, max_val=20)
 
-            # find adjacent enemies
-            adjacent = [(i,e) for i,e in enumerate(enemies)
-                        if e["hp"] > 0 and manhattan(player_pos, e["pos"]) == 1]
+        # find adjacent enemies
+        adjacent = [(i,e) for i,e in live_items(enemies)
+                    if manhattan(player_pos, e["pos"]) == 1]
 
-            if not adjacent:
-                messages.append("No adjacent enemy to attack.")
-            else:
-                # --- MULTIPLE TARGETS: LET PLAYER CHOOSE ---
-                if len(adjacent) > 1:
-                    ui.stdscr.addstr(GRID_ROWS + 10, 2, "Choose target: ")
-                    y = GRID_ROWS + 11
-                    for n, (idx, enemy) in enumerate(adjacent, start=1):
-                        ui.stdscr.addstr(y, 2, f"{n}) {enemy['name']} ({enemy['hp']} HP)")
-                        y += 1
-                    ui.stdscr.refresh()
-                    choice = ui.stdscr.getkey()
-                    ui.stdscr.addstr(GRID_ROWS + 10, 17, choice)
-                    ui.stdscr.refresh()
-                    time.sleep(0.15)
-                    if choice.isdigit():
-                        sel = int(choice)
-                        if 1 <= sel <= len(adjacent):
-                            chosen_idx = adjacent[sel - 1][0]
-                        else:
-                            chosen_idx = adjacent[0][0]
-                            messages.append("Invalid target, attacking nearest.")
+        if not adjacent:
+            messages.append("No adjacent enemy to attack.")
+        else:
+            # --- MULTIPLE TARGETS: LET PLAYER CHOOSE ---
+            if len(adjacent) > 1:
+                prompt.addstr(6, 0, "Choose target: ")
+                y = 7
+                for n, (idx, enemy) in enumerate(adjacent, start=1):
+                    prompt.addstr(y, 0, f"{n}) {enemy['name']} ({enemy['hp']} HP)")
+                    y += 1
+                ui.refresh()
+                choice, sel = ui.command("pick")
+                prompt.addstr(6, 15, key_name(choice))
+                ui.refresh()
+                ui.beat(0.15)
+                if sel:
+                    if sel <= len(adjacent):
+                        chosen_idx = adjacent[sel - 1][0]
                     else:
                         chosen_idx = adjacent[0][0]
-                        messages.append("Invalid input, attacking nearest.")
+                        messages.append("Invalid target, attacking nearest.")
                 else:
                     chosen_idx = adjacent[0][0]
-
-                target = enemies[chosen_idx]
-                tstate = enemy_states[chosen_idx]
-                if tstate.get("phased"):
-                    messages.append(f"{target['name']} phases and avoids your attack!")
-                    tstate["phased"] = False
-                else:
-                    # compute damage with a short damage text animation
-                    weapon_atk = 0
-                    if "weapon" in player.equipment:
-                        weapon_key = player.equipment["weapon"]
-                        weapon = ITEMS.get(weapon_key, {})
-                        eff = weapon.get("effect", (None, None))
-                        if isinstance(eff[1], dict) and eff[1].get("atk"):
-                            weapon_atk = eff[1]["atk"]
-                        else:
-                            weapon_atk = 2
-
-                    p_stat = {"atk": weapon_atk, "strength": player.strength, "magic": 0}
-                    # use the same roll value from animation
-                    dmg, _ = compute_attack(p_stat, {"agility": target["agility"]}, roll_override=rollv)
-                    if player.passive == "swift":
-                        dmg += 1
-
-                    if rollv > 18:
-                        dmg *= 2
-                        ui.display_message_with_animation("CRITICAL STRIKE!", y=GRID_ROWS+9, x=2)
-
-                    frames = ["D", "Da", "Dam", "Dama", "Damag", "Damage!"]
-                    ui.type_and_replace(frames, y=GRID_ROWS+10, x=2, delay=0.06)
-                    messages.append(f"You deal {dmg} to {target['name']} (roll {rollv}).")
-                    target["hp"] -= dmg
-                    if target["hp"] <= 0:
-                        messages.append(f"{target['name']} falls!")
-        elif action == "move_again":
-            ui.stdscr.addstr(GRID_ROWS + 8, 2, "Move Again: ")
-            ui.stdscr.refresh()
-            k2 = ui.stdscr.getkey()
-
-            # display pressed key
-            ui.stdscr.addstr(GRID_ROWS + 8, 14, k2)
-            ui.stdscr.refresh()
-            time.sleep(0.15)
-
-            if k2.lower() in ("w", "a", "s", "d"):
-                drdc = {"w":(-1,0), "s":(1,0), "a":(0,-1), "d":(0,1)}[k2.lower()]
-                newp = clamp_pos(player_pos[0] + drdc[0], player_pos[1] + drdc[1])
-                if any(e["pos"] == newp and e["hp"] > 0 for e in enemies):
-                    messages.append("Second move blocked by enemy.")
-                else:
-                    player_pos = newp
-                    messages.append("You move again.")
+                    messages.append("Invalid input, attacking nearest.")
             else:
-                messages.append("Invalid second movement.")
-        elif action == "defend":
-            defending = True
-            messages.append("You brace for incoming attacks. (Damage reduced this turn)")
-        elif action == "magic":
-            if player.mana < 1:
-                messages.append("No mana.")
-            else:
-                # simple choices: 1 Firebolt (3), 2 Heal (2)
-                ui.stdscr.addstr(GRID_ROWS + 8, 2, "1 Firebolt - Damage nearby enemies(3)")
-                ui.stdscr.addstr(GRID_ROWS + 9, 2, "2 Heal - Heal yourself (2)")
-                ui.stdscr.refresh()
-                k = ui.stdscr.getkey()
-                if k == "1" and player.mana >= 3:
-                    player.mana -= 3
-                    # area damage up to distance 2
-                    # Fire magic range: can hit any enemy within 3 tiles
-                    targets = [(i,e) for i,e in enumerate(enemies)
-                            if e["hp"]>0 and manhattan(player_pos, e["pos"]) <= 3]
-                    if not targets:
-                        messages.append("No targets in range for Firebolt.")
-                    else:
-                        for idx, e in targets:
-                            tstate = enemy_states[idx]
-                            if tstate.get("phased"):
-                                messages.append(f"{e['name']} phased and avoided Firebolt!")
-                                tstate["phased"] = False
-                            else:
-                                dmg, rv = compute_attack({"atk":3,"magic":player.magic}, {"agility": e["agility"]})
-                                messages.append(f"Firebolt hits {e['name']} for {dmg}.")
-                                e["hp"] -= dmg
-                elif k == "2" and player.mana >= 2:
-                    player.mana -= 2
-                    healed = min(player.max_hp - player.hp, 6 + player.magic)
-                    player.hp += healed
-                    messages.append(f"You cast Heal and gain {healed} HP.")
-                else:
-                    messages.append("Invalid magic choice or insufficient mana.")
-        elif action == "item":
-            if not player.inventory:
-                messages.append("Inventory empty.")
+                chosen_idx = adjacent[0][0]
+
+            target = enemies[chosen_idx]
+            if effects.consume(target, "phased"):
+                messages.append(f"{target['name']} phases and avoids your attack!")
+            elif effects.has(target, "invisible"):
+                messages.append(f"Your blade passes through empty air — {target['name']} is invisible!")
             else:
-                # show simple numbered inventory
-                ui.stdscr.addstr(GRID_ROWS + 8, 2, "Inventory: " + ", ".join([f"{i+1}:{ITEMS[k]['name']}" for i,k in enumerate(player.inventory[:6])]) + "   ")
-                ui.stdscr.addstr(11, 2, "Press number to use, 'i' to inspect, or any other key to cancel.")
-                ui.stdscr.refresh()
-                k = ui.stdscr.getkey()
-            if k.isdigit():
-                idx = int(k)-1
-                if 0 <= idx < len(player.inventory):
-                    key = player.inventory.pop(idx)
-                    ok, msg = player.apply_item(key, state)
-                    messages.append(msg)
-                else:
-                    messages.append("Invalid item index.")
+                # compute damage with a short damage text animation
+                # use the same roll value from animation
+                dmg = player_attack_damage(player, target, rollv)
+
+                if rollv > 18:
+                    ui.display_message_with_animation("CRITICAL STRIKE!", y=ui.prompt_row(5), x=2)
+
+                frames = ["D", "Da", "Dam", "Dama", "Damag", "Damage!"]
+                ui.type_and_replace(frames, y=ui.prompt_row(6), x=2, delay=0.06)
+                messages.append(f"{who} deal{s} {dmg} to {target['name']} (roll {rollv}).")
+                target["hp"] -= dmg
+                player.threat += dmg
+                if target["hp"] <= 0:
+                    messages.append(f"{target['name']} falls!")
+    elif action == "move_again":
+        prompt.addstr(4, 0, "Move Again: ")
+        ui.refresh()
+        k2, step = ui.command("step")
 
-            elif k.lower() == "i":
+        # display pressed key
+        prompt.addstr(4, 12, key_name(k2))
+        ui.refresh()
+        ui.beat(0.15)
+
+        if terrain.tile(player_pos) == "~":
+            # sand eats the rest of your movement
+            messages.append("The sand drags at your feet — no second move.")
+        elif effects.has(player, "rooted"):
+            messages.append(f"{who} {be} rooted and can't move.")
+        elif step:
+            drdc = MOVE_STEPS[step]
+            player.facing = drdc
+            newp = clamp_pos(player_pos[0] + drdc[0], player_pos[1] + drdc[1])
+            if enemy_at(enemies, newp) or newp in blocked:
+                messages.append("Second move blocked.")
+                ui.flush_input()
+            elif not terrain.passable(newp):
+                messages.append("Second move blocked by a wall.")
+                ui.flush_input()
+            elif newp != player_pos:
+                player_pos = newp
+                messages.append(f"{who} move{s} again.")
+                spike = enter_tile(terrain, player_pos)
+                if spike:
+                    player.hp -= spike
+                    messages.append(f"Spikes! {who} take{s} {spike} damage.")
+        else:
+            messages.append("Invalid second movement.")
+    elif action == "defend":
+        effects.apply(player, "guarding", 1, turn)
+        messages.append(f"{who} brace{s} for incoming attacks. (Damage halved this turn)")
+    elif action == "magic":
+        if player.mana < 1:
+            messages.append("No mana.")
+        else:
+            # the class spellbook, numbered: "<n> <name> - <desc> (<cost>)"
+            book = spellbook(player)
+            for n, key in enumerate(book, start=1):
+                prompt.addstr(3 + n, 0, f"{n} {SPELLS[key]['name']} - {SPELLS[key]['desc']} ({SPELLS[key]['cost']})")
+            ui.refresh()
+            _, n = ui.command("pick")
+            pick = book[n - 1] if n and n <= len(book) else None
+            if pick is None or cast_spell(player, pick, player_pos, enemies, effects, messages, who, s) is None:
+                messages.append("Invalid magic choice or insufficient mana.")
+    elif action == "item":
+        if not leader.inventory:
+            messages.append("Inventory empty.")
+        else:
+            # show simple numbered inventory
+            prompt.addstr(4, 0, "Inventory: " + ", ".join([f"{i+1}:{ITEMS[k]['name']}" for i,k in enumerate(leader.inventory[:6])]) + "   ")
+            prompt.addstr(5, 0, "Press number to use, 'i' to inspect, or any other key to cancel.")
+            ui.refresh()
+            _, k = ui.command("inventory")
+            if k == "inspect":
                 # inspect mode
                 ui.clear()
                 ui.draw_text_block(["Select an item number to inspect:"], 2, 2)
                 ui.draw_text_block(
-                    [f"{i+1}: {ITEMS[item]['name']}" for i, item in enumerate(player.inventory)], 
+                    [f"{i+1}: {ITEMS[item]['name']}" for i, item in enumerate(leader.inventory)], 
                     4, 2
                 )
                 ui.refresh()
-                ch2 = ui.stdscr.getkey()
+                _, n = ui.command("pick")
 
-                if ch2.isdigit():
-                    idx = int(ch2)-1
-                    if 0 <= idx < len(player.inventory):
-                        desc = player.describe_item(player.inventory[idx])
+                if n:
+                    if n <= len(leader.inventory):
+                        desc = leader.describe_item(leader.inventory[n - 1])
                         ui.display_message_with_animation(desc, y=ui.height-4)
-                        ui.stdscr.getch()
+                        ui.getch()
                 else:
                     ui.display_message_with_animation("Inspection canceled.", y=ui.height-4)
-                    ui.stdscr.getch()
+                    ui.getch()
+            elif k in PICK_KEYS.values():
+                if k <= len(leader.inventory):
+                    key = leader.inventory.pop(k - 1)
+                    # potions go to whoever is acting; gear and key items to the leader
+                    user = player if ITEMS[key]["effect"][0] in ("heal", "mana") else leader
+                    ok, msg = user.apply_item(key, state)
+                    messages.append(msg)
+                else:
+                    messages.append("Invalid item index.")
             else:
                 messages.append("Item canceled.")
-        elif action == "run":
-            flee_chance = max(10, min(95, 30 + player.agility * 3 - len([e for e in enemies if e["hp"]>0])*5))
-            # animated roll
-            val = ui.rolling_animation("Flee roll", y=GRID_ROWS+8, x=2, rolls=5, max_val=100)
-            if val <= flee_chance:
-                messages.append("You successfully fled.")
-                return False
-            else:
-                messages.append("Failed to flee.")
+    elif action == "run":
+        flee_chance = max(10, min(95, 30 + player.agility * 3 - len(enemies.live)*5))
+        # animated roll
+        val = ui.rolling_animation("Flee roll", y=ui.prompt_row(4), x=2, rolls=5, max_val=100)
+        if val <= flee_chance:
+            messages.append("You successfully fled.")
+            return player_pos, True
         else:
-            messages.append("No action taken.")
+            messages.append("Failed to flee.")
+    elif action == "stunned":
+        pass
+    else:
+        messages.append("No action taken.")
+    return player_pos, False
+
+# -------------------- Rewind --------------------
+REWIND_DEPTH = 64      # hero turns kept for rewinding; older ones drop off the back
+REWIND_CHARGES = 1     # rewinds per fight outside practice mode, for the odd misclick
+PRACTICE_MODE = False  # --practice: rewind as often as you like
+
+Snapshot = namedtuple("Snapshot", "turn positions heroes units states pool effects queue log_total")
+
+def _freeze(value):
+    """Immutable copy of a unit / AI-state value: dicts and lists become tagged tuples."""
+    if isinstance(value, dict):
+        return (dict, tuple((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, list):
+        return (list, tuple(_freeze(v) for v in value))
+    return value
+
+def _thaw(value):
+    if type(value) is tuple and len(value) == 2 and (value[0] is dict or value[0] is list):
+        if value[0] is dict:
+            return {k: _thaw(v) for k, v in value[1]}
+        return [_thaw(v) for v in value[1]]
+    return value
+
+def _hero_record(hero):
+    return (hero.hp, hero.mana, hero.threat, hero.downed, hero.facing, _freeze(hero.effects), tuple(hero.inventory),
+            tuple(hero.equipment.items()))
+
+class CombatHistory:
+    """
+    Snapshots of a fight taken as each hero's turn comes up, newest last, in a deque capped at REWIND_DEPTH.
+    Snapshots are immutable, and any hero, enemy slot or AI state that is unchanged since the previous
+    snapshot reuses that snapshot's record, so a long fight only stores what each turn changed. Rewinding
+    writes a snapshot back into the live objects in place; the effect and initiative heaps hold references
+    to those objects, so their saved entries stay valid.
+    """
 
-        # cleanup dead enemies, check victory
-        if all(e["hp"] <= 0 for e in enemies):
+    def __init__(self, party, enemies, effects, queue, log, depth=REWIND_DEPTH):
+        self.party, self.enemies, self.effects, self.queue, self.log = party, enemies, effects, queue, log
+        self.snaps = deque(maxlen=depth)
+        self.charges = None if PRACTICE_MODE else REWIND_CHARGES  # None: unlimited
+
+    @staticmethod
+    def _share(records, prev):
+        if prev is None:
+            return tuple(records)
+        return tuple(p if r == p else r for r, p in zip(records, prev))
+
+    def push(self, turn, positions, log):
+        prev = self.snaps[-1] if self.snaps else None
+        pool, fx, queue = self.enemies, self.effects, self.queue
+        self.snaps.append(Snapshot(
+            turn, tuple(positions),
+            self._share([_hero_record(h) for h in self.party], prev and prev.heroes),
+            self._share([_freeze(e) for e in pool], prev and prev.units),
+            self._share([_freeze(st) for st in pool.states], prev and prev.states),
+            (tuple(pool.live), len(pool.graveyard), tuple(pool.free), pool.spawned),
+            (tuple(fx.heap), fx.seq),
+            (tuple(queue.heap), queue.seq, tuple(queue.units.items())),
+            log.total))
+
+    def can_rewind(self):
+        return len(self.snaps) > 1 and (self.charges is None or self.charges > 0)
+
+    def rewind(self, positions):
+        """
+        Undo the last hero turn: restore the snapshot before the current one (which it drops, since the
+        fight loop takes it again on the way back in). Returns the turn to carry on from.
+        """
+        self.snaps.pop()
+        snap = self.snaps.pop()
+        if self.charges is not None:
+            self.charges -= 1
+        for hero, (hp, mana, threat, downed, facing, effects, inventory, equipment) in zip(self.party, snap.heroes):
+            hero.hp, hero.mana, hero.threat, hero.downed, hero.facing = hp, mana, threat, downed, facing
+            hero.effects.clear()
+            hero.effects.update(_thaw(effects))
+            if list(hero.inventory) != list(inventory):
+                hero.inventory.clear()
+                hero.inventory.extend(inventory)
+            hero.equipment = dict(equipment)
+        pool = self.enemies
+        for slot, unit, st, state in zip(pool, snap.units, pool.states, snap.states):
+            slot.clear()
+            slot.update(_thaw(unit))
+            st.clear()
+            st.update(_thaw(state))
+        live, dead, free, spawned = snap.pool
+        pool.live = {i: pool[i] for i in live}
+        del pool.graveyard[dead:]
+        pool.free, pool.spawned = list(free), spawned
+        self.effects.heap, self.effects.seq = list(snap.effects[0]), snap.effects[1]
+        self.queue.heap, self.queue.seq, self.queue.units = list(snap.queue[0]), snap.queue[1], dict(snap.queue[2])
+        positions[:] = snap.positions
+        self.log.truncate(snap.log_total)
+        return snap.turn
+
+def combat_sequence(ui, player, area, enemies=None):
+    # spawn enemies (unless the caller already rolled the encounter, e.g. after declining auto-resolve)
+    # If area is a dict, use its name. If it's just a string, use it directly.
+    state = {"area_name": area["name"] if isinstance(area, dict) else area}
+    terrain = get_terrain(area)
+    # the leader plus any hired companions; positions[i] is party[i]'s tile
+    party = [player] + player.companions
+    positions = party_start_positions(terrain, len(party))
+    if enemies is None:
+        enemies = spawn_enemies(area, positions[0], director=player.director)
+    messages = CombatLog()
+    messages.append(f"Encounter: {', '.join(e['name'] for e in enemies)}")
+    start_hp = sum(h.hp for h in party)
+    max_hp = sum(h.max_hp for h in party)
+    enemies = UnitPool(enemies)
+    enemy_states = enemies.states
+    turn = 1
+    effects = EffectScheduler()
+    for hero in party:
+        hero.effects.clear()
+        hero.threat = 0  # damage dealt this fight; enemies go after whoever hurts them most
+        hero.downed = False
+
+    queue = InitiativeQueue()
+    for h, hero in enumerate(party):
+        queue.add(("hero", h), hero.agility, rank=h)
+    sync_initiative(queue, enemies, 0)
+    history = CombatHistory(party, enemies, effects, queue, messages)
+    ui.mark("fight", state["area_name"])
+
+    while True:
+        # check victory
+        if enemies.all_dead() and any(h.hp > 0 for h in party):
             messages.append("All foes defeated!")
             # reward
-            loot = random.choice(area["loot"])
-            player.inventory.append(loot)
-            g = random.randint(8, 30)
-            xp = random.randint(8, 20)
-            player.gold += g
-            player.exp += xp
-            messages.append(f"Found {ITEMS[loot]['name']} and {g} gold (+{xp} XP)!")
+            award_victory(player, area, messages, enemies.graveyard)
+            player.director.record_fight(turn, start_hp - sum(max(0, x.hp) for x in party), max_hp, "won")
+            stats_fight(player, state["area_name"], "won", turn, start_hp - sum(max(0, x.hp) for x in party), len(party))
+            ui.on_resize = None
+            revive_party(party)
             ui.draw_hud(player, messages)
             ui.refresh()
-            time.sleep(2.5)
+            ui.pause(2.5)
+            ui.flush_input()  # combat keys still queued mean nothing to the menus
             return True
 
-        # Enemies take turns with smarter AI
-        for idx, e in enumerate(enemies):
-            if e["hp"] <= 0:
-                continue
-            enemy_ai_move_and_act(idx, e, enemy_states[idx], player, player_pos, enemies, ui, messages)
-            # if enemy attacked and player was defending, reduce damage
-            if defending and messages:
-                # last message likely an enemy hit (crudely), reduce last damage by half
-                # (we already reduced damage when computing in AI not knowing defending state — for simplicity, we apply a textual effect)
-                messages.append("Your defense absorbed some damage.")
-                defending = False
-
         # check player death
-        if player.hp <= 0:
-            # clear messages and redraw HUD so the screen is clean
-            messages.clear()
+        if all(h.hp <= 0 for h in party):
+            messages.append("You were slain...")
             ui.clear()
-            ui.draw_grid(player_pos, enemies)
-            ui.draw_hud(player, ["You were slain..."])
+            ui.draw_grid(positions[0], enemies, terrain)
+            ui.draw_hud(player, messages, turn)
             ui.refresh()
-            time.sleep(2.5)
+            player.director.record_fight(turn, start_hp, max_hp, "died")
+            stats_fight(player, state["area_name"], "died", turn, start_hp, len(party))
+            ui.on_resize = None
+            ui.pause(2.5)
+            ui.flush_input()
             return None
 
+        now, key = queue.peek()
+        if now >= turn * TURN_TICKS:
+            # loop end
+            # Wizard passive: restore 1 mana per turn
+            for hero in party:
+                if hero.hp > 0 and hero.passive == "arcane" and hero.mana < hero.magic * 2:
+                    hero.mana += 1
+                    messages.append(f"Arcane energy restores 1 mana{'' if hero is player else ' to ' + hero.name}.")
+            turn += 1
+            # expire / tick whatever status effects are due this turn
+            effects.process(turn, messages)
+            enemies.reap(player, positions[0], messages, terrain, party_members(party, positions, 0))
+            sync_initiative(queue, enemies, now)
+            continue
+        if key[0] == "hero" and party[key[1]].hp > 0:
+            history.push(turn, positions, messages)
+        queue.pop()
+
+        if key[0] == "hero":
+            h = key[1]
+            hero = party[h]
+            if hero.hp <= 0:
+                continue
+            allies = party_members(party, positions, h)
+            ui.mark("turn", turn)
+            messages.append(f"========= Turn {turn}" + (f" — {hero.name}" if len(party) > 1 else ""))
+            upcoming = [initiative_name(k, party, enemies) for k in queue.preview(INITIATIVE_PREVIEW)]
+            odds = None
+            state["can_rewind"] = history.can_rewind()
+            alive = live_items(enemies)
+            if DUEL_ODDS_READOUT and len(party) == 1 and len(alive) == 1:
+                i, foe = alive[0]
+                odds = duel_readout(hero, foe, manhattan(positions[h], foe["pos"]), effects, now, enemy_states[i].get("raged"))
+
+            def repaint(hero=hero, pos=positions[h], allies=allies, upcoming=upcoming, odds=odds):
+                ui.clear()
+                ui.draw_grid(pos, enemies, terrain, allies)
+                ui.draw_hud(hero, messages, turn, party, player)
+                ui.draw_initiative(upcoming, odds)
+                prompt = ui.pane("prompt")
+                prompt.addstr(0, 0, f"Turn {turn}: WASD/arrows move, : queue, l log" + (", u undo" if state["can_rewind"] else ""))
+                prompt.addstr(1, 0, "1 Atk 2 Def 3 Magic 4 Item m Move r Run p Pass")
+
+            repaint()
+            ui.on_resize = repaint
+            ui.refresh()
+            positions[h], fled = hero_turn(ui, hero, positions[h], player, enemies, terrain, effects, turn, messages,
+                                           state, {pos for _, pos in allies})
+            if state.pop("rewind", False):
+                turn = history.rewind(positions)
+                messages.append(f"Rewound to turn {turn}.")
+                continue
+            if fled:
+                player.director.record_fight(turn, start_hp - sum(max(0, x.hp) for x in party), max_hp, "fled")
+                stats_fight(player, state["area_name"], "fled", turn, start_hp - sum(max(0, x.hp) for x in party), len(party))
+                ui.on_resize = None
+                revive_party(party)
+                ui.flush_input()
+                return False
+        else:
+            # Enemies take turns with smarter AI (units summoned mid-turn join the queue a full delay later)
+            _, idx, uid = key
+            e = enemies[idx]
+            if e["hp"] <= 0 or e.get("id") != uid:
+                queue.remove(key)
+                continue
+            standing = [i for i, h in enumerate(party) if h.hp > 0]
+            field = None
+            if len(standing) > 1:
+                # one multi-source search from every standing hero serves both targeting and movement
+                field = party_distance_field(terrain, tuple(positions[i] for i in standing))
+            t = pick_target(e, party, positions, field)
+            positions[t] = enemy_ai_move_and_act(idx, e, enemy_states[idx], party[t], positions[t], enemies, ui, messages,
+                                                 terrain, effects, turn, party_members(party, positions, t), field)
+            for hero in party:
+                if hero.hp <= 0 and not hero.downed and len(party) > 1:
+                    hero.downed = True
+                    messages.append(f"{unit_name(hero)} {'are' if hero is player else 'is'} down!")
+
+        # cleanup dead enemies (death blasts, splits) and let newcomers into the order
+        enemies.reap(player, positions[0], messages, terrain, party_members(party, positions, 0))
+        sync_initiative(queue, enemies, now)
+
+# -------------------- Headless simulation & auto-resolve --------------------
+OUTCOME_TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "outcome_tables.json")
+OUTCOME_TABLE_AREAS = ["goblin_forest", "royal_arena"]
+LEVEL_BUCKETS = [1, 3, 5, 7]  # lower bound of each bucket; tables are built at the bucket floor
+# representative gear per equipment tier (tier = weapon atk + armor def, bucketed)
+TIER_GEAR = [
+    {},
+    {"weapon": "iron_sword", "armor": "leather_armor"},
+    {"weapon": "royal_sword", "armor": "steel_armor"},
+    {"weapon": "royal_blade", "armor": "steel_armor"},
+]
+AUTO_RESOLVE_MIN_WIN = 0.97   # only offer auto-resolve for fights we basically can't lose
+AUTO_RESOLVE_MAX_LOSS = 0.5   # ...and that cost less than half the current HP
+SIM_TURN_LIMIT = 200
+
+def level_bucket(level):
+    bucket = 0
+    for i, floor in enumerate(LEVEL_BUCKETS):
+        if level >= floor:
+            bucket = i
+    return bucket
+
+def equipment_tier(player):
+    total = 0
+    for slot in ("weapon", "armor"):
+        eff = ITEMS.get(player.equipment.get(slot), {}).get("effect", (None, None))
+        if isinstance(eff[1], dict):
+            total += eff[1].get("atk", 0) + eff[1].get("def", 0)
+    if total == 0:
+        return 0
+    if total <= 4:
+        return 1
+    if total <= 7:
+        return 2
+    return 3
+
+def encounter_key(area, enemies):
+    return area["id"] + ":" + "+".join(sorted(e.get("key", e["id"]) for e in enemies))
+
+def outcome_key(player, area, enemies):
+    return f"{level_bucket(player.level)}|{player.pclass}|{equipment_tier(player)}|{encounter_key(area, enemies)}"
+
+def make_sim_player(pclass, level, tier):
+    p = Player("Sim", pclass)
+    for _ in range(level - 1):
+        apply_level_gain(p)
+    p.equipment = dict(TIER_GEAR[tier])
+    return p
+
+def simulate_combat(player, area, enemies=None, terrain=None):
+    """
+    Play one fight headlessly with a simple bot (approach, attack, heal when low, Firebolt groups).
+    Works on copies; returns (won, hp_lost, turns).
+    """
+    player = deepcopy(player)
+    terrain = terrain or get_terrain(area)
+    player_pos = PLAYER_START
+    enemies = UnitPool(deepcopy(enemies) if enemies is not None else spawn_enemies(area, player_pos))
+    enemy_states = enemies.states
+    effects = EffectScheduler()
+    player.effects = {}
+    start_hp = player.hp
+    messages = []
+
+    def step_toward(pos, goal):
+        nxt = find_path_around(enemies, pos, goal, terrain)
+        if nxt == goal or not terrain.passable(nxt) or enemy_at(enemies, nxt):
+            return pos
+        spike = enter_tile(terrain, nxt)
+        if spike:
+            player.hp -= spike
+        return nxt
+
+    queue = InitiativeQueue()
+    queue.add(("hero", 0), player.agility)
+    sync_initiative(queue, enemies, 0)
+    turn = 1
+    while turn <= SIM_TURN_LIMIT:
+        if player.hp <= 0:
+            return False, start_hp, turn
+        if enemies.all_dead():
+            return True, start_hp - player.hp, turn
+        now, key = queue.peek()
+        if now >= turn * TURN_TICKS:
+            if player.passive == "arcane" and player.mana < player.magic * 2:
+                player.mana += 1
+            turn += 1
+            effects.process(turn, messages)
+            enemies.reap(player, player_pos, messages, terrain)
+            sync_initiative(queue, enemies, now)
+            messages.clear()
+            continue
+        queue.pop()
+
+        if key[0] == "enemy":
+            _, idx, uid = key
+            e = enemies[idx]
+            if e["hp"] <= 0 or e.get("id") != uid:
+                queue.remove(key)
+                continue
+            player_pos = enemy_ai_move_and_act(idx, e, enemy_states[idx], player, player_pos, enemies, None, messages, terrain, effects, turn)
+            enemies.reap(player, player_pos, messages, terrain)
+            sync_initiative(queue, enemies, now)
+            continue
+
+        alive = live_items(enemies)
+        nearest = min(alive, key=lambda ie: manhattan(player_pos, ie[1]["pos"]))[1]
+        stunned = effects.has(player, "stunned")
+        rooted = stunned or effects.has(player, "rooted")
+        if manhattan(player_pos, nearest["pos"]) > 1 and not rooted:
+            player_pos = step_toward(player_pos, nearest["pos"])
+        adjacent = [(i, e) for i, e in alive if manhattan(player_pos, e["pos"]) == 1]
+        in_blast = spell_targets("firebolt", player_pos, player.facing, enemies)
+
+        if stunned:
+            pass
+        elif player.hp < player.max_hp * 0.4 and player.mana >= SPELLS["heal"]["cost"]:
+            cast_spell(player, "heal", player_pos, enemies, effects, [])
+        elif len(in_blast) >= 2 and player.mana >= SPELLS["firebolt"]["cost"]:
+            cast_spell(player, "firebolt", player_pos, enemies, effects, [])
+        elif adjacent:
+            idx, target = min(adjacent, key=lambda ie: ie[1]["hp"])
+            if not effects.consume(target, "phased") and not effects.has(target, "invisible"):
+                target["hp"] -= player_attack_damage(player, target, roll(20))
+        elif terrain.tile(player_pos) != "~" and not rooted:
+            # move again
+            player_pos = step_toward(player_pos, nearest["pos"])
+
+        enemies.reap(player, player_pos, messages, terrain)
+        sync_initiative(queue, enemies, now)
+    return False, start_hp - player.hp, SIM_TURN_LIMIT
+
+def _table_compositions(area):
+    """Every encounter spawn_enemies can roll in this area, as sorted enemy-key tuples."""
+    comps = set()
+    if area["name"] != "Goblin Forest":
+        comps.update((k,) for k in ELITE_POOL + ELITE_EXTRAS)
+    for n in (2, 3):
+        comps.update(combinations_with_replacement(sorted(area["encounters"]), n))
+    return sorted(comps)
+
+def build_outcome_tables(path=OUTCOME_TABLE_PATH, sims=40, area_ids=None, seed=2025):
+    """
+    Offline: simulate every (level bucket, class, equipment tier, composition) cell and write the
+    compact lookup file used by auto-resolve. Each composition stores a flat row of
+    [win rate in permille, mean HP lost] pairs in bucket -> class -> tier order.
+    """
+    random.seed(seed)
+    comps = {}
+    for area_id in area_ids or OUTCOME_TABLE_AREAS:
+        area = next(a for a in AREAS if a["id"] == area_id)
+        for keys in _table_compositions(area):
+            row = []
+            for level in LEVEL_BUCKETS:
+                for pclass in CLASSES:
+                    for tier in range(len(TIER_GEAR)):
+                        player = make_sim_player(pclass, level, tier)
+                        wins = 0
+                        lost = 0
+                        for _ in range(sims):
+                            enemies = spawn_enemies(area, PLAYER_START, keys=list(keys))
+                            won, hp_lost, _ = simulate_combat(player, area, enemies)
+                            wins += won
+                            lost += hp_lost
+                        row += [round(1000 * wins / sims), round(lost / sims)]
+            comps[area["id"] + ":" + "+".join(keys)] = row
+    data = {"version": 1, "sims": sims, "buckets": LEVEL_BUCKETS, "classes": list(CLASSES),
+            "tiers": len(TIER_GEAR), "comps": comps}
+    with open(path, "w") as f:
+        json.dump(data, f, separators=(",", ":"))
+    return comps
+
+_OUTCOME_TABLE = None
+
+def load_outcome_tables(path=OUTCOME_TABLE_PATH):
+    """Expand the shipped lookup file into a flat {outcome_key: (win permille, hp loss)} dict, once."""
+    global _OUTCOME_TABLE
+    if _OUTCOME_TABLE is None:
+        _OUTCOME_TABLE = {}
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return _OUTCOME_TABLE
+        cells = [(b, pclass, tier) for b in range(len(data["buckets"]))
+                 for pclass in data["classes"] for tier in range(data["tiers"])]
+        for comp, row in data["comps"].items():
+            for n, (b, pclass, tier) in enumerate(cells):
+                _OUTCOME_TABLE[f"{b}|{pclass}|{tier}|{comp}"] = (row[2 * n], row[2 * n + 1])
+    return _OUTCOME_TABLE
+
+def lookup_outcome(player, area, enemies):
+    """(win probability, expected HP loss) for this fight, or None if it isn't tabled."""
+    row = load_outcome_tables().get(outcome_key(player, area, enemies))
+    if row is None:
+        return None
+    return row[0] / 1000.0, row[1]
+
+def is_trivial_fight(player, area, enemies):
+    if any(e.get("hp_scale", 1.0) > 1.0 for e in enemies):
+        return None  # the director beefed this one up; the tables would be optimistic
+    odds = lookup_outcome(player, area, enemies)
+    if odds is None:
+        return None
+    win_p, hp_loss = odds
+    if win_p >= AUTO_RESOLVE_MIN_WIN and hp_loss < player.hp * AUTO_RESOLVE_MAX_LOSS:
+        return odds
+    return None
+
+def auto_resolve(player, area, odds, messages, enemies=()):
+    """
+    Resolve a tabled fight instantly. Returns True on a win (HP loss, loot and XP applied),
+    or False if the roll goes against the player and the fight has to be played out.
+    """
+    win_p, hp_loss = odds
+    if random.random() >= win_p:
+        messages.append("The skirmish turns against you — fight it out!")
+        return False
+    player.hp = max(1, player.hp - int(round(hp_loss)))
+    messages.append(f"Auto-resolved: you win, losing {int(round(hp_loss))} HP.")
+    stats_fight(player, area["name"], "won", 0, int(round(hp_loss)), auto=True)
+    award_victory(player, area, messages, enemies)
+    return True
+
+# -------------------- Duel solver --------------------
+DUEL_MAX_DIST = GRID_ROWS + GRID_COLS - 2
+DUEL_TOLERANCE = 1e-12
+DUEL_MAX_SWEEPS = 10000
+DUEL_HP_BASE = 10 ** 6  # stand-in hero HP when tabulating moves as damage deltas
+BURN_DAMAGE = 2 * STATUS_EFFECTS["burning"]["tick"]  # a fresh burn ticks on each of the next two turns
+DUEL_ODDS_READOUT = False  # show exact 1v1 odds in the combat HUD (--odds)
+
+def _damage_table(fn):
+    """[(damage, probability)] of fn(roll) over a d20, equal damages merged."""
+    table = {}
+    for r in range(1, 21):
+        d = fn(r)
+        table[d] = table.get(d, 0.0) + 0.05
+    return sorted(table.items())
+
+def initiative_cycle(hero_delay, enemy_delay):
+    """
+    One period of InitiativeQueue's order for a hero and a single enemy: (actors, gaps, ticks), where
+    actors[i] is "hero" or "enemy", gaps[i] is the ticks from that action to the next and ticks[i] is
+    when it happens within the period. The hero acts first on ties, as it does in the queue.
+    """
+    period = hero_delay * enemy_delay // gcd(hero_delay, enemy_delay)
+    times = sorted([(t, 0) for t in range(hero_delay, period + 1, hero_delay)] +
+                   [(t, 1) for t in range(enemy_delay, period + 1, enemy_delay)])
+    actors = [("hero", "enemy")[who] for _, who in times]
+    gaps = [b[0] - a[0] for a, b in zip(times, times[1:])] + [period + times[0][0] - times[-1][0]]
+    return actors, gaps, [t for t, _ in times]
+
+class DuelModel:
+    """
+    One hero against one enemy on open ground, as a Markov chain over
+    (hero HP, enemy HP, distance, evade, stunned, charging, rage, phase). `phase` is the position in
+    the initiative cycle, so who acts next is exactly what the queue would pick. The hero plays
+    simulate_combat's bot without its spells (close in, then strike) and the enemy plays
+    enemy_ai_move_and_act with the same d20 damage. Timed effects are counted in actions rather
+    than turns to keep the chain small: a burn is charged up front, invisibility covers the next
+    two swings, a stun costs one action and rage lasts three enemy actions.
+
+    solve() fills in, for every reachable state, the win probability and the expected ticks until
+    the last action. It works through states in order of rising HP, one (hero HP, enemy HP) block
+    at a time, since damage only ever lowers HP. Within a block, moves, evasions and misses cycle
+    through the phases, so each block is iterated to convergence.
+    """
+
+    def __init__(self, player, enemy):
+        if enemy.get("splits_into") or enemy.get("summons"):
+            raise ValueError(f"{enemy['name']} doesn't fight alone")
+        if enemy.get("key") in BOSS_BRAINS:
+            raise ValueError(f"{enemy['name']} follows a boss script")
+        self.player, self.enemy = player, enemy
+        self.special = enemy.get("special")
+        self.range = enemy.get("range", 1)
+        self.max_e = enemy.get("max_hp", enemy["hp"])
+        self.actors, self.gaps, self.cycle_ticks = initiative_cycle(action_delay(player.agility), action_delay(enemy["agility"]))
+        self.hero_hits = _damage_table(lambda r: player_attack_damage(player, enemy, r))
+        self._enemy_hits, self._move_cache = {}, {}
+        self.win, self.ticks = {}, {}
+        self.solver = None  # background thread filling in states for the HUD readout
+
+    def enemy_hits(self, enraged, charging, slam):
+        key = (enraged, charging, slam)
+        if key not in self._enemy_hits:
+            self._enemy_hits[key] = _damage_table(
+                lambda r: enemy_hit_damage(self.enemy, self.player, r, enraged=enraged, charging=charging, slam=slam))
+        return self._enemy_hits[key]
+
+    def start(self, dist, hp=None, enemy_hp=None):
+        return (self.player.hp if hp is None else hp, self.enemy["hp"] if enemy_hp is None else enemy_hp,
+                max(1, min(dist, DUEL_MAX_DIST)), 0, 0, 0, 0, 0)
+
+    def _hero(self, s):
+        p, e, d, ev, st, ch, rg = s
+        if st:
+            return [(1.0, (p, e, d, ev, 0, ch, rg))]
+        if d >= 3:
+            return [(1.0, (p, e, d - 2, ev, st, ch, rg))]
+        if ev:
+            return [(1.0, (p, e, 1, ev - 1, st, ch, rg))]
+        return [(pr, (p, e - dmg, 1, ev, st, ch, rg)) for dmg, pr in self.hero_hits]
+
+    def _enemy(self, s):
+        p, e, d, ev, st, ch, rg = s
+        sp = self.special
+        out = []
+        evade = {"phase": (0.2, 1), "invis": (0.25, 2)}.get(sp)
+        if evade and not ev:
+            branches = [(evade[0], evade[1]), (1 - evade[0], 0)]
+        else:
+            branches = [(1.0, ev)]
+        if sp == "rage" and rg == 0 and e <= self.max_e // 2:
+            rg = 3
+        for pr, ev2 in branches:
+            out += self._enemy_act(pr, p, e, d, ev2, st, ch, rg)
+        return out
+
+    def _enemy_act(self, pr, p, e, d, ev, st, ch, rg):
+        sp = self.special
+        left = -1 if rg == 1 else (rg - 1 if rg > 0 else rg)  # rage counts down, then is spent
+        if self.range > 1:
+            # kiting: up close it backs off and steps straight back in; farther out it closes one tile
+            d2, moved = (d if d <= 2 else d - 1), True
+            if d2 > self.range:
+                return [(pr, (p, e, d2, ev, st, ch, left))]
+            out = [(pr * 0.5, (p, e, d2, ev, st, ch, left))]  # ranged units that moved hold fire half the time
+            pr *= 0.5
+        else:
+            moved = d > 1
+            steps = 2 if sp == "charge" and d >= 3 else 1
+            d2 = max(1, d - steps) if moved else d
+            if steps == 2 and moved:
+                ch = 1
+            if d2 > 1:
+                return [(pr, (p, e, d2, ev, st, ch, left))]
+            out = []
+            if e < max(6, self.enemy.get("atk", 5)):
+                out.append((pr * 0.4, (p, e, 2, ev, st, ch, left)))  # wounded melee units back off
+                pr *= 0.6
+        hits = self.enemy_hits(rg > 0, bool(ch), sp == "slam" and moved and d2 == 1)
+        for dmg, hp_pr in hits:
+            q = pr * hp_pr
+            if sp == "stun":
+                out.append((q * 0.35, (p - dmg, e, d2, ev, 1, 0, left)))
+                out.append((q * 0.65, (p - dmg, e, d2, ev, st, 0, left)))
+            elif sp in ("fire", "fire_breath"):
+                out.append((q * 0.4, (p - dmg - BURN_DAMAGE, e, d2, ev, st, 0, left)))
+                out.append((q * 0.6, (p - dmg, e, d2, ev, st, 0, left)))
+            else:
+                out.append((q, (p - dmg, e, d2, ev, st, 0, left)))
+        return out
+
+    def _moves(self, actor, e, rest):
+        """
+        One actor's outcomes as merged [(hero damage, enemy damage, rest of next state, probability)].
+        HP only matters through the enemy's rage and retreat thresholds, so these are shared widely.
+        """
+        key = (actor, e <= self.max_e // 2, e < max(6, self.enemy.get("atk", 5)), rest)
+        moves = self._move_cache.get(key)
+        if moves is None:
+            base = (DUEL_HP_BASE, e) + rest
+            merged = {}
+            for pr, t in (self._hero if actor == "hero" else self._enemy)(base):
+                k = (DUEL_HP_BASE - t[0], e - t[1], t[2:])
+                merged[k] = merged.get(k, 0.0) + pr
+            moves = self._move_cache[key] = [k + (pr,) for k, pr in merged.items()]
+        return moves
+
+    def transitions(self, s):
+        """[(next state, probability)] for one action; a side at 0 HP ends it as "win" or "loss"."""
+        p, e, ph = s[0], s[1], s[7]
+        nxt = (ph + 1) % len(self.actors)
+        out = []
+        for dp, de, rest, pr in self._moves(self.actors[ph], e, s[2:7]):
+            if e <= de:
+                out.append(("win", pr))
+            elif p <= dp:
+                out.append(("loss", pr))
+            else:
+                out.append(((p - dp, e - de) + rest + (nxt,), pr))
+        return out
+
+    def solve(self, starts):
+        """Win probability and expected ticks left for every state reachable from `starts`."""
+        win, ticks = self.win, self.ticks
+        win["win"], win["loss"], ticks["win"], ticks["loss"] = 1.0, 0.0, 0.0, 0.0
+        edges, stack = {}, [s for s in starts if s not in win]
+        while stack:
+            s = stack.pop()
+            if s in edges or s in win:
+                continue
+            edges[s] = self.transitions(s)
+            stack += [t for t, _ in edges[s] if t not in edges and t not in win]
+        blocks = {}
+        for s in edges:
+            blocks.setdefault((s[0], s[1]), []).append(s)
+        cap = SIM_TURN_LIMIT * TURN_TICKS
+        for key in sorted(blocks, key=lambda pe: pe[0] + pe[1]):
+            # later phases first, so one sweep carries most values around the cycle
+            block = sorted(blocks[key], key=lambda s: (-s[7], s[2:7]))
+            rows, inside = [], set(block)
+            for s in block:
+                gap = self.gaps[s[7]]
+                w = t_left = 0.0
+                inner = []
+                for t, pr in edges[s]:
+                    if t in inside:
+                        inner.append((t, pr))
+                    elif t in ("win", "loss"):
+                        w += pr * win[t]
+                    else:  # already solved: everything leaving the block is folded in once
+                        w += pr * win[t]
+                        t_left += pr * (gap + ticks[t])
+                rows.append((s, w, t_left, gap, inner))
+                win[s], ticks[s] = 0.0, 0.0
+            for _ in range(DUEL_MAX_SWEEPS):
+                delta = 0.0
+                for s, w, t_left, gap, inner in rows:
+                    for t, pr in inner:
+                        w += pr * win[t]
+                        t_left += pr * (gap + ticks[t])
+                    t_left = min(t_left, cap)  # nobody can ever land a hit: a stalemate
+                    delta = max(delta, abs(w - win[s]), abs(t_left - ticks[s]) / TURN_TICKS)
+                    win[s], ticks[s] = w, t_left
+                if delta < DUEL_TOLERANCE:
+                    break
+        return self
+
+    def phase_at(self, now, actor):
+        """Phase of `actor`'s action at tick `now`, falling back to its first slot if the clocks disagree."""
+        t = (now - 1) % self.cycle_ticks[-1] + 1
+        for ph, (who, tick) in enumerate(zip(self.actors, self.cycle_ticks)):
+            if who == actor and tick == t:
+                return ph
+        return self.actors.index(actor)
+
+    def odds(self, state):
+        """(win probability, expected turns) from a state, solving whatever isn't known yet."""
+        if state not in self.win:
+            self.solve([state])
+        # the fight ends on the turn its last action falls in
+        return self.win[state], (self.cycle_ticks[state[7]] + self.ticks[state]) / TURN_TICKS + 0.5
+
+def spawn_distances(player_pos=PLAYER_START):
+    """{distance: share} over the tiles spawn_enemies places enemies on, for an open arena."""
+    cells = [(r, c) for r in range(GRID_ROWS) for c in range(GRID_COLS // 2, GRID_COLS) if (r, c) != player_pos]
+    shares = {}
+    for cell in cells:
+        d = manhattan(cell, player_pos)
+        shares[d] = shares.get(d, 0.0) + 1 / len(cells)
+    return shares
+
+_DUEL_MODELS = {}
+
+def _duel_signature(player, enemy):
+    gear = tuple(sorted(player.equipment.items()))
+    return (player.agility, player.strength, player.passive, gear,
+            tuple(sorted((k, v) for k, v in enemy.items() if k not in ("hp", "pos", "id", "effects", "taunts"))))
+
+def duel_model(player, enemy):
+    """Solved-as-needed DuelModel for this matchup; shared by every query with the same stats."""
+    key = _duel_signature(player, enemy)
+    model = _DUEL_MODELS.get(key)
+    if model is None:
+        model = _DUEL_MODELS[key] = DuelModel(player, enemy)
+    return model
+
+def duel_odds(player, enemy, dist=None, hp=None, enemy_hp=None):
+    """
+    Exact (win probability, expected turns) for a 1v1 under DuelModel. With no distance given it
+    averages over where spawn_enemies can place the enemy.
+    """
+    model = duel_model(player, enemy)
+    if dist is not None:
+        return model.odds(model.start(dist, hp, enemy_hp))
+    shares = spawn_distances()
+    model.solve([model.start(d, hp, enemy_hp) for d in shares])
+    found = [(share, model.odds(model.start(d, hp, enemy_hp))) for d, share in shares.items()]
+    return sum(s * w for s, (w, _) in found), sum(s * t for s, (_, t) in found)
+
+def duel_readout(hero, enemy, dist, effects, now, raged=False):
+    """
+    HUD text with the live odds of a 1v1, e.g. "Win 87%, ~5 turns left". A state the model hasn't seen is
+    solved on a background thread, so the first look at a big matchup just says so instead of stalling.
+    """
+    try:
+        model = duel_model(hero, enemy)
+    except ValueError:
+        return None
+    evade = 2 if effects.has(enemy, "invisible") else int(effects.has(enemy, "phased"))
+    rage = 3 if effects.has(enemy, "enraged") else (-1 if raged else 0)
+    state = (hero.hp, enemy["hp"], max(1, min(dist, DUEL_MAX_DIST)), evade, int(effects.has(hero, "stunned")),
+             int(effects.has(enemy, "charging")), rage, model.phase_at(now, "hero"))
+    if model.solver and model.solver.is_alive():
+        return "Odds: solving..."
+    if state not in model.win:
+        # the player doesn't walk the bot's path, so cover every distance at this HP in one go
+        starts = [state[:2] + (d,) + state[3:] for d in range(1, DUEL_MAX_DIST + 1)]
+        model.solver = threading.Thread(target=model.solve, args=(starts,), daemon=True)
+        model.solver.start()
+        return "Odds: solving..."
+    return f"Win {model.win[state]:.0%}, ~{model.ticks[state] / TURN_TICKS:.0f} turns left"
+
+def print_duel_odds(enemy_key, pclass="Knight", level=1, tier=0):
+    """--duel: exact odds of a fresh hero against one unscaled enemy, per spawn distance."""
+    player = make_sim_player(pclass, level, tier)
+    enemy = deepcopy(ENEMIES[enemy_key])
+    enemy.update(key=enemy_key, max_hp=enemy["hp"])
+    t0 = time.perf_counter()
+    try:
+        win, turns = duel_odds(player, enemy)
+    except ValueError as exc:
+        print(f"No exact odds: {exc}.")
+        return
+    model = duel_model(player, enemy)
+    print(f"{pclass} Lv{level} (tier {tier} gear, {player.hp} HP) vs {enemy['name']} ({enemy['hp']} HP): "
+          f"win {win:.2%}, {turns:.1f} turns")
+    for d in sorted(spawn_distances()):
+        w, t = model.odds(model.start(d))
+        print(f"  from {d:2} tiles: win {w:.2%}, {t:.1f} turns")
+    print(f"{len(model.win)} states solved in {time.perf_counter() - t0:.2f}s")
+
+# -------------------- Bot environment --------------------
+# Headless reset()/step() wrapper around the combat rules and a straight-line overworld run, for
+# training and evaluating automated players. Observations are flat int16 vectors (NumPy arrays
+# when NumPy is installed, array("h") otherwise), written in place into a buffer each env owns:
+#   GRID_ROWS * GRID_COLS cells: ENV_CELL codes for terrain, ENV_HERO, or ENV_ENEMY + pool slot
+#   hero HP, max HP, mana, area index
+#   HP of every enemy pool slot (0 when empty), so grid codes line up with HP
+#   inventory count of every ITEMS key, in ENV_ITEM_KEYS order
+ENV_MOVES = ("", "w", "a", "s", "d")
+ENV_ACTS = ("attack", "defend", "firebolt", "heal", "potion", "ether", "equip", "run")
+ENV_ACTIONS = [(m, a) for m in ENV_MOVES for a in ENV_ACTS]  # action id -> (move key, action)
+ENV_CELL = {".": 0, "#": 1, "~": 2, "^": 3}
+ENV_GRID_CELLS = GRID_ROWS * GRID_COLS
+ENV_HERO = 4
+ENV_ENEMY = 5
+ENV_ITEM_KEYS = sorted(ITEMS)
+ENV_HP_AT = ENV_GRID_CELLS + 4  # offsets of the enemy HP and inventory count blocks
+ENV_ITEM_AT = {k: ENV_HP_AT + MAX_ENEMY_SLOTS + n for n, k in enumerate(ENV_ITEM_KEYS)}
+ENV_OBS_SIZE = ENV_HP_AT + MAX_ENEMY_SLOTS + len(ENV_ITEM_KEYS)
+ENV_FIGHTS_PER_AREA = 3
+ENV_REWARDS = {"won": 1.0, "died": -1.0, "fled": 0.0, "cleared": 5.0, "dealt": 0.01, "taken": -0.01}
+ENV_DIRS = {"w": (-1, 0), "s": (1, 0), "a": (0, -1), "d": (0, 1)}
+
+def _env_vector(values):
+    """A flat int16 vector (copying `values`): a NumPy array when NumPy is installed, else array("h")."""
+    return np.array(values, dtype=np.int16) if np else array("h", values)
+
+@lru_cache(maxsize=None)
+def _terrain_plane(terrain):
+    return _env_vector([ENV_CELL.get(terrain.tile((r, c)), 0) for r in range(GRID_ROWS) for c in range(GRID_COLS)])
+
+def _gear_bonus(key):
+    stats = ITEMS[key]["effect"][1]
+    return stats.get("atk", 0) + stats.get("def", 0)
+
+class CombatEnv:
+    """
+    One game for a bot. An episode walks the arenas in AREAS order, fighting ENV_FIGHTS_PER_AREA
+    encounters in each and resting to full between fights, as the overworld lets a player do; it
+    ends when the hero dies or the last arena is cleared. A step is one hero turn: an optional
+    W/A/S/D step plus one action from ENV_ACTS (ENV_ACTIONS enumerates the pairs), after which the
+    enemies play until the hero is up again. Damage rolls use the module's `random`, so reset(seed)
+    replays an episode exactly given the same actions. The observation returned is the env's own
+    buffer (`out`, if given), overwritten by the next step: copy it to keep it.
+    """
 
-        # loop end
-        # Wizard passive: restore 1 mana per turn
-        if player.passive == "arcane" and player.mana < player.magic * 2:
-            player.mana += 1
-            messages.append("Arcane energy restores 1 mana.")
-        turn += 1
-        # trim messages to avoid overflow
-        if len(messages) > 40:
-            messages = messages[-40:]
+    def __init__(self, pclass="Knight", areas=None, fights_per_area=ENV_FIGHTS_PER_AREA, out=None):
+        self.pclass = pclass
+        self.areas = areas or AREAS
+        self.fights_per_area = fights_per_area
+        self.messages = []  # the combat rules log here; cleared every step
+        self.obs = out if out is not None else _env_vector([0] * ENV_OBS_SIZE)
+        self.plane = None  # terrain plane currently under the units in self.obs
+        self.marks = []    # grid cells in self.obs holding a unit code
+        self.held = []     # inventory count cells in self.obs that may be non-zero
+
+    def reset(self, seed=None):
+        if seed is not None:
+            random.seed(seed)
+        self.player = Player("Bot", self.pclass)
+        self.area_index = self.fight_no = 0
+        self._start_fight()
+        return self.observe()
+
+    def _start_fight(self):
+        player = self.player
+        player.hp, player.mana = player.max_hp, player.magic * 2
+        player.effects.clear()
+        player.threat = 0
+        self.area = self.areas[self.area_index]
+        self.terrain = get_terrain(self.area)
+        self.pos = party_start_positions(self.terrain, 1)[0]
+        self.enemies = UnitPool(spawn_enemies(self.area, self.pos, director=player.director))
+        self.effects = EffectScheduler()
+        self.queue = InitiativeQueue()
+        self.queue.add(("hero", 0), player.agility)
+        sync_initiative(self.queue, self.enemies, 0)
+        self.turn = 1
+        self._advance()
+
+    def _advance(self):
+        """Play turn boundaries and enemy actions until the hero is up. Returns how the fight ended, if it did."""
+        player, enemies, queue, messages = self.player, self.enemies, self.queue, self.messages
+        while True:
+            if player.hp <= 0:
+                return "died"
+            if enemies.all_dead():
+                return "won"
+            now, key = queue.peek()
+            if now >= self.turn * TURN_TICKS:
+                if player.passive == "arcane" and player.mana < player.magic * 2:
+                    player.mana += 1
+                self.turn += 1
+                if self.turn > SIM_TURN_LIMIT:
+                    return "fled"  # a stalemate counts as walking away
+                self.effects.process(self.turn, messages)
+                enemies.reap(player, self.pos, messages, self.terrain)
+                sync_initiative(queue, enemies, now)
+                continue
+            queue.pop()
+            if key[0] == "hero":
+                return None
+            _, idx, uid = key
+            e = enemies[idx]
+            if e["hp"] <= 0 or e.get("id") != uid:
+                queue.remove(key)
+                continue
+            self.pos = enemy_ai_move_and_act(idx, e, enemies.states[idx], player, self.pos, enemies, None, messages,
+                                             self.terrain, self.effects, self.turn)
+            enemies.reap(player, self.pos, messages, self.terrain)
+            sync_initiative(queue, enemies, now)
+
+    def _hero_act(self, move, act):
+        """hero_turn without the prompts. Returns (fled, damage dealt)."""
+        player, enemies, effects, terrain = self.player, self.enemies, self.effects, self.terrain
+        if effects.has(player, "stunned"):
+            return False, 0
+        if move and not effects.has(player, "rooted"):
+            dr, dc = ENV_DIRS[move]
+            newp = clamp_pos(self.pos[0] + dr, self.pos[1] + dc)
+            if newp != self.pos and terrain.passable(newp) and not enemy_at(enemies, newp):
+                self.pos = newp
+                player.hp -= enter_tile(terrain, newp)
+        dealt = 0
+        if act == "attack":
+            rollv = roll(20)
+            adjacent = [e for e in enemies.live.values() if manhattan(self.pos, e["pos"]) == 1]
+            if adjacent:
+                target = min(adjacent, key=lambda e: e["hp"])
+                if not effects.consume(target, "phased") and not effects.has(target, "invisible"):
+                    dealt = player_attack_damage(player, target, rollv)
+                    target["hp"] -= dealt
+        elif act == "defend":
+            effects.apply(player, "guarding", 1, self.turn)
+        elif act in ("firebolt", "heal"):
+            dealt = cast_spell(player, act, self.pos, enemies, effects, self.messages) or 0
+        elif act in ("potion", "ether"):
+            kind = "heal" if act == "potion" else "mana"
+            for key in player.inventory:
+                if ITEMS[key]["effect"][0] == kind:
+                    player.inventory.remove(key)
+                    player.apply_item(key, {"area_name": self.area["name"]})
+                    break
+        elif act == "equip":
+            # the biggest upgrade in the pack, if there is one
+            def upgrade(key):
+                slot = "weapon" if "atk" in ITEMS[key]["effect"][1] else "armor"
+                worn = player.equipment.get(slot)
+                return _gear_bonus(key) - (_gear_bonus(worn) if worn else 0)
+            gear = [k for k in player.inventory if ITEMS[k]["effect"][0] == "equip" and upgrade(k) > 0]
+            if gear:
+                best = max(gear, key=upgrade)
+                player.inventory.remove(best)
+                player.apply_item(best)
+        elif act == "run":
+            flee_chance = max(10, min(95, 30 + player.agility * 3 - len(enemies.live) * 5))
+            if random.randint(1, 100) <= flee_chance:
+                return True, 0
+        player.threat += dealt
+        return False, dealt
+
+    def _act(self, action):
+        """The hero half of a step. Returns (HP before, fled, damage dealt)."""
+        self.messages.clear()
+        hp = self.player.hp
+        fled, dealt = self._hero_act(*ENV_ACTIONS[action])
+        return hp, fled, dealt
+
+    def _settle(self, hp, dealt, outcome):
+        """Score a played turn and move on to the next fight if this one ended. Returns (reward, done, info)."""
+        player = self.player
+        reward = ENV_REWARDS["dealt"] * dealt + ENV_REWARDS["taken"] * max(0, hp - max(0, player.hp))
+        done = False
+        if outcome:
+            reward += ENV_REWARDS[outcome]
+            player.director.record_fight(self.turn, player.max_hp - max(0, player.hp), player.max_hp, outcome)
+            if outcome == "won":
+                award_victory(player, self.area, self.messages, self.enemies.graveyard)
+                if player.exp >= 20 * player.level:
+                    apply_level_gain(player)
+            if outcome == "died":
+                done = True
+            else:
+                self.fight_no += 1
+                if self.fight_no == self.fights_per_area:
+                    self.area_index, self.fight_no = self.area_index + 1, 0
+                if self.area_index == len(self.areas):
+                    reward += ENV_REWARDS["cleared"]
+                    done = True
+                else:
+                    self._start_fight()
+        info = {"outcome": outcome, "area": self.area["name"], "turn": self.turn, "level": player.level}
+        return reward, done, info
+
+    def step(self, action):
+        """Play one hero turn. Returns (observation, reward, done, info)."""
+        hp, fled, dealt = self._act(action)
+        reward, done, info = self._settle(hp, dealt, "fled" if fled else self._advance())
+        return self.observe(), reward, done, info
+
+    def observe(self):
+        """Bring self.obs up to date, rewriting only the grid cells units left or entered, and return it."""
+        obs, plane = self.obs, _terrain_plane(self.terrain)
+        if plane is not self.plane:
+            obs[:ENV_GRID_CELLS] = plane
+            self.plane = plane
+        else:
+            for j in self.marks:
+                obs[j] = plane[j]
+        marks = self.marks = [self.pos[0] * GRID_COLS + self.pos[1]]
+        obs[marks[0]] = ENV_HERO
+        live = self.enemies.live
+        for i, e in live.items():
+            j = e["pos"][0] * GRID_COLS + e["pos"][1]
+            obs[j] = ENV_ENEMY + i
+            marks.append(j)
+        player, at = self.player, ENV_GRID_CELLS
+        obs[at], obs[at + 1], obs[at + 2], obs[at + 3] = max(0, player.hp), player.max_hp, player.mana, self.area_index
+        for i, e in enumerate(self.enemies):
+            obs[ENV_HP_AT + i] = max(0, e["hp"]) if i in live else 0
+        for j in self.held:
+            obs[j] = 0
+        held = self.held = [ENV_ITEM_AT[k] for k in player.inventory]
+        for j in held:
+            obs[j] += 1
+        return obs
+
+class VectorCombatEnv:
+    """
+    K CombatEnvs stepped in lockstep in one process, each observing into its own row of one
+    preallocated (K, ENV_OBS_SIZE) buffer. step() takes one action per game and returns that buffer
+    (overwritten by the next step), rewards and done flags; a finished game is reset on the spot and
+    a copy of its last observation and its episode return are left in its info dict. All games share
+    the module's `random`, so a seeded batch replays exactly as a whole.
+    """
+
+    def __init__(self, n, pclass="Knight", **kwargs):
+        if np:
+            self.obs = np.zeros((n, ENV_OBS_SIZE), dtype=np.int16)
+        else:
+            self.obs = [_env_vector([0] * ENV_OBS_SIZE) for _ in range(n)]
+        self.envs = [CombatEnv(pclass, out=self.obs[i], **kwargs) for i in range(n)]
+        self.returns = [0.0] * n
+
+    def reset(self, seed=None):
+        if seed is not None:
+            random.seed(seed)
+        self.returns = [0.0] * len(self.envs)
+        for env in self.envs:
+            env.reset()
+        return self.obs
+
+    def step(self, actions):
+        # phase by phase over the batch: every hero acts, then every game's enemies play, then scoring
+        envs = self.envs
+        acted = [env._act(action) for env, action in zip(envs, actions)]
+        outcomes = ["fled" if fled else env._advance() for env, (_, fled, _) in zip(envs, acted)]
+        rewards, dones, infos = [], [], []
+        for i, env in enumerate(envs):
+            hp, _, dealt = acted[i]
+            r, done, info = env._settle(hp, dealt, outcomes[i])
+            o = env.observe()
+            self.returns[i] += r
+            if done:
+                info["final_observation"], info["episode_return"] = _env_vector(o), self.returns[i]
+                self.returns[i] = 0.0
+                env.reset()
+            rewards.append(r)
+            dones.append(done)
+            infos.append(info)
+        if np:
+            return self.obs, np.array(rewards), np.array(dones), infos
+        return self.obs, rewards, dones, infos
+
+def env_benchmark(steps=100000, n_envs=64, seed=0):
+    """Random-action throughput of VectorCombatEnv. Returns (steps, episodes finished, seconds)."""
+    venv = VectorCombatEnv(n_envs)
+    venv.reset(seed)
+    rng = random.Random(seed)
+    episodes = 0
+    start = time.perf_counter()
+    for _ in range(max(1, steps // n_envs)):
+        _, _, dones, _ = venv.step([rng.randrange(len(ENV_ACTIONS)) for _ in range(n_envs)])
+        episodes += sum(dones)
+    return max(1, steps // n_envs) * n_envs, episodes, time.perf_counter() - start
+
+# -------------------- Procedural arenas --------------------
+ARENA_GEN_VERSION = 1  # bump when the generator changes so stale cached layouts are ignored
+ARENA_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "arena_cache")
+ARENA_NAME_PARTS = (
+    ["Ashen", "Whispering", "Sunken", "Howling", "Gilded", "Shattered", "Frozen", "Verdant", "Crimson", "Hollow"],
+    ["Marsh", "Quarry", "Barrows", "Canyon", "Glade", "Ruins", "Steppe", "Catacombs", "Dunes", "Crossing"],
+)
+# units that only ever appear through summons/splits or story fights
+NON_ROLLABLE = {"skeleton", "golemite", "adult_dragon", "baby_dragon"}
+MAX_ARENA_TIER = 5
+
+_ARENA_CACHE = {}
+_ARENA_LOCK = threading.Lock()
+
+def _item_power(key):
+    eff = ITEMS[key]["effect"]
+    if isinstance(eff[1], dict):
+        return 10 * sum(eff[1].values())
+    if isinstance(eff[1], int):
+        return eff[1] * 2
+    return 60  # key items / curios
+
+def _tier_band(ranked, tier, width=0.45):
+    """Slice of a power-sorted list for a tier (1..MAX_ARENA_TIER), with overlap between neighbours."""
+    n = len(ranked)
+    center = (tier - 0.5) / MAX_ARENA_TIER
+    lo = max(0, int((center - width / 2) * n))
+    hi = min(n, max(lo + 3, int((center + width / 2) * n)))
+    return ranked[lo:hi]
+
+def _generate_layout(rng, rows, cols, tier):
+    start = (rows // 2, 1)
+    wall_p = 0.16 + 0.02 * tier
+    grid = [["#" if rng.random() < wall_p else "." for _ in range(cols)] for _ in range(rows)]
+    # one smoothing pass: lone walls crumble, dense clusters fill in
+    smoothed = []
+    for r in range(rows):
+        row = []
+        for c in range(cols):
+            walls = 0
+            for rr in (r - 1, r, r + 1):
+                for cc in (c - 1, c, c + 1):
+                    if (rr, cc) != (r, c) and (not (0 <= rr < rows and 0 <= cc < cols) or grid[rr][cc] == "#"):
+                        walls += 1
+            if walls >= 5:
+                row.append("#")
+            elif walls <= 2:
+                row.append(".")
+            else:
+                row.append(grid[r][c])
+        smoothed.append(row)
+    grid = smoothed
+    # sand drifts: short random walks
+    for _ in range(max(1, rows * cols // 40)):
+        r, c = rng.randrange(rows), rng.randrange(cols)
+        for _ in range(rng.randint(3, 8)):
+            if grid[r][c] == ".":
+                grid[r][c] = "~"
+            r = max(0, min(rows - 1, r + rng.choice((-1, 0, 1))))
+            c = max(0, min(cols - 1, c + rng.choice((-1, 0, 1))))
+    # spikes get denser with tier
+    spike_p = 0.015 * tier
+    for r in range(rows):
+        for c in range(cols):
+            if grid[r][c] == "." and rng.random() < spike_p:
+                grid[r][c] = "^"
+    # keep the player's corner open
+    for r, c in ((start[0], 0), start, (start[0], 2), (start[0] - 1, 1), (start[0] + 1, 1)):
+        if 0 <= r < rows and 0 <= c < cols:
+            grid[r][c] = "."
+    # wall off anything the player can't reach, so every spawn is reachable
+    seen = {start}
+    q = deque([start])
+    while q:
+        r, c = q.popleft()
+        for nxt in ((r - 1, c), (r + 1, c), (r, c - 1), (r, c + 1)):
+            if nxt not in seen and 0 <= nxt[0] < rows and 0 <= nxt[1] < cols and grid[nxt[0]][nxt[1]] != "#":
+                seen.add(nxt)
+                q.append(nxt)
+    for r in range(rows):
+        for c in range(cols):
+            if (r, c) not in seen:
+                grid[r][c] = "#"
+    spawnable = sum(1 for (r, c) in seen if c >= cols // 2)
+    return ["".join(row) for row in grid], spawnable
+
+def generate_arena(seed, tier, rows=GRID_ROWS, cols=GRID_COLS):
+    """Build an area dict (terrain, encounter table, loot table, art) deterministically from (seed, tier)."""
+    tier = max(1, min(MAX_ARENA_TIER, tier))
+    rng = random.Random(f"arena:{ARENA_GEN_VERSION}:{seed}:{tier}:{rows}x{cols}")
+    layout, spawnable = _generate_layout(rng, rows, cols, tier)
+    while spawnable < 6:  # too cramped on the spawn side — reroll from the same stream
+        layout, spawnable = _generate_layout(rng, rows, cols, tier)
+
+    ranked_enemies = sorted((k for k in ENEMIES if k not in NON_ROLLABLE), key=_enemy_power)
+    band = _tier_band(ranked_enemies, tier)
+    encounters = sorted(rng.sample(band, min(len(band), rng.randint(3, 5))))
+    elites = _tier_band(ranked_enemies, min(MAX_ARENA_TIER, tier + 1))
+    ranked_items = sorted(ITEMS, key=_item_power)
+    loot = sorted(rng.sample(_tier_band(ranked_items, tier, width=0.5), 3))
+
+    name = f"{rng.choice(ARENA_NAME_PARTS[0])} {rng.choice(ARENA_NAME_PARTS[1])}"
+    return {
+        "id": f"wilds_{seed}_{tier}_{rows}x{cols}",
+        "name": name,
+        "desc": f"Tier {tier} wilds. Seed {seed}.",
+        "encounters": encounters,
+        "elite_pool": elites,
+        "loot": loot,
+        "scale": round(0.75 + 0.25 * (tier - 1), 2),
+        "terrain": layout,
+        # the art for a generated arena is simply its map
+        "art": ["".join(TERRAIN_TILES[ch]["draw"] for ch in row) for row in layout],
+        "generated": True,
+    }
+
+def _arena_cache_path(seed, tier, rows, cols):
+    return os.path.join(ARENA_CACHE_DIR, f"v{ARENA_GEN_VERSION}_{seed}_{tier}_{rows}x{cols}.json")
+
+def get_arena(seed, tier, rows=GRID_ROWS, cols=GRID_COLS):
+    """Procedural arena by address: memory cache, then disk cache, then generate (and persist)."""
+    key = (seed, tier, rows, cols)
+    with _ARENA_LOCK:
+        if key in _ARENA_CACHE:
+            return _ARENA_CACHE[key]
+    path = _arena_cache_path(seed, tier, rows, cols)
+    try:
+        with open(path) as f:
+            area = json.load(f)
+    except (OSError, ValueError):
+        area = generate_arena(seed, tier, rows, cols)
+        try:
+            os.makedirs(ARENA_CACHE_DIR, exist_ok=True)
+            with open(path, "w") as f:
+                json.dump(area, f, separators=(",", ":"))
+        except OSError:
+            pass  # read-only install: just keep it in memory
+    with _ARENA_LOCK:
+        return _ARENA_CACHE.setdefault(key, area)
+
+def prefetch_arena(seed, tier, rows=GRID_ROWS, cols=GRID_COLS):
+    """Warm the arena cache on a background thread (e.g. while zone art is on screen)."""
+    t = threading.Thread(target=get_arena, args=(seed, tier, rows, cols), daemon=True)
+    t.start()
+    return t
+
+# -------------------- Statistics --------------------
+STATS_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stats.sqlite3")
+STATS_BATCH = 512  # most rows written per transaction
+
+STATS_SCHEMA = """
+PRAGMA journal_mode = WAL;
+CREATE TABLE IF NOT EXISTS runs (
+    id TEXT PRIMARY KEY, started REAL, name TEXT, pclass TEXT,
+    ended REAL, ending TEXT, fights INTEGER DEFAULT 0, level INTEGER, gold INTEGER, flags BLOB);
+CREATE TABLE IF NOT EXISTS fights (
+    run_id TEXT, at REAL, area TEXT, pclass TEXT, level INTEGER, party INTEGER,
+    outcome TEXT, turns INTEGER, hp_lost INTEGER, auto INTEGER);
+CREATE TABLE IF NOT EXISTS trades (run_id TEXT, at REAL, area TEXT, item TEXT, side TEXT, price INTEGER);
+
+-- running totals, kept current by the triggers below so reports never scan the raw tables
+CREATE TABLE IF NOT EXISTS arena_totals (
+    area TEXT PRIMARY KEY, fights INTEGER, won INTEGER, died INTEGER, fled INTEGER, turns INTEGER, hp_lost INTEGER);
+CREATE TABLE IF NOT EXISTS ending_totals (ending TEXT PRIMARY KEY, runs INTEGER, fights INTEGER, level INTEGER);
+CREATE TABLE IF NOT EXISTS item_totals (
+    item TEXT PRIMARY KEY, bought INTEGER, spent INTEGER, sold INTEGER, earned INTEGER);
+
+CREATE TRIGGER IF NOT EXISTS tally_fight AFTER INSERT ON fights BEGIN
+    INSERT INTO arena_totals VALUES (NEW.area, 1, NEW.outcome = 'won', NEW.outcome = 'died',
+                                     NEW.outcome = 'fled', NEW.turns, NEW.hp_lost)
+    ON CONFLICT(area) DO UPDATE SET fights = fights + 1, won = won + excluded.won, died = died + excluded.died,
+        fled = fled + excluded.fled, turns = turns + excluded.turns, hp_lost = hp_lost + excluded.hp_lost;
+    UPDATE runs SET fights = fights + 1 WHERE id = NEW.run_id;
+END;
+CREATE TRIGGER IF NOT EXISTS tally_ending AFTER UPDATE OF ending ON runs
+WHEN OLD.ending IS NULL AND NEW.ending IS NOT NULL BEGIN
+    INSERT INTO ending_totals VALUES (NEW.ending, 1, NEW.fights, NEW.level)
+    ON CONFLICT(ending) DO UPDATE SET runs = runs + 1, fights = fights + excluded.fights, level = level + excluded.level;
+END;
+CREATE TRIGGER IF NOT EXISTS tally_trade AFTER INSERT ON trades BEGIN
+    INSERT INTO item_totals VALUES (NEW.item, NEW.side = 'buy', IIF(NEW.side = 'buy', NEW.price, 0),
+                                    NEW.side = 'sell', IIF(NEW.side = 'sell', NEW.price, 0))
+    ON CONFLICT(item) DO UPDATE SET bought = bought + excluded.bought, spent = spent + excluded.spent,
+        sold = sold + excluded.sold, earned = earned + excluded.earned;
+END;
+"""
+
+class StatsDB:
+    """
+    Per-run, per-fight and per-trade records across every game played, in SQLite. Writes are queued and
+    committed by a background thread in batched transactions, so the game loop never waits on disk;
+    triggers fold each new row into the *_totals tables, so reports read a few dozen rows no matter
+    how many fights have been logged.
+    """
+
+    def __init__(self, path=STATS_DB_PATH):
+        self.path = path
+        conn = sqlite3.connect(path)
+        conn.executescript(STATS_SCHEMA)
+        if "flags" not in {row[1] for row in conn.execute("PRAGMA table_info(runs)")}:
+            conn.execute("ALTER TABLE runs ADD COLUMN flags BLOB")  # databases from before story bitsets
+        conn.close()
+        self.pending = Queue()
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def _write_loop(self):
+        conn = sqlite3.connect(self.path)
+        while True:
+            batch = [self.pending.get()]
+            while batch[-1] is not None and len(batch) < STATS_BATCH:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except Empty:
+                    break
+            with conn:
+                for row in batch:
+                    if row is not None:
+                        conn.execute(*row)
+            if batch[-1] is None:
+                conn.close()
+                return
+
+    def start_run(self, player):
+        run_id = os.urandom(8).hex()
+        self.pending.put(("INSERT INTO runs (id, started, name, pclass) VALUES (?, ?, ?, ?)",
+                          (run_id, time.time(), player.name, player.pclass)))
+        return run_id
+
+    def end_run(self, run_id, player, ending):
+        self.pending.put(("UPDATE runs SET ended = ?, ending = ?, level = ?, gold = ?, flags = ? WHERE id = ? AND ending IS NULL",
+                          (time.time(), ending, player.level, player.gold, StoryFlags(player.flag_bits()).to_bytes(), run_id)))
+
+    def fight(self, run_id, player, area, outcome, turns, hp_lost, party=1, auto=False):
+        self.pending.put(("INSERT INTO fights VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                          (run_id, time.time(), area, player.pclass, player.level, party, outcome, turns, hp_lost, int(auto))))
+
+    def trade(self, run_id, area, item, side, price):
+        self.pending.put(("INSERT INTO trades VALUES (?, ?, ?, ?, ?, ?)", (run_id, time.time(), area, item, side, price)))
+
+    def report(self):
+        return stats_report(self.path)
+
+    def close(self):
+        self.pending.put(None)
+        self.writer.join()
+
+def stats_report(path=STATS_DB_PATH):
+    """The aggregate tables, as {"arenas": [...], "endings": [...], "items": [...]} of row tuples."""
+    conn = sqlite3.connect(path)
+    try:
+        return {
+            "runs": conn.execute("SELECT COUNT(*), COUNT(ending) FROM runs").fetchone(),
+            "arenas": conn.execute("SELECT area, fights, won, died, fled, turns, hp_lost FROM arena_totals "
+                                   "ORDER BY 1.0 * died / fights DESC, fights DESC").fetchall(),
+            "endings": conn.execute("SELECT ending, runs, fights, level FROM ending_totals ORDER BY runs DESC").fetchall(),
+            "items": conn.execute("SELECT item, bought, spent, sold, earned FROM item_totals "
+                                  "ORDER BY bought DESC, sold DESC").fetchall(),
+        }
+    finally:
+        conn.close()
+
+_STATS = None  # the open StatsDB, if this session is being recorded
+
+def open_stats(path=STATS_DB_PATH):
+    global _STATS
+    _STATS = StatsDB(path)
+    return _STATS
+
+def close_stats():
+    global _STATS
+    if _STATS:
+        _STATS.close()
+        _STATS = None
+
+def stats_start_run(player):
+    if _STATS:
+        player.run_id = _STATS.start_run(player)
+
+def stats_end_run(player, ending):
+    if _STATS and player.run_id:
+        _STATS.end_run(player.run_id, player, ending)
+        player.run_id = None  # a run ends once, whichever exit it takes
+
+def stats_fight(player, area, outcome, turns, hp_lost, party=1, auto=False):
+    if _STATS and player.run_id:
+        _STATS.fight(player.run_id, player, area, outcome, turns, hp_lost, party, auto)
+
+def stats_trade(player, area, item, side, price):
+    if _STATS and player.run_id:
+        _STATS.trade(player.run_id, area, item, side, price)
+
+def stats_lines(db=None, top=3):
+    """A few lines of cross-run highlights for the Stats screen."""
+    db = db or _STATS
+    if not db:
+        return []
+    rep = db.report()
+    arenas = ", ".join(f"{a} {died / fights:.0%} of {fights}" for a, fights, _, died, _, _, _ in rep["arenas"][:top])
+    endings = ", ".join(f"{e} x{runs} ({fights / runs:.1f} fights)" for e, runs, fights, _ in rep["endings"][:top])
+    items = ", ".join(f"{ITEMS.get(i, {}).get('name', i)} x{n}" for i, n, _, _, _ in rep["items"][:top] if n)
+    return ["=== All runs ===", f"Deadliest arenas: {arenas or '-'}", f"Endings: {endings or '-'}",
+            f"Most bought: {items or '-'}"]
+
+def print_stats_report(path=STATS_DB_PATH):
+    if not os.path.exists(path):
+        print(f"No statistics recorded yet ({path}).")
+        return
+    rep = stats_report(path)
+    print(f"{rep['runs'][0]} runs ({rep['runs'][1]} finished)\n")
+    print(f"{'Arena':<24}{'fights':>8}{'won':>7}{'died':>7}{'fled':>7}{'death%':>8}{'turns':>7}{'hp lost':>9}")
+    for area, fights, won, died, fled, turns, hp_lost in rep["arenas"]:
+        print(f"{area:<24}{fights:>8}{won:>7}{died:>7}{fled:>7}{died / fights:>8.1%}{turns / fights:>7.1f}{hp_lost / fights:>9.1f}")
+    print(f"\n{'Ending':<24}{'runs':>8}{'fights/run':>12}{'level':>7}")
+    for ending, n, fights, level in rep["endings"]:
+        print(f"{ending:<24}{n:>8}{fights / n:>12.1f}{(level or 0) / n:>7.1f}")
+    print(f"\n{'Item':<24}{'bought':>8}{'spent':>8}{'sold':>7}{'earned':>8}")
+    for item, bought, spent, sold, earned in rep["items"]:
+        print(f"{ITEMS.get(item, {}).get('name', item):<24}{bought:>8}{spent:>8}{sold:>7}{earned:>8}")
+
+# -------------------- Shop --------------------
+SHOP_VALUE_PER_TIER = 25     # a tier-t arena stocks catalogue goods worth up to t * this
+SHOP_STOCK = {"heal": 6, "mana": 6}  # usual units on the shelf, by effect; anything else comes in pairs
+SHOP_GEAR_STOCK = 2
+DEMAND_STEP = 0.12           # each unit a shop is short of (or over) its usual stock moves its prices this much
+SELL_RATIO = 0.5             # shops pay half an item's value...
+PRICE_FLOOR = 0.5            # ...and a glut can't push any price below half of normal
+UNSTOCKED = {"crown_key", "treasure_map"}  # quest items are found, never sold over the counter
+
+def _effect_kind(key):
+    kind = ITEMS[key]["effect"][0]
+    return kind if kind in ("heal", "mana", "equip") else "curio"
+
+def _value_table():
+    """
+    Base value of every item: its catalogue price where it has one, otherwise its power scaled by
+    the going price per point of power among catalogue items with the same kind of effect.
+    """
+    rates = {}
+    for entry in SHOP_ITEMS:
+        rates.setdefault(_effect_kind(entry["id"]), []).append(entry["price"] / _item_power(entry["id"]))
+    values = {}
+    for key in ITEMS:
+        kind_rates = rates.get(_effect_kind(key), [1.0])
+        values[key] = max(1, round(_item_power(key) * sum(kind_rates) / len(kind_rates)))
+    values.update({entry["id"]: entry["price"] for entry in SHOP_ITEMS})
+    return values
+
+ITEM_VALUES = _value_table()
+
+class Shop:
+    """
+    One arena's shop. `usual` is the stock it keeps when left alone; prices rise as the player
+    buys it short of that and fall as the player sells it more than it wants.
+    """
+
+    def __init__(self, name, tier, loot=()):
+        self.name = name
+        self.usual = {}
+        for entry in SHOP_ITEMS:
+            key = entry["id"]
+            if ITEM_VALUES[key] <= tier * SHOP_VALUE_PER_TIER and key not in UNSTOCKED:
+                self.usual[key] = SHOP_STOCK.get(_effect_kind(key), SHOP_GEAR_STOCK)
+        for key in loot:  # the local finds turn up on the shelf too
+            if key not in UNSTOCKED:
+                self.usual.setdefault(key, 1)
+        self.stock = dict(self.usual)
+
+    def _demand(self, key):
+        short = self.usual.get(key, 0) - self.stock.get(key, 0)
+        return max(PRICE_FLOOR, 1 + DEMAND_STEP * short)
+
+    def buy_price(self, key):
+        return max(1, round(ITEM_VALUES[key] * self._demand(key)))
+
+    def sell_price(self, key):
+        return max(1, round(ITEM_VALUES[key] * SELL_RATIO * self._demand(key)))
+
+    def wares(self):
+        """(item, units) on the shelf, cheapest first."""
+        return sorted(((k, n) for k, n in self.stock.items() if n > 0), key=lambda kn: (ITEM_VALUES[kn[0]], kn[0]))
+
+    def buy(self, player, key):
+        price = self.buy_price(key)
+        if self.stock.get(key, 0) <= 0 or player.gold < price:
+            return None
+        player.gold -= price
+        self.stock[key] -= 1
+        player.add_item(key)
+        return price
+
+    def sell(self, player, key):
+        if key not in player.inventory:
+            return None
+        price = self.sell_price(key)
+        player.remove_item(key)
+        player.gold += price
+        self.stock[key] = self.stock.get(key, 0) + 1
+        return price
+
+    def restock(self):
+        """Between visits every shelf drifts one unit back towards its usual level."""
+        for key in set(self.stock) | set(self.usual):
+            have, want = self.stock.get(key, 0), self.usual.get(key, 0)
+            self.stock[key] = have + (want > have) - (want < have)
+
+def get_shop(player, area, tier):
+    """The shop for this arena in this run, restocked a little since the last visit."""
+    shop = player.shops.get(area["name"])
+    if shop is None:
+        shop = player.shops[area["name"]] = Shop(area["name"], tier, area.get("loot", ()))
+    else:
+        shop.restock()
+    return shop
+
+def stacked_inventory(player):
+    """Inventory as (item, count) stacks, in the order each item was first picked up."""
+    counts = {}
+    for key in player.inventory:
+        counts[key] = counts.get(key, 0) + 1
+    return list(counts.items())
 
 # -------------------- Story & Overworld art --------------------
-def show_zone_ui(stdscr, ui, area):
+def show_zone_ui(ui, area):
     ui.draw_zone_art(area["art"], area["name"], area["desc"])
 
 # -------------------- Game flow (curses main) --------------------
-def shop_menu(ui, player):
-    items = SHOP_ITEMS
+def shop_menu(ui, player, shop):
     selection = 0
+    top = 0           # first listing shown; long inventories scroll
     mode = "buy"  # "buy" or "sell"
+    list_y = 6
 
-    while True:
-        ui.stdscr.clear()
-        ui.stdscr.addstr(1, 2, f"🏪 Shop — Mode: {mode.upper()} — Gold: {player.gold}")
-        ui.stdscr.addstr(3, 2, "Press TAB to switch between BUY/SELL | Q to leave")
-
+    def listing():
         if mode == "buy":
-            ui.stdscr.addstr(5, 2, "Items for Sale:")
-            for i, item in enumerate(items):
-                line = f"{item['name']} - {item['price']} gold"
-                if i == selection:
-                    line = "> " + line
-                ui.stdscr.addstr(6 + i, 4, line)
-        else:
-            ui.stdscr.addstr(5, 2, "Your Inventory:")
-            inv_items = [(iid, 1) for iid in player.inventory]
-            if not inv_items:
-                ui.stdscr.addstr(7, 4, "(empty)")
-            for i, (item_id, qty) in enumerate(inv_items):
-                item = ITEMS[item_id]
-                sell_price = max(1, item.get("value", 10) // 2)
-                line = f"{item['name']} x{qty} - sells for {sell_price} gold"
-                if i == selection:
-                    line = "> " + line
-                ui.stdscr.addstr(7 + i, 4, line)
-
-        ui.stdscr.refresh()
-        key = ui.stdscr.getkey().lower()
+            return [(key, n, shop.buy_price(key)) for key, n in shop.wares()]
+        return [(key, n, shop.sell_price(key)) for key, n in stacked_inventory(player)]
+
+    def visible():
+        return max(1, ui.height - list_y - 3)
+
+    def draw_row(i):
+        key, n, price = entries[i]
+        what = f"{price} gold" if mode == "buy" else f"sells for {price} gold"
+        line = f"{'> ' if i == selection else '  '}{ITEMS[key]['name']} x{n} - {what}"
+        ui.put(list_y + i - top, 4, line.ljust(max(0, ui.width - 6)))
+
+    def draw():
+        ui.clear()
+        ui.put(1, 2, f"🏪 {shop.name} Shop — Mode: {mode.upper()} — Gold: {player.gold}")
+        ui.put(3, 2, "Press TAB to switch between BUY/SELL | Q or Esc to leave")
+        ui.put(5, 2, "Items for Sale:" if mode == "buy" else "Your Inventory:")
+        if not entries:
+            ui.put(list_y, 4, "(sold out)" if mode == "buy" else "(empty)")
+        for i in range(top, min(len(entries), top + visible())):
+            draw_row(i)
+
+    entries = listing()
+    ui.on_resize = draw
+    draw()
+    while True:
+        ui.refresh()
+        _, cmd = ui.command("shop")
 
         # Exit
-        if key == "q":
+        if cmd == "leave":
+            ui.on_resize = None
             break
         # Switch mode
-        elif key == "\t":
+        elif cmd == "mode":
             mode = "sell" if mode == "buy" else "buy"
-            selection = 0
-        # Move selection
-        elif key in ("w", "k"):
-            selection = max(0, selection - 1)
-        elif key in ("s", "j"):
-            if mode == "buy":
-                selection = min(len(items) - 1, selection + 1)
-            else:
-                inv_len = len(player.inventory)
-                selection = min(inv_len - 1, selection + 1) if inv_len > 0 else 0
+            selection = top = 0
+            entries = listing()
+            draw()
+        # Move selection: only the two rows that changed are redrawn, unless the list has to scroll
+        elif cmd in ("up", "down") and entries:
+            old = selection
+            step = -1 if cmd == "up" else 1
+            selection = max(0, min(len(entries) - 1, selection + step))
+            if selection < top or selection >= top + visible():
+                top = max(0, min(selection, selection - visible() + 1))
+                draw()
+            elif selection != old:
+                draw_row(old)
+                draw_row(selection)
         # Confirm action
-        elif key in (" ", "\n"):
+        elif cmd == "confirm" and entries:
+            item_id = entries[selection][0]
             if mode == "buy":
-                chosen = items[selection]
-                if player.gold >= chosen["price"]:
-                    player.gold -= chosen["price"]
-                    player.add_item(chosen["id"])
-                    ui.display_message_with_animation(f"Bought {chosen['name']}!", y=ui.height - 3)
-                else:
+                price = shop.buy(player, item_id)
+                if price is None:
                     ui.display_message_with_animation("Not enough gold!", y=ui.height - 3)
+                else:
+                    stats_trade(player, shop.name, item_id, "buy", price)
+                    ui.display_message_with_animation(f"Bought {ITEMS[item_id]['name']}!", y=ui.height - 3)
             else:  # sell mode
-                inv_items = [(iid, 1) for iid in player.inventory]
-                if not inv_items:
-                    continue
-                item_id, qty = inv_items[selection]
-                sell_price = max(1, ITEMS[item_id].get("value", 10) // 2)
-                player.gold += sell_price
-                player.remove_item(item_id)
-                ui.display_message_with_animation(
-                    f"Sold {ITEMS[item_id]['name']} for {sell_price} gold.",
-                    y=ui.height - 3
-                )
-                selection = 0
-
-def choose_class_curses(stdscr, ui):
+                price = shop.sell(player, item_id)
+                stats_trade(player, shop.name, item_id, "sell", price)
+                ui.display_message_with_animation(f"Sold {ITEMS[item_id]['name']} for {price} gold.", y=ui.height - 3)
+            # stock, prices and the stacks all moved
+            entries = listing()
+            selection = min(selection, max(0, len(entries) - 1))
+            top = min(top, selection)
+            draw()
+
+def choose_class_curses(ui):
     ui.clear()
-    ui.stdscr.addstr(1, 2, "Choose a class (1 Knight, 2 Wizard, 3 Bandit): ")
-    ui.stdscr.refresh()
+    ui.put(1, 2, "Choose a class (1 Knight, 2 Wizard, 3 Bandit): ")
+    ui.refresh()
     while True:
-        k = ui.stdscr.getkey()
-        if k == "1":
-            return "Knight"
-        if k == "2":
-            return "Wizard"
-        if k == "3":
-            return "Bandit"
-        ui.stdscr.addstr(3, 2, "Invalid choice. Press 1,2 or 3.")
+        _, pclass = ui.command("class")
+        if pclass:
+            return pclass
+        ui.put(3, 2, "Invalid choice. Press 1,2 or 3.")
 
 def get_choice(options, ui, prompt="Choose an option:"):
     """
     Displays a simple choice list with curses and returns the chosen option.
     """
-    stdscr = ui.stdscr
-    curses.curs_set(0)
     selected = 0
 
-    while True:
+    def draw():
         ui.clear()
-        stdscr.addstr(2, 2, prompt, curses.A_BOLD)
+        ui.put(2, 2, prompt, curses.A_BOLD)
         for i, opt in enumerate(options):
             attr = curses.A_REVERSE if i == selected else curses.A_NORMAL
-            stdscr.addstr(4 + i, 4, opt, attr)
-        stdscr.refresh()
+            ui.put(4 + i, 4, opt, attr)
+
+    ui.on_resize = draw
+    while True:
+        draw()
+        ui.refresh()
 
-        key = stdscr.getch()
-        if key in [curses.KEY_UP, ord("w")]:
+        _, cmd = ui.command("choice")
+        if cmd == "up":
             selected = (selected - 1) % len(options)
-        elif key in [curses.KEY_DOWN, ord("s")]:
+        elif cmd == "down":
             selected = (selected + 1) % len(options)
-        elif key in [ord("\n"), 10, 13]:
+        elif cmd == "confirm":
+            ui.on_resize = None
             return options[selected]
 
 
-def main_curses(stdscr):
-    ui = UI(stdscr)
+# endings with their own cutscene; the rest get the plain outcome card
+ENDING_SCENES = {
+    "Liberator": show_throne_room_ending,
+    "Elder Dragon Ally": show_spared_dragon_ending,
+    "Dragonslayer": show_ending_cutscene,
+    "Hoard King": show_ending_cutscene,
+}
+
+def finish_run(ui, player):
+    """Resolve, record and show the run's ending."""
+    final = resolve_ending(player)
+    stats_end_run(player, final)
+    scene = ENDING_SCENES.get(final)
+    if scene:
+        scene(ui, player)
+    else:
+        ui.clear()
+        ui.draw_text_block(["=== FINAL OUTCOME ===", f"Ending: {final}", "", "Thanks for playing!"], 2, 2)
+        ui.getch()
+
+def fallen(ui, player):
+    ui.display_message_with_animation("You have been defeated. Press any key.", y=ui.height-3)
+    ui.getch()
+    final = resolve_ending(player)
+    stats_end_run(player, final)
+    ui.display_message_with_animation(f"{final}. Your run ends.", y=ui.height-4)
+    ui.getch()
+
+def run_game(ui):
     ui.clear()
-    ui.stdscr.addstr(1, 2, "Welcome to Clash-Style Curses RPG!")
-    ui.stdscr.addstr(3, 2, "Enter your name (press Enter for 'Champion'):")
-    curses.echo()
-    name = ui.stdscr.getstr(4, 2, 20).decode().strip()
-    curses.noecho()
+    ui.put(1, 2, "Welcome to Clash-Style Curses RPG!")
+    ui.put(3, 2, "Enter your name (press Enter for 'Champion'):")
+    name = ui.getstr(4, 2, 20).strip()
     if not name:
         name = "Champion"
-    pclass = choose_class_curses(stdscr, ui)
+    pclass = choose_class_curses(ui)
     player = Player(name, pclass)
+    stats_start_run(player)
     # starter items
     player.inventory.extend(["small_potion", "elixir_bottle"])
     if pclass == "Wizard":
@@ -1446,53 +5093,92 @@ def main_curses(stdscr):
         player.inventory.append("treasure_map")
         player.inventory.append("crown_key")
     # progression
-    area_index = 0
+    zone = START_ZONE
     saw_dragons_peak = False
-    while area_index < len(AREAS):
-        area = AREAS[area_index]
-        show_zone_ui(stdscr, ui, area)
+    run_seed = random.randrange(1 << 30)  # addresses this run's procedural wilds
+    while zone is not None:
+        area = ZONES[zone]
+        tier = ZONE_TIERS[zone]
+        wilds_seed = f"{run_seed}-{zone}"
+        # generate the wilds next to this zone while the player reads the zone art
+        prefetch_arena(wilds_seed, tier)
+        show_zone_ui(ui, area)
         explored_once = False
         if area.get("id") == "dragons_peak":
             saw_dragons_peak = True
         # area loop
         while True:
             ui.clear()
-            ui.draw_text_block([f"Area: {area['name']}", area["desc"], "", "Commands: e Explore  r Rest  i Inventory  s Stats  n Next  q Quit  p Shop"], 1, 2)
+            ui.draw_text_block([f"Area: {area['name']}", area["desc"], "", "Commands: e Explore  w Wilds  r Rest  i Inventory  s Stats  h Party  n Next  q Quit  p Shop"], 1, 2)
             ui.refresh()
-            k = ui.stdscr.getkey()
-            if k.lower() == "e":
-                explored_once = True
-                result = combat_sequence(stdscr, ui, player, area)
+            _, cmd = ui.command("zone")
+            if cmd in ("explore", "wilds"):
+                if cmd == "explore":
+                    explored_once = True
+                    fight_area = area
+                else:
+                    fight_area = get_arena(wilds_seed, tier)
+                    show_zone_ui(ui, fight_area)
+                enemies = spawn_enemies(fight_area, PLAYER_START, director=player.director)
+                resolved = False
+                odds = is_trivial_fight(player, fight_area, enemies)
+                if odds is not None:
+                    # trivial fight: offer to skip the animated combat using the precomputed tables
+                    ui.clear()
+                    ui.draw_text_block([
+                        f"Encounter: {', '.join(e['name'] for e in enemies)}",
+                        f"Win chance {odds[0]:.0%}, expected HP loss ~{odds[1]:.0f}.",
+                        "Auto-resolve this fight? (y/n)",
+                    ], 1, 2)
+                    ui.refresh()
+                    if ui.command("confirm")[1] == "yes":
+                        auto_msgs = []
+                        resolved = auto_resolve(player, fight_area, odds, auto_msgs, enemies)
+                        ui.draw_text_block(auto_msgs + ["", "Press any key to continue..."], 5, 2)
+                        ui.refresh()
+                        ui.getch()
+                result = True if resolved else combat_sequence(ui, player, fight_area, enemies)
                 if result is None:
-                    # player died
-                    ui.display_message_with_animation("You have been defeated. Press any key.", y=ui.height-3)
-                    ui.stdscr.getch()
-                    # final outcome display
-                    end_msg = "Fallen Champion. Your run ends."
-                    ui.display_message_with_animation(end_msg, y=ui.height-4)
-                    ui.stdscr.getch()
+                    fallen(ui, player)
                     return
                 elif result is True:
                     # level up check
                     if player.exp >= 20 * player.level:
-                        player.level += 1
-                        player.max_hp += 6
-                        player.hp = player.max_hp
-                        player.strength += 1
-                        player.agility += 1
-                        player.magic += 1
-                        player.mana = player.magic * 2
+                        apply_level_gain(player)
                         ui.display_message_with_animation(f"Level up! Now level {player.level}", y=ui.height-4)
-                        ui.stdscr.getch()
+                        ui.getch()
+                    for ally in player.companions:
+                        if ally.exp >= 20 * ally.level:
+                            apply_level_gain(ally)
                 else:
                     # fled
                     pass
-            elif k.lower() == "r":
-                player.hp = player.max_hp
-                player.mana = player.magic * 2
+            elif cmd == "rest":
+                for hero in [player] + player.companions:
+                    hero.hp = hero.max_hp
+                    hero.mana = hero.magic * 2
                 ui.display_message_with_animation("You rest and fully recover your health and mana.", y=ui.height - 4)
-                ui.stdscr.getch()
-            elif k.lower() == "i":
+                ui.getch()
+            elif cmd == "party":
+                ui.clear()
+                lines = ["Party:"] + [f"  {hero.summary_line()}  Lv:{hero.level}" for hero in [player] + player.companions]
+                if len(player.companions) + 1 < PARTY_MAX:
+                    lines += ["", f"Hire a companion for {hire_cost(player)} gold (you have {player.gold}):",
+                              "1 Knight, 2 Wizard, 3 Bandit — any other key to leave."]
+                else:
+                    lines += ["", "Your party is full. Press any key."]
+                ui.draw_text_block(lines, 1, 2)
+                ui.refresh()
+                _, pclass = ui.command("class")
+                if pclass and len(player.companions) + 1 < PARTY_MAX:
+                    if player.gold < hire_cost(player):
+                        ui.display_message_with_animation("Not enough gold.", y=ui.height - 4)
+                    else:
+                        player.gold -= hire_cost(player)
+                        hero = hire_companion(player, pclass)
+                        ui.display_message_with_animation(f"{hero.name} the {pclass} joins your party!", y=ui.height - 4)
+                    ui.getch()
+            elif cmd == "inventory":
                 ui.clear()
                 # Show equipped gear
                 if player.equipment:
@@ -1512,42 +5198,37 @@ def main_curses(stdscr):
                 )
                 ui.refresh()
 
-                ch = ui.stdscr.getkey()
+                _, pick = ui.command("inventory")
 
                 # Use item
-                if ch.isdigit():
-                    idx = int(ch) - 1
-                    if 0 <= idx < len(player.inventory):
-                        key = player.inventory.pop(idx)
+                if pick in PICK_KEYS.values():
+                    if pick <= len(player.inventory):
+                        key = player.inventory.pop(pick - 1)
                         ok, msg = player.apply_item(key)
                         ui.display_message_with_animation(msg, y=ui.height - 4)
-                        ui.stdscr.getch()
+                        ui.getch()
 
                 # Inspect item
-                elif ch.lower() == "i":
-                    ui.stdscr.addstr(11, 2, "Inspect which item number? ")
-                    curses.echo()
-                    s = ui.stdscr.getstr(11, 30, 2).decode()
-                    curses.noecho()
+                elif pick == "inspect":
+                    ui.put(11, 2, "Inspect which item number? ")
+                    s = ui.getstr(11, 30, 2)
                     if s.isdigit():
                         idx = int(s) - 1
                         if 0 <= idx < len(player.inventory):
                             desc = player.describe_item(player.inventory[idx])
                             ui.display_message_with_animation(desc, y=ui.height - 4)
-                            ui.stdscr.getch()
+                            ui.getch()
 
                 # Discard
-                elif ch.lower() == "d":
-                    ui.stdscr.addstr(11, 2, "Discard which item number? ")
-                    curses.echo()
-                    s = ui.stdscr.getstr(11, 31, 2).decode()
-                    curses.noecho()
+                elif pick == "discard":
+                    ui.put(11, 2, "Discard which item number? ")
+                    s = ui.getstr(11, 31, 2)
                     if s.isdigit():
                         idx = int(s) - 1
                         if 0 <= idx < len(player.inventory):
                             removed = player.inventory.pop(idx)
                             ui.display_message_with_animation(f"Discarded {ITEMS[removed]['name']}", y=ui.height - 4)
-                            ui.stdscr.getch()
+                            ui.getch()
                             ui.clear()
                             # >>> Show equipped gear
                             equipped_lines = []
@@ -1565,201 +5246,208 @@ def main_curses(stdscr):
                             # <<<
                             ui.draw_text_block(["Press number to use, d + number to discard, or any other key to return."], 10 + len(inv_lines), 2)
                             ui.refresh()
-                            ch = ui.stdscr.getkey()
-                            if ch.isdigit():
-                                idx = int(ch)-1
-                                if 0 <= idx < len(player.inventory):
-                                    key = player.inventory.pop(idx)
+                            _, pick = ui.command("inventory")
+                            if pick in PICK_KEYS.values():
+                                if pick <= len(player.inventory):
+                                    key = player.inventory.pop(pick - 1)
                                     ok, msg = player.apply_item(key)
                                     ui.display_message_with_animation(msg, y=ui.height-4)
-                                    ui.stdscr.getch()
-                            elif ch.lower() == "d":
-                                ui.stdscr.addstr(11, 2, "Enter index to discard: ")
-                                curses.echo()
-                                s = ui.stdscr.getstr(11, 26, 2).decode()
-                                curses.noecho()
+                                    ui.getch()
+                            elif pick == "discard":
+                                ui.put(11, 2, "Enter index to discard: ")
+                                s = ui.getstr(11, 26, 2)
                                 if s.isdigit():
                                     idx = int(s)-1
                                     if 0 <= idx < len(player.inventory):
                                         removed = player.inventory.pop(idx)
                                         ui.display_message_with_animation(f"Discarded {ITEMS[removed]['name']}", y=ui.height-4)
-                                        ui.stdscr.getch()
-            elif k.lower() == "s":
+                                        ui.getch()
+            elif cmd == "stats":
                 ui.clear()
-                ui.draw_text_block([player.summary_line(), f"Gold: {player.gold}  Level:{player.level}  Exp:{player.exp}"], 2, 2)
+                ui.draw_text_block([player.summary_line(), f"Gold: {player.gold}  Level:{player.level}  Exp:{player.exp}",
+                                    "", player.director.summary(), zone_line(player), ""] + stats_lines(), 2, 2)
                 ui.draw_text_block(["Press any key to continue..."], ui.height - 3, 2)
-                ui.stdscr.getch()
-            elif k.lower() == "n":
+                ui.getch()
+            elif cmd == "next":
                 if explored_once == True:
-
-                    # Check if we're currently in Desert Arena
-                    if area["id"] == "desert_arena":
-                        # Only unlock if player has both items
-                        if ("treasure_map" in player.inventory or "has_map" in player.story_flags) and ("crown_key" in player.inventory or "has_crown_key" in player.story_flags):
-                            area_index = len(AREAS) - 1  # sends player to Hidden Throne
-                            break
-
-                    # Otherwise continue normally
-                    if area["id"] == "hidden_throne":
-                        show_throne_room_ending(ui, player)
-                    if area["id"] != "dragons_peak":
-                        area_index += 1
+                    nxt = next_zone(player, zone)
+                    if nxt is not None:
+                        zone = nxt
                         break
-                    if area["id"] == "dragons_peak":
-                        ui.display_message_with_animation("You ascend to the crimson heights of Dragon’s Peak...")
-                        time.sleep(1.2)
-                        ui.display_message_with_animation("Before you stands the Adult Dragon — wings vast, eyes like molten gold.")
-                        time.sleep(1.2)
-                        ui.display_message_with_animation("It rumbles: 'Mortal... you dare approach my roost?'")
-                        time.sleep(1.0)
-
-                        choice = get_choice(["Fight", "Spare"], ui, prompt="How will you face the dragon?")
-
-                        player_pos = (GRID_ROWS // 2, 1)
-                        dragonspeak_area = deepcopy(area)
-                        dragonspeak_area["encounters"] = ["adult_dragon"]
-
-                        if choice == "Fight":
-                            ui.display_message_with_animation("You draw your weapon. The dragon rears up and unleashes a roar!")
-                            time.sleep(1.0)
-                            enemies = spawn_enemies(dragonspeak_area, player_pos)
-                            area = AREAS[5]
-                            result = combat_sequence(stdscr, ui, player, area)
-                            if result is None:
-                                # player died
-                                ui.display_message_with_animation("You have been defeated. Press any key.", y=ui.height-3)
-                                ui.stdscr.getch()
-                                # final outcome display
-                                end_msg = "Fallen Champion. Your run ends."
-                                ui.display_message_with_animation(end_msg, y=ui.height-4)
-                                ui.stdscr.getch()
-                                time.sleep(1)
-                                exit()
-                            else:
-                                show_ending_cutscene(ui, player)
-                                
-
-                        elif choice == "Spare":
-                            ui.display_message_with_animation("You kneel, lowering your weapon in a gesture of peace...")
-                            time.sleep(1.2)
-                            ui.display_message_with_animation("The dragon’s gaze narrows, testing your resolve.")
-                            time.sleep(1.0)
-
-                            # --- Compute peaceful success chance ---
-                            base_chance = 0.35
-                            if player.magic >= 10:
-                                base_chance += 0.25  # strong magic aura calms it
-                            if "dragon_scale" in player.inventory or "dragon_scale" in player.story_flags:
-                                base_chance += 0.25  # you carry the scent of dragonkind
-
-                            # Cap at 90% max success chance
-                            base_chance = min(base_chance, 0.9)
-
-                            if random.random() < base_chance:
-                                ui.display_message_with_animation("The dragon’s eyes soften. A deep rumble shakes the air — laughter.")
-                                time.sleep(1.0)
-                                ui.display_message_with_animation("'You show wisdom, mortal. Take this, a token of my kin.'")
-                                player.story_flags.add("befriended_adult_dragon")
-                                player.story_flags.add("befriended_dragon")
-                                player.add_item("dragon_scale")
-                                time.sleep(1.0)
-                                ui.display_message_with_animation("You receive the Dragon Scale in peace.")
-                                time.sleep(1.0)
-                                show_spared_dragon_ending(ui, player)
-                            else:
-                                ui.display_message_with_animation("The dragon’s lips curl into a sneer. 'Foolish... mercy is weakness.'")
-                                time.sleep(1.0)
-                                ui.display_message_with_animation("You draw your weapon. The dragon rears up and unleashes a roar!")
-                                time.sleep(1.0)
-                                area = AREAS[5]
-                                result = combat_sequence(stdscr, ui, player, area)
-                                if result is None:
-                                    # player died
-                                    ui.display_message_with_animation("You have been defeated. Press any key.", y=ui.height-3)
-                                    ui.stdscr.getch()
-                                    # final outcome display
-                                    end_msg = "Fallen Champion. Your run ends."
-                                    ui.display_message_with_animation(end_msg, y=ui.height-4)
-                                    ui.stdscr.getch()
-                                    time.sleep(1)
-                                    exit()
-                                else:
-                                    show_ending_cutscene(ui, player)
+                    if zone == "hidden_throne":
+                        player.story_flags.add("liberator")
+                        finish_run(ui, player)
+                        return
+                    if zone not in ZONE_FIGHTS:
+                        ui.display_message_with_animation("No road leads on from here.", y=ui.height-4)
+                        ui.getch()
+                        continue
+                    ui.display_message_with_animation("You ascend to the crimson heights of Dragon’s Peak...")
+                    ui.pause(1.2)
+                    ui.display_message_with_animation("Before you stands the Adult Dragon — wings vast, eyes like molten gold.")
+                    ui.pause(1.2)
+                    ui.display_message_with_animation("It rumbles: 'Mortal... you dare approach my roost?'")
+                    ui.pause(1.0)
+
+                    choice = get_choice(["Fight", "Spare"], ui, prompt="How will you face the dragon?")
+
+                    if choice == "Spare":
+                        ui.display_message_with_animation("You kneel, lowering your weapon in a gesture of peace...")
+                        ui.pause(1.2)
+                        ui.display_message_with_animation("The dragon’s gaze narrows, testing your resolve.")
+                        ui.pause(1.0)
+
+                        # --- Compute peaceful success chance ---
+                        base_chance = 0.35
+                        if player.magic >= 10:
+                            base_chance += 0.25  # strong magic aura calms it
+                        if player.has_flag("dragon_scale"):
+                            base_chance += 0.25  # you carry the scent of dragonkind
+
+                        # Cap at 90% max success chance
+                        base_chance = min(base_chance, 0.9)
+
+                        if random.random() < base_chance:
+                            ui.display_message_with_animation("The dragon’s eyes soften. A deep rumble shakes the air — laughter.")
+                            ui.pause(1.0)
+                            ui.display_message_with_animation("'You show wisdom, mortal. Take this, a token of my kin.'")
+                            player.story_flags.add("befriended_dragon")
+                            player.add_item("dragon_scale")
+                            ui.pause(1.0)
+                            ui.display_message_with_animation("You receive the Dragon Scale in peace.")
+                            ui.pause(1.0)
+                            finish_run(ui, player)
                             return
+                        ui.display_message_with_animation("The dragon’s lips curl into a sneer. 'Foolish... mercy is weakness.'")
+                        ui.pause(1.0)
+
+                    # fight it out, by choice or because mercy was refused
+                    ui.display_message_with_animation("You draw your weapon. The dragon rears up and unleashes a roar!")
+                    ui.pause(1.0)
+                    result = combat_sequence(ui, player, ZONES[ZONE_FIGHTS[zone]])
+                    if result is None:
+                        fallen(ui, player)
+                        return
+                    if result is False:
+                        ui.display_message_with_animation("You flee the roost. The dragon's roar follows you down the mountain.", y=ui.height-4)
+                        ui.getch()
+                        continue
+                    player.story_flags.add("slain_dragon")
+                    finish_run(ui, player)
+                    return
                 else:
                     ui.display_message_with_animation("Explore once to progress to the next area", y=ui.height-4)
-            elif k.lower() == "p":
-                shop_menu(ui, player)
-            elif k.lower() == "q":
+            elif cmd == "shop":
+                shop_menu(ui, player, get_shop(player, area, tier))
+            elif cmd == "quit":
                 ui.display_message_with_animation("Quitting... press any key.", y=ui.height-4)
-                ui.stdscr.getch()
+                ui.getch()
                 # final outcome quick summary
-                if player.hp <= 0:
-                    final = "Fallen Champion"
-                elif "befriended_dragon" in player.story_flags:
-                    final = "Dragon Companion"
-                
-                elif "slain_dragon" in player.story_flags:
-                    final = "Hoard King"
-                elif player.exp > 80 or player.level >= 6:
-                    final = "Arena Legend"
-                else:
-                    final = "Wandering Champion"
+                final = resolve_ending(player)
+                stats_end_run(player, final)
                 ui.display_message_with_animation(f"Ending: {final}. Thanks for playing!", y=ui.height-4)
-                ui.stdscr.getch()
+                ui.getch()
                 return
             else:
                 # ignore
                 pass
-    if (("has_map" in player.story_flags or "treasure_map" in player.inventory) and
-        ("has_crown_key" in player.story_flags or "crown_key" in player.inventory)):
-        return  # Secret path chosen, do NOT trigger dragon sequence
-    # Dragon's Peak final sequence
-    # Dragon's Peak final sequence - only run if player actually reached Dragon's Peak
-    # Final Ending
-    if player.hp <= 0:
-        final = "Fallen Champion"
-    elif "befriended_adult_dragon" in player.story_flags:
-        final = "Elder Dragon Ally"
-    elif "slain_adult_dragon" in player.story_flags:
-        final = "Dragonsbane"
-    elif player.exp > 80 or player.level >= 6:
-        final = "Arena Legend"
-    else:
-        final = "Wandering Champion"
+    finish_run(ui, player)
 
-    ui.clear()
-    ui.draw_text_block(["=== FINAL OUTCOME ===", f"Ending: {final}", "", "Thanks for playing!"], 2, 2)
-    ui.stdscr.getch()
-
-
-    if player.hp <= 0:
-        final = "Fallen Champion"
-    elif "true_ruler" in player.story_flags:    # <--- ADD THIS LINE
-        final = "True Ruler"
-    elif "befriended_dragon" in player.story_flags:
-        final = "Dragon Companion"
-    elif "slain_dragon" in player.story_flags and player.gold > 60:
-        final = "Hoard King"
-    elif player.exp > 80 or player.level >= 6:
-        final = "Arena Legend"
-    else:
-        final = "Wandering Champion"
+def main_curses(stdscr, recorder=None):
+    return run_game(UI(CursesRenderer(stdscr), recorder))
 
-    ui.clear()
-    ui.draw_text_block(["=== FINAL OUTCOME ===", f"Ending: {final}", "", "Thanks for playing!"], 2, 2)
-    ui.stdscr.getch()
+SOAK_KEYS = "eeewwrisnhp" + "wasd" * 3 + "1234mpu" + " \nyn"  # everything but q, weighted towards fighting
+
+def soak_test(n_keys=20000, seed=0):
+    """
+    Play games back to back on n_keys random keys with the null renderer, at full speed.
+    Returns (games started, seconds).
+    """
+    rng = random.Random(seed)
+    random.seed(seed)
+    keys = iter([rng.choice(SOAK_KEYS) for _ in range(n_keys)])
+    games = 0
+    start = time.perf_counter()
+    try:
+        while True:
+            games += 1
+            run_game(UI(NullRenderer(keys)))
+    except EOFError:
+        pass
+    return games, time.perf_counter() - start
 
 def main():
-    curses.wrapper(main_curses)
+    if "--build-outcome-tables" in sys.argv:
+        # offline: python3 clash_rpg2_fixed.py --build-outcome-tables [sims]
+        i = sys.argv.index("--build-outcome-tables")
+        sims = int(sys.argv[i + 1]) if len(sys.argv) > i + 1 else 40
+        table = build_outcome_tables(sims=sims)
+        print(f"Wrote {len(table)} encounter compositions to {OUTCOME_TABLE_PATH}")
+        return
+    if "--replay" in sys.argv:
+        # python3 clash_rpg2_fixed.py --replay FILE [--speed X] [--turn N ...] [--frame N ...]
+        # with --turn/--frame the screens are printed as plain text instead of being played back
+        path = sys.argv[sys.argv.index("--replay") + 1]
+        turns, frames = cli_values("--turn", int), cli_values("--frame", int)
+        if turns or frames:
+            dump_frames(path, set(turns), set(frames))
+        else:
+            replay_session(path, (cli_values("--speed", float) or [1.0])[0])
+        return
+    if "--env-bench" in sys.argv:
+        # python3 clash_rpg2_fixed.py --env-bench [steps] [--envs K] [--seed N]: bot environment throughput
+        i = sys.argv.index("--env-bench")
+        n = int(sys.argv[i + 1]) if len(sys.argv) > i + 1 and sys.argv[i + 1].isdigit() else 100000
+        steps, episodes, secs = env_benchmark(n, (cli_values("--envs", int) or [64])[0], (cli_values("--seed", int) or [0])[0])
+        print(f"Env: {steps} steps, {episodes} episodes in {secs:.2f}s ({steps / max(secs, 1e-9):.0f} steps/s)")
+        return
+    if "--duel" in sys.argv:
+        # python3 clash_rpg2_fixed.py --duel ENEMY [--class C] [--level N] [--tier T]: exact 1v1 odds
+        print_duel_odds(sys.argv[sys.argv.index("--duel") + 1], (cli_values("--class") or ["Knight"])[0],
+                        (cli_values("--level", int) or [1])[0], (cli_values("--tier", int) or [0])[0])
+        return
+    if "--stats-report" in sys.argv:
+        # python3 clash_rpg2_fixed.py --stats-report: cross-run totals from the statistics database
+        print_stats_report()
+        return
+    if "--soak" in sys.argv:
+        # python3 clash_rpg2_fixed.py --soak [keys] [--seed N]: headless random-input run on the null renderer
+        i = sys.argv.index("--soak")
+        n = int(sys.argv[i + 1]) if len(sys.argv) > i + 1 and sys.argv[i + 1].isdigit() else 20000
+        games, secs = soak_test(n, (cli_values("--seed", int) or [0])[0])
+        print(f"Soak: {n} keys over {games} games in {secs:.2f}s ({n / max(secs, 1e-9):.0f} keys/s)")
+        return
+    global DUEL_ODDS_READOUT, PRACTICE_MODE
+    DUEL_ODDS_READOUT = "--odds" in sys.argv
+    PRACTICE_MODE = "--practice" in sys.argv
+    recorder = None
+    if "--record" in sys.argv:
+        # python3 clash_rpg2_fixed.py --record FILE: play normally, saving the session for --replay
+        seed = random.randrange(1 << 32)
+        random.seed(seed)
+        recorder = SessionRecorder(sys.argv[sys.argv.index("--record") + 1], seed)
+    if "--no-stats" not in sys.argv:
+        open_stats()
+    try:
+        if "--ansi" in sys.argv:
+            # python3 clash_rpg2_fixed.py --ansi: plain escape sequences instead of curses
+            renderer = AnsiRenderer()
+            try:
+                run_game(UI(renderer, recorder))
+            finally:
+                renderer.close()
+        else:
+            curses.wrapper(main_curses, recorder)
+    finally:
+        close_stats()
+        if recorder:
+            recorder.close()
+
+def cli_values(flag, cast=str):
+    """Every value given for a repeatable command-line flag, e.g. --turn 3 --turn 5."""
+    return [cast(sys.argv[i + 1]) for i, a in enumerate(sys.argv[:-1]) if a == flag]
 
 
 
-def harmonize_dragon_flags(player):
-    """Ensure both short and long dragon story flags are present for compatibility."""
-    if "befriended_adult_dragon" in player.story_flags:
-        player.story_flags.add("befriended_dragon")
-    if "slain_adult_dragon" in player.story_flags:
-        player.story_flags.add("slain_dragon")
 if __name__ == "__main__":
     main()
@@ -0,0 +1,20 @@
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clash_rpg2_fixed as game
+
+
+def test_dragon_finale_always_spawns_one_adult_dragon():
+    finale = game.ZONES["dragon_finale"]
+    random.seed(0)
+    for difficulty in (0.5, 0.7, 1.0, 1.5, 2.0):
+        director = game.EncounterDirector()
+        director.difficulty = difficulty
+        for _ in range(50):
+            enemies = game.spawn_enemies(finale, game.PLAYER_START, director=director)
+            assert [e["key"] for e in enemies] == ["adult_dragon"]
+        # without a director too
+        assert [e["key"] for e in game.spawn_enemies(finale, game.PLAYER_START)] == ["adult_dragon"]